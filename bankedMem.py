@@ -0,0 +1,84 @@
+from nmigen import *
+from nmigen.cli import main
+from multiMem import MultiMem
+from matrixScheduler import PiorityEncoder
+from util import *
+
+class BankedMem(Elaboratable):
+    # Same ports as a MultiMem, but built from a few small MultiMems with only a few ports each.
+    #
+    # The low bits of the address pick the bank. Each bank's ports go to its requests from the
+    # highest numbered port down. Like a MultiMem, two writes to the same address in one cycle is
+    # undefined. A request which doesn't get a bank port this cycle has its grant low: a read
+    # returns junk and a write doesn't happen.
+
+    def __init__(self, width, depth, readPorts, writePorts, banks, bankReadPorts, bankWritePorts, init=None):
+        assert banks & (banks - 1) == 0 and depth % banks == 0, "banks must be a power of two that divides depth"
+        self.bankBits = (banks - 1).bit_length()
+        self.bankReadPorts = bankReadPorts
+        self.bankWritePorts = bankWritePorts
+        self.banks = [MultiMem(width, depth // banks, bankReadPorts, bankWritePorts, init=init[b::banks] if init else None)
+                      for b in range(banks)]
+
+        # read ports
+        self.read_addr = [Signal((depth-1).bit_length(), name=f"read_addr{i}") for i in range(readPorts)]
+        self.read_enable = [Signal(name=f"read_en{i}") for i in range(readPorts)]
+        self.read_data = [Signal(width, name=f"read_data{i}") for i in range(readPorts)]
+        self.read_grant = [Signal(name=f"read_grant{i}") for i in range(readPorts)]
+
+        # write ports
+        self.write_addr = [Signal((depth-1).bit_length(), name=f"write_addr{i}") for i in range(writePorts)]
+        self.write_enable = [Signal(name=f"write_en{i}") for i in range(writePorts)]
+        self.write_data = [Signal(width, name=f"write_data{i}") for i in range(writePorts)]
+        self.write_grant = [Signal(name=f"write_grant{i}") for i in range(writePorts)]
+
+    def bankOf(self, addr):
+        return addr[:self.bankBits]
+
+    def arbitrate(self, m, kind, addrs, enables, grants, bankPorts):
+        # Returns (bank, port, hot) for every bank port, where hot has a bit set for the request it serves,
+        # and drives each request's grant
+        ports = []
+        for b in range(len(self.banks)):
+            # The last bankPorts requests for this bank get its ports, the very last one the last port
+            m.submodules[f"{kind}_arbiter_{b}"] = arbiter = PiorityEncoder(len(addrs), bankPorts)
+            m.d.comb += arbiter.input.eq(Cat(*[enable & (self.bankOf(addr) == b) for addr, enable in reversed(list(zip(addrs, enables)))]))
+            ports += [(b, bankPorts - 1 - p, Cat(*reversed(list(hot)))) for p, hot in enumerate(arbiter.outHot)]
+
+        granted = treeOR(hot for _, _, hot in ports)
+        for k, grant in enumerate(grants):
+            m.d.comb += grant.eq(granted[k])
+        return ports
+
+    def elaborate(self, platform):
+        m = Module()
+
+        for b, bank in enumerate(self.banks):
+            m.submodules[f"bank{b}"] = bank
+
+        readHits = [[] for _ in self.read_addr]
+        for b, p, hot in self.arbitrate(m, "read", self.read_addr, self.read_enable, self.read_grant, self.bankReadPorts):
+            bank = self.banks[b]
+            m.d.comb += bank.read_addr[p].eq(treeOR(Mux(hot[k], addr[self.bankBits:], 0) for k, addr in enumerate(self.read_addr)))
+            for k in range(len(self.read_addr)):
+                readHits[k] += [Mux(hot[k], bank.read_data[p], 0)]
+
+        for k, data in enumerate(readHits):
+            m.d.comb += self.read_data[k].eq(treeOR(data))
+
+        for b, p, hot in self.arbitrate(m, "write", self.write_addr, self.write_enable, self.write_grant, self.bankWritePorts):
+            bank = self.banks[b]
+            m.d.comb += [
+                bank.write_addr[p].eq(treeOR(Mux(hot[k], addr[self.bankBits:], 0) for k, addr in enumerate(self.write_addr))),
+                bank.write_data[p].eq(treeOR(Mux(hot[k], data, 0) for k, data in enumerate(self.write_data))),
+                bank.write_enable[p].eq(hot != 0),
+            ]
+
+        return m
+
+
+if __name__ == "__main__":
+    mem = BankedMem(width=2, depth=64, readPorts=12, writePorts=16, banks=4, bankReadPorts=2, bankWritePorts=2)
+    ports = mem.read_addr + mem.read_enable + mem.read_data + mem.read_grant
+    ports += mem.write_addr + mem.write_enable + mem.write_data + mem.write_grant
+    main(mem, ports=ports)
@@ -0,0 +1,756 @@
+import sys
+import time
+
+from depthAnalyzer import DepthAnalyzer
+
+# Benchmark flow
+#
+# Usage: python bench.py [benchmark ...] > bench_output.txt
+#
+# With no arguments every benchmark is run. Each benchmark is a plain function which
+# prints its own results, so they can be pasted straight into commit messages.
+
+benchmarks = {}
+
+def benchmark(fn):
+    benchmarks[fn.__name__] = fn
+    return fn
+
+class Arch:
+    NumGPR = 32
+
+def makeImpl(decodes=4, issues=4, registers=64, **kwargs):
+    class Impl:
+        NumDecodes = decodes
+        NumIssues = issues
+        numRenamingRegisters = registers
+    for key, value in kwargs.items():
+        setattr(Impl, key, value)
+    return Impl()
+
+
+@benchmark
+def depth():
+    from renamer import Renamer
+    from matrixScheduler import MatrixScheduler
+    from scheduler import Scheduler
+
+    designs = [
+        ("renamer", lambda: Renamer(makeImpl(registers=150), Arch())),
+        ("matrixScheduler", lambda: MatrixScheduler(makeImpl(), Arch())),
+        ("scheduler", lambda: Scheduler(makeImpl(), Arch())),
+    ]
+
+    for name, design in designs:
+        start = time.perf_counter()
+        analyzer = DepthAnalyzer(design(), name=name)
+        elapsed = time.perf_counter() - start
+        print("\n".join(analyzer.report()))
+        print(f"  (analyzed in {elapsed:.2f}s)")
+
+
+@benchmark
+def resolver(trials=500):
+    import random
+    from nmigen import Module
+    from nmigen.back.pysim import Simulator, Settle, Delay
+    from renamer import ChainResolver, PrefixResolver
+
+    for width in [4, 6, 8, 16]:
+        chain = ChainResolver(width, 8, 6)
+        prefix = PrefixResolver(width, 8, 6)
+
+        chainDepth = DepthAnalyzer(chain, name="chain").moduleDepth()
+        prefixDepth = DepthAnalyzer(prefix, name="prefix").moduleDepth()
+
+        # Randomised equivalence check. Use a tiny arch register space so conflicts are common
+        m = Module()
+        m.submodules.chain = chain
+        m.submodules.prefix = prefix
+        inputs = ["regA", "regB", "regOut", "isAllocated", "allocated", "ratA", "ratB"]
+        for name in inputs:
+            for a, b in zip(getattr(chain, name), getattr(prefix, name)):
+                m.d.comb += b.eq(a)
+
+        mismatches = 0
+        sim = Simulator(m)
+        def process():
+            nonlocal mismatches
+            rng = random.Random(width)
+            for _ in range(trials):
+                for i in range(width):
+                    yield chain.regA[i].eq(rng.randrange(4))
+                    yield chain.regB[i].eq(rng.randrange(4))
+                    yield chain.regOut[i].eq(rng.randrange(4))
+                    yield chain.isAllocated[i].eq(rng.random() < 0.8)
+                    yield chain.allocated[i].eq(rng.randrange(256))
+                    yield chain.ratA[i].eq(rng.randrange(256))
+                    yield chain.ratB[i].eq(rng.randrange(256))
+                yield Settle()
+                for name in ["outA", "outB", "updateEnabled"]:
+                    for a, b in zip(getattr(chain, name), getattr(prefix, name)):
+                        if (yield a) != (yield b):
+                            mismatches += 1
+                yield Delay(1e-9)
+        sim.add_process(process)
+        sim.run()
+
+        print(f"{width}-wide: chain {chainDepth} levels, prefix {prefixDepth} levels "
+              f"({chainDepth - prefixDepth} fewer), {trials} random groups, {mismatches} mismatches")
+
+
+def _renamerTrace(impl, icache, cycles, readyChance=1.0, seed=0):
+    # Run the Renamer off a given dummy icache, returns every (outA, outB, outOut) it produced
+    # and how many cycles the output was ready. With readyChance < 1, outReady is randomly dropped
+    import random
+    from nmigen.back.pysim import Simulator, Settle, Tick
+    from renamer import Renamer
+
+    renamer = Renamer(impl, Arch())
+    for decoder in renamer.decoders:
+        decoder.dummy_icache.init = icache
+
+    rng = random.Random(seed)
+    renamed = []
+    stats = {"readyCycles": 0}
+    sim = Simulator(renamer)
+    def process():
+        for _ in range(cycles):
+            yield Tick()
+            ready = rng.random() < readyChance
+            yield renamer.outReady.eq(ready)
+            yield Settle()
+            stats["readyCycles"] += ready
+            for i in range(impl.NumDecodes):
+                if ready and (yield renamer.outValid[i]):
+                    renamed.append(((yield renamer.outA[i]), (yield renamer.outB[i]), (yield renamer.outOut[i])))
+    sim.add_clock(1e-6)
+    sim.add_process(process)
+    sim.run()
+    return renamer, renamed, stats["readyCycles"]
+
+
+@benchmark
+def renameStages(seeds=3, cycles=100):
+    import random
+
+    for resolver in ["chain", "prefix"]:
+        mismatches = 0
+        compared = 0
+        for seed in range(seeds):
+            rng = random.Random(seed)
+            icache = [rng.randrange(1 << 15) for _ in range(256)]
+
+            _, single, _ = _renamerTrace(makeImpl(registers=150, RenameResolver=resolver), icache, cycles)
+            _, double, _ = _renamerTrace(makeImpl(registers=150, RenameResolver=resolver, RenameStages=2), icache, cycles + 1)
+
+            compared += len(single)
+            mismatches += sum(a != b for a, b in zip(single, double)) + abs(len(single) - len(double))
+
+        print(f"{resolver}: {compared} renamed uops compared over {seeds} random streams, {mismatches} mismatches")
+
+    from renamer import Renamer
+    for decodes in [4, 8]:
+        for stages in [1, 2]:
+            renamer = Renamer(makeImpl(decodes=decodes, registers=150, RenameStages=stages), Arch())
+            analyzer = DepthAnalyzer(renamer)
+            fixup = max(analyzer.regInput[out][0] for out in renamer.outA + renamer.outB)
+            print(f"  {decodes}-wide, {stages} stage: {analyzer.moduleDepth()} levels worst, {fixup} levels into outA/outB")
+
+
+def _schedulers():
+    # (name, impl, constructor) for every scheduling backend, for the trace driven comparisons
+    from matrixScheduler import MatrixScheduler
+    from camScheduler import CamScheduler
+    from issueQueue import IssueQueue
+    return [
+        ("matrixScheduler", makeImpl(), MatrixScheduler),
+        ("camScheduler", makeImpl(), CamScheduler),
+        ("issueQueue 4x8", makeImpl(IssueQueueSize=8), IssueQueue),
+        ("issueQueue 4x16", makeImpl(IssueQueueSize=16), IssueQueue),
+    ]
+
+@benchmark
+def issueQueue(length=2000):
+    from traceSim import mixedTrace, runScheduler
+
+    traces = [
+        ("mixed", mixedTrace(length)),
+        ("high ILP", mixedTrace(length, seed=1, regs=32, locality=0.1)),
+    ]
+
+    for name, impl, scheduler in _schedulers():
+        ipcs = []
+        for traceName, trace in traces:
+            stats = runScheduler(scheduler(impl, Arch()), impl, trace)
+            ipcs += [f"{traceName} IPC {stats['ipc']:.2f}"]
+
+        design = scheduler(impl, Arch())
+        analyzer = DepthAnalyzer(design)
+        total = analyzer.summary()
+        select = max(analyzer.arrival[valid][0] for valid in design.readyValid[:design.NumIssues])
+        print(f"{name}: {', '.join(ipcs)}; {total['levels']} levels worst, {select} levels to select, ~{total['luts']} LUTs")
+
+
+def _consumerLatency(scheduler, gap):
+    # Uop 5 issues and completes, then a consumer of 5 is inserted gap cycles after the
+    # completion (0 is the same cycle). Returns how many cycles after insert the consumer issues
+    from nmigen.back.pysim import Simulator, Settle, Tick
+    from decoder import ALU
+
+    def issued():
+        ids = []
+        for valid, ready in zip(scheduler.readyValid[:scheduler.NumIssues], scheduler.ready):
+            if (yield valid):
+                ids += [(yield ready)]
+        return ids
+
+    result = []
+    def process():
+        if hasattr(scheduler, "inUnits"):
+            yield scheduler.inUnits[0].eq(ALU)
+        yield scheduler.inOut[0].eq(5)
+        yield scheduler.inValid[0].eq(1)
+        yield Tick()
+        yield scheduler.inValid[0].eq(0)
+
+        # Wait for 5 to issue, and complete it straight away
+        for _ in range(10):
+            yield Settle()
+            if 5 in (yield from issued()):
+                break
+            yield Tick()
+        yield scheduler.clear_addr[0].eq(5)
+
+        for cycle in range(gap + 20):
+            if cycle == gap:
+                yield scheduler.inOut[0].eq(6)
+                yield scheduler.inA[0].eq(5)
+                yield scheduler.inB[0].eq(5)
+                yield scheduler.inValid[0].eq(1)
+            yield Settle()
+            if cycle > gap and 6 in (yield from issued()):
+                result.append(cycle - gap)
+                return
+            yield Tick()
+            yield scheduler.clear_addr[0].eq(0)
+            yield scheduler.inValid[0].eq(0)
+
+    sim = Simulator(scheduler)
+    sim.add_clock(1e-6)
+    sim.add_process(process)
+    sim.run()
+    return result[0] if result else None
+
+@benchmark
+def scoreboard(length=2000):
+    from traceSim import mixedTrace, runScheduler
+
+    trace = mixedTrace(length)
+    for name, impl, scheduler in _schedulers():
+        latencies = [_consumerLatency(scheduler(impl, Arch()), gap) for gap in [0, 1, 10]]
+        latencies = ", ".join("never" if latency is None else str(latency) for latency in latencies)
+
+        filtered = runScheduler(scheduler(impl, Arch()), impl, trace)
+        unfiltered = runScheduler(scheduler(impl, Arch()), impl, trace, filterCompleted=False)
+
+        print(f"{name}: consumer inserted 0/1/10 cycles after its producer completed issues after {latencies} cycles; "
+              f"IPC {filtered['ipc']:.2f} with completed sources passed as NULL, {unfiltered['ipc']:.2f} with their IDs")
+
+
+@benchmark
+def core(cycles=2000):
+    from core import Core
+    from traceSim import mixedTrace, program, runCore, runScheduler
+    from matrixScheduler import MatrixScheduler
+
+    for name, trace in [("mixed", mixedTrace(256)), ("high ILP", mixedTrace(256, seed=1, regs=32, locality=0.1))]:
+        impl = makeImpl(NumClears=8)
+        reference = runScheduler(MatrixScheduler(impl, Arch()), impl, trace * 4, filterCompleted=False)
+
+        results = []
+        for stages in [1, 2]:
+            impl = makeImpl(NumClears=8, RenameStages=stages)
+            stats = runCore(Core(impl, Arch(), program(trace)), cycles)
+            results += [f"{stats['ipc']:.2f} uops/cycle with {stages} stage rename"]
+
+        print(f"{name}: {', '.join(results)} (scheduler alone {reference['ipc']:.2f})")
+
+@benchmark
+def backpressure(cycles=400):
+    import random
+    from core import Core
+    from traceSim import mixedTrace, program, runCore
+
+    # Renamer on its own with the scheduler randomly refusing groups. Everything it hands over
+    # must match what it produces with no stalls, in order, with nothing dropped or repeated
+    rng = random.Random(0)
+    icache = [rng.randrange(1 << 15) for _ in range(256)]
+    for stages in [1, 2]:
+        impl = makeImpl(registers=150, RenameStages=stages)
+        _, reference, _ = _renamerTrace(impl, icache, cycles * 2)
+        for readyChance in [0.8, 0.5, 0.2]:
+            _, renamed, readyCycles = _renamerTrace(impl, icache, cycles, readyChance, seed=stages)
+            mismatches = sum(a != b for a, b in zip(renamed, reference))
+            groups = len(renamed) / impl.NumDecodes
+            print(f"{stages} stage rename, ready {readyChance:.0%} of cycles: {groups / readyCycles:.2f} groups per ready cycle, "
+                  f"{len(renamed)} uops, {mismatches} mismatches")
+
+    # Small issue queues fill up and push back through rename to fetch
+    for name, trace in [("mixed", mixedTrace(256)), ("high ILP", mixedTrace(256, seed=1, regs=32, locality=0.1))]:
+        results = []
+        for size in [4, 8, 16]:
+            impl = makeImpl(NumClears=8, Scheduler="queues", IssueQueueSize=size)
+            stats = runCore(Core(impl, Arch(), program(trace)), cycles * 5)
+            results += [f"{stats['ipc']:.2f} with {size} entry queues"]
+        print(f"{name} core: {', '.join(results)} uops/cycle")
+
+@benchmark
+def moveElimination(cycles=2000):
+    from core import Core
+    from traceSim import mixedTrace, withIdioms, program, runCore
+
+    for registers in [64, 40]:
+        for rate in [0.0, 0.1, 0.25]:
+            trace = withIdioms(mixedTrace(256, regs=16), rate)
+            results = []
+            for eliminate in [False, True]:
+                impl = makeImpl(NumClears=8, registers=registers, MoveElimination=eliminate)
+                stats = runCore(Core(impl, Arch(), program(trace)), cycles)
+                issued = stats["uops"] - stats["eliminated"]
+                results += [f"{stats['ipc']:.2f} uops/cycle, {issued / stats['uops']:.0%} issued"]
+            print(f"{registers} registers, {rate:.0%} idioms: without {results[0]}; with {results[1]}")
+
+@benchmark
+def fusion(cycles=2000):
+    from core import Core
+    from traceSim import mixedTrace, withFusablePairs, program, runCore
+
+    for name, trace in [("mixed", mixedTrace(256)), ("high ILP", mixedTrace(256, seed=1, regs=32, locality=0.1))]:
+        for rate in [0.0, 0.15, 0.3]:
+            pairs = withFusablePairs(trace, rate)
+            results = []
+            for rules in [[], None]:
+                impl = makeImpl(NumClears=8) if rules is None else makeImpl(NumClears=8, FusionRules=rules)
+                stats = runCore(Core(impl, Arch(), program(pairs)), cycles)
+                fused = 2 * stats["fused"] / stats["uops"]
+                results += [f"{stats['ipc']:.2f} uops/cycle, {fused:.0%} fused"]
+            print(f"{name}, {rate:.0%} pairs: without fusion {results[0]}; with {results[1]}")
+
+@benchmark
+def uopCache(cycles=1000):
+    from core import Core
+    from traceSim import mixedTrace, withFusablePairs, program, runCore
+
+    # The program is one loop, so it either fits in the cache and streams or keeps missing.
+    # High ILP, so that the front end is the limit rather than the scheduler
+    for length in [32, 64, 128, 256]:
+        trace = withFusablePairs(mixedTrace(length, seed=1, regs=32, locality=0.1), 0.15)
+        results = []
+        for entries in [0, 16, 64]:
+            stats = runCore(Core(makeImpl(NumClears=8, UopCacheEntries=entries), Arch(), program(trace)), cycles)
+            groups = stats["uopCacheHits"] + stats["uopCacheMisses"]
+            delivered = stats["renamed"] / stats["cycles"]
+            if entries:
+                results += [f"{entries} entries {stats['uopCacheHits'] / groups:.0%} hits, {delivered:.2f} uops/cycle delivered"]
+            else:
+                results += [f"no cache {delivered:.2f} uops/cycle delivered"]
+        print(f"{length} instruction loop: {'; '.join(results)}")
+
+def _flushRecovery(wrongPath, chained, flush, missLatency=20):
+    # A load misses, and a branch behind it turns out mispredicted just after wrongPath uops
+    # (all waiting on the load) went into the scheduler. Returns how many cycles until the scheduler
+    # holds none of them any more, and how many issue slots they took.
+    # Everything but the load has latency 1
+    from nmigen.back.pysim import Simulator, Settle, Tick
+    from matrixScheduler import MatrixScheduler
+
+    impl = makeImpl(registers=64)
+    scheduler = MatrixScheduler(impl, Arch())
+    load = 1
+    squashed = list(range(2, 2 + wrongPath))
+    mask = sum(1 << id for id in squashed)
+    stats = {"wasted": 0}
+
+    def process():
+        # The load, then the wrong path, one group a cycle
+        groups = [[(load, 0)]]
+        for start in range(0, wrongPath, impl.NumDecodes):
+            groups += [[(id, id - 1 if chained else load) for id in squashed[start:start + impl.NumDecodes]]]
+        for group in groups:
+            for i in range(impl.NumDecodes):
+                out, source = group[i] if i < len(group) else (0, 0)
+                yield scheduler.inOut[i].eq(out)
+                yield scheduler.inA[i].eq(source)
+                yield scheduler.inValid[i].eq(i < len(group))
+            yield Tick()
+        for i in range(impl.NumDecodes):
+            yield scheduler.inValid[i].eq(0)
+
+        # Mispredict found, the load completes missLatency cycles later
+        cycle = 0
+        while True:
+            yield scheduler.flush_hot.eq(mask if flush and cycle == 0 else 0)
+            yield Settle()
+            clears = [load] if cycle == missLatency else []
+            for p in range(impl.NumIssues):
+                if (yield scheduler.readyValid[p]):
+                    id = yield scheduler.ready[p]
+                    if id != load:
+                        clears += [id]
+                        stats["wasted"] += id in squashed
+            for c, clear in enumerate(scheduler.clear_addr):
+                yield clear.eq(clears[c] if c < len(clears) else 0)
+            yield Tick()
+            yield Settle()
+            cycle += 1
+
+            pending = (yield scheduler.waiting_for_select) & mask
+            for id in squashed:
+                pending |= yield scheduler.matrix.rows[id - 1].values
+            if not pending:
+                stats["cycles"] = cycle
+                return
+
+    sim = Simulator(scheduler)
+    sim.add_clock(1e-6)
+    sim.add_process(process)
+    sim.run()
+    return stats
+
+
+@benchmark
+def flush():
+    for chained in [False, True]:
+        for wrongPath in [16, 48]:
+            results = []
+            for squash in [False, True]:
+                stats = _flushRecovery(wrongPath, chained, squash)
+                results += [f"{stats['cycles']} cycles, {stats['wasted']} issue slots wasted"]
+            shape = "dependent chain" if chained else "independent"
+            print(f"{wrongPath} {shape} wrong path uops behind a 20 cycle miss: drained {results[0]}; flushed {results[1]}")
+
+@benchmark
+def wakeup(length=1000):
+    from traceSim import mixedTrace, runScheduler
+    from matrixScheduler import MatrixScheduler
+    from camScheduler import CamScheduler
+    from scheduler import Scheduler
+
+    # The direct wakeup Scheduler has no issue path that seeds wakeups yet, so it can't run a trace
+    trace = mixedTrace(length)
+    for registers in [32, 64, 128]:
+        impl = makeImpl(registers=registers)
+        for name, scheduler, runs in [("matrix", MatrixScheduler, True), ("cam", CamScheduler, True), ("direct", Scheduler, False)]:
+            total = DepthAnalyzer(scheduler(impl, Arch())).summary()
+            ipc = f"IPC {runScheduler(scheduler(impl, Arch()), impl, trace)['ipc']:.2f}" if runs else "IPC n/a"
+            print(f"{registers} entries, {name}: {ipc}, {total['levels']} levels, ~{total['luts']} LUTs, "
+                  f"{total['flops']} flops, {total['memoryBits']} memory bits")
+
+@benchmark
+def buildCache():
+    import tempfile
+    from nmigen.back import rtlil
+    from buildCache import BuildCache
+    from core import Core
+    from traceSim import mixedTrace, program
+
+    # A small sweep, converted to RTLIL without the cache, then twice with an empty one
+    configs = [dict(registers=registers, Scheduler=scheduler) for registers in [48, 64] for scheduler in ["matrix", "cam"]]
+    trace = program(mixedTrace(256))
+
+    start = time.perf_counter()
+    for config in configs:
+        core = Core(makeImpl(NumClears=8, **config), Arch(), trace)
+        rtlil.convert(core, ports=[core.cycles, core.completed])
+    print(f"uncached: {time.perf_counter() - start:.1f}s")
+
+    with tempfile.TemporaryDirectory() as path:
+        for run in ["cold", "warm"]:
+            cache = BuildCache(path)
+            start = time.perf_counter()
+            for config in configs:
+                core = Core(makeImpl(NumClears=8, BuildCache=cache, **config), Arch(), trace)
+                cache.convert(core, ports=[core.cycles, core.completed])
+            print(f"{run} cache: {time.perf_counter() - start:.1f}s, {cache.hits} hits, {cache.misses} misses")
+
+@benchmark
+def replay(length=500):
+    from traceSim import mixedTrace, runScheduler
+    from matrixScheduler import MatrixScheduler
+
+    # The oracle knows which loads miss before waking anything, it's the bound replay is measured against.
+    # Replays cost issue slots, so they only show up as lost IPC once issue bandwidth is short
+    for name, trace in [("mixed", mixedTrace(length)), ("high ILP", mixedTrace(length, seed=1, regs=32, locality=0.1))]:
+        for missRate in [0.0, 0.1, 0.2]:
+            impl = makeImpl()
+            oracle = runScheduler(MatrixScheduler(impl, Arch()), impl, trace, missRate=missRate)
+            results = []
+            for cancelDelay in [1, 3]:
+                impl = makeImpl(Replay=True)
+                stats = runScheduler(MatrixScheduler(impl, Arch()), impl, trace, missRate=missRate, cancelDelay=cancelDelay)
+                loss = 1 - stats["ipc"] / oracle["ipc"]
+                results += [f"miss known after {cancelDelay}: IPC {stats['ipc']:.2f} ({loss:.1%} lost), {stats['replays']} replays"]
+            print(f"{name}, {missRate:.0%} load misses ({oracle['misses']} loads): oracle IPC {oracle['ipc']:.2f}; {'; '.join(results)}")
+@benchmark
+def ratPorts(cycles=1000):
+    import random
+    from core import Core
+    from renamer import Renamer
+    from traceSim import mixedTrace, program, runCore
+
+    # With fewer ports, groups get split but the renamed stream must come out the same, just later
+    rng = random.Random(0)
+    icache = [rng.randrange(1 << 15) for _ in range(256)]
+    for stages in [1, 2]:
+        _, reference, _ = _renamerTrace(makeImpl(registers=150, RenameStages=stages), icache, 100)
+        for ports in [6, 4, 2]:
+            _, renamed, _ = _renamerTrace(makeImpl(registers=150, RenameStages=stages, RATReadPorts=ports), icache, 400)
+            mismatches = sum(a != b for a, b in zip(reference, renamed)) + max(len(reference) - len(renamed), 0)
+            print(f"{stages} stage rename, {ports} read ports: {len(reference)} renamed uops compared, {mismatches} mismatches")
+
+    for ports in [8, 6, 4]:
+        total = DepthAnalyzer(Renamer(makeImpl(registers=150, RATReadPorts=ports), Arch())).summary()
+        print(f"  {ports} read ports: {total['levels']} levels, ~{total['luts']} LUTs")
+
+    for name, trace in [("mixed", mixedTrace(256)), ("high ILP", mixedTrace(256, seed=1, regs=32, locality=0.1))]:
+        results = []
+        for ports in [8, 6, 5, 4]:
+            stats = runCore(Core(makeImpl(NumClears=8, RATReadPorts=ports), Arch(), program(trace)), cycles)
+            groups = stats["uopCacheHits"] + stats["uopCacheMisses"]
+            results += [f"{ports} ports {stats['ratSplits'] / groups:.0%} of groups split, {stats['ipc']:.2f} uops/cycle"]
+        print(f"{name}: {'; '.join(results)}")
+def _dispatchTrace(impl, trace):
+    # Renames trace in python (IDs handed out in order) and feeds it to the direct wakeup Scheduler
+    # as fast as it takes it. Returns how many cycles that took and how many of them stalled
+    from nmigen.back.pysim import Simulator, Settle, Tick
+    from scheduler import Scheduler
+
+    scheduler = Scheduler(impl, Arch())
+    rat = {}
+    uops = []
+    for n, uop in enumerate(trace):
+        out = n % (impl.numRenamingRegisters - 1) + 1
+        uops.append((out, rat.get(uop.a, 0), rat.get(uop.b, 0)))
+        rat[uop.out] = out
+
+    stats = {"cycles": 0, "stalls": 0}
+    def process():
+        pending = {}
+        while uops or pending:
+            if not pending:
+                pending = dict(enumerate(uops[:impl.NumDecodes]))
+                del uops[:impl.NumDecodes]
+            for k in range(impl.NumDecodes):
+                out, a, b = pending.get(k, (0, 0, 0))
+                yield scheduler.inOut[k].eq(out)
+                yield scheduler.inA[k].eq(a)
+                yield scheduler.inB[k].eq(b)
+                yield scheduler.inValid[k].eq(k in pending)
+            yield Settle()
+            stats["stalls"] += yield scheduler.stall
+            for k in list(pending):
+                if (yield scheduler.inTaken[k]):
+                    del pending[k]
+            yield Tick()
+            stats["cycles"] += 1
+
+    sim = Simulator(scheduler)
+    sim.add_clock(1e-6)
+    sim.add_process(process)
+    sim.run()
+    return stats
+
+@benchmark
+def statusBanks(length=200):
+    from traceSim import mixedTrace
+    from scheduler import Scheduler
+
+    # The direct wakeup Scheduler can't issue yet, so this is how fast it takes uops in
+    configs = [("fully ported", {}),
+               ("4 banks of 2R/2W", dict(StatusBanks=4)),
+               ("8 banks of 2R/2W", dict(StatusBanks=8)),
+               ("4 banks of 3R/3W", dict(StatusBanks=4, StatusBankReadPorts=3, StatusBankWritePorts=3))]
+
+    for name, config in configs:
+        analyzer = DepthAnalyzer(Scheduler(makeImpl(**config), Arch()))
+        total = analyzer.summary()
+        reads, writes = analyzer.widestMemory()
+        print(f"{name}: {total['levels']} levels, ~{total['luts']} LUTs of logic, ~{total['memoryLuts']} LUTs of memory, "
+              f"widest memory {reads}R/{writes}W")
+
+    for traceName, trace in [("mixed", mixedTrace(length)), ("high ILP", mixedTrace(length, seed=1, regs=32, locality=0.1))]:
+        results = []
+        for name, config in configs:
+            stats = _dispatchTrace(makeImpl(**config), trace)
+            results += [f"{name} {length / stats['cycles']:.2f} uops/cycle, {stats['stalls'] / stats['cycles']:.0%} of cycles stalled"]
+        print(f"{traceName}: {'; '.join(results)}")
+@benchmark
+def flatMatrix(length=300):
+    from nmigen.hdl.ir import Fragment
+    from traceSim import mixedTrace, runScheduler
+    from matrixScheduler import MatrixScheduler
+
+    trace = mixedTrace(length)
+    for registers in [64, 150]:
+        results = []
+        for name, config in [("per row", {}), ("flat", dict(FlatMatrix=True))]:
+            impl = makeImpl(registers=registers, **config)
+
+            start = time.perf_counter()
+            Fragment.get(MatrixScheduler(impl, Arch()), None).prepare()
+            elaborate = time.perf_counter() - start
+
+            start = time.perf_counter()
+            stats = runScheduler(MatrixScheduler(impl, Arch()), impl, trace)
+            simulate = time.perf_counter() - start
+
+            total = DepthAnalyzer(MatrixScheduler(impl, Arch())).summary()
+            results += [f"{name} elaborates in {elaborate:.2f}s, simulates {stats['cycles'] / simulate:.0f} cycles/s "
+                        f"({stats['cycles']} cycles), {total['modules']} modules, {total['signals']} signals, "
+                        f"~{total['luts']} LUTs, {total['levels']} levels"]
+        print(f"{registers} entries: {'; '.join(results)}")
+@benchmark
+def smt(cycles=1000):
+    from core import Core
+    from traceSim import mixedTrace, program, runCore
+
+    # Two independent low ILP threads (mostly reading the last few results), alone and then sharing the core
+    traces = [program(mixedTrace(256, seed=seed, locality=0.9)) for seed in [0, 1]]
+    for t, trace in enumerate(traces):
+        stats = runCore(Core(makeImpl(NumClears=8), Arch(), trace), cycles)
+        print(f"thread {t} alone: {stats['ipc']:.2f} uops/cycle")
+
+    for policy in ["roundRobin", "icount"]:
+        stats = runCore(Core(makeImpl(NumClears=8, Threads=2, ThreadPolicy=policy), Arch(), traces), cycles)
+        perThread = ", ".join(f"thread {t} {uops / stats['cycles']:.2f}" for t, uops in enumerate(stats["threadUops"]))
+        print(f"SMT {policy}: {stats['ipc']:.2f} uops/cycle ({perThread})")
+@benchmark
+def criticalSelect(length=1000):
+    from traceSim import mixedTrace, runScheduler
+    from matrixScheduler import MatrixScheduler
+
+    configs = [("position", {}),
+               ("fanout", dict(Select="fanout")),
+               ("fanout, age 16", dict(Select="fanout", SelectAgeLimit=16)),
+               ("fanout, age 4", dict(Select="fanout", SelectAgeLimit=4))]
+
+    for name, config in configs:
+        total = DepthAnalyzer(MatrixScheduler(makeImpl(FlatMatrix=True, **config), Arch())).summary()
+        print(f"{name}: {total['levels']} levels, ~{total['luts']} LUTs")
+
+    # Select only matters when there are more ready uops than issue ports
+    traces = [("mixed", mixedTrace(length)), ("high ILP", mixedTrace(length, seed=1, regs=32, locality=0.1))]
+    for traceName, trace in traces:
+        for issues in [2, 4]:
+            results = []
+            for name, config in configs:
+                impl = makeImpl(issues=issues, FlatMatrix=True, **config)
+                results += [f"{name} {runScheduler(MatrixScheduler(impl, Arch()), impl, trace)['ipc']:.3f}"]
+            print(f"{traceName}, {issues} issue: IPC {'; '.join(results)}")
+
+@benchmark
+def twoLevel(length=600):
+    from traceSim import mixedTrace, runScheduler
+    from matrixScheduler import MatrixScheduler
+    from twoLevelScheduler import TwoLevelScheduler
+
+    # A small window in front of a waiting buffer, against a matrix over every renaming register
+    counters = ["promotions", "windowOccupancy", "bufferOccupancy", "windowFull"]
+    configs = [
+        ("matrix, 32 registers", MatrixScheduler, dict(registers=32)),
+        ("matrix, 128 registers", MatrixScheduler, dict(registers=128)),
+        ("two level, 16+64", TwoLevelScheduler, dict(registers=128, WindowEntries=16, WaitingEntries=64)),
+        ("two level, 24+64", TwoLevelScheduler, dict(registers=128, WindowEntries=24, WaitingEntries=64)),
+    ]
+
+    for name, scheduler, config in configs:
+        total = DepthAnalyzer(scheduler(makeImpl(FlatMatrix=True, **config), Arch())).summary()
+        print(f"{name}: {total['levels']} levels, ~{total['luts']} LUTs, {total['flops']} flops, {total['memoryBits']} memory bits")
+
+    traces = [("mixed", mixedTrace(length)), ("high ILP", mixedTrace(length, seed=1, regs=32, locality=0.1))]
+    for traceName, trace in traces:
+        for missRate in [0.0, 0.2]:
+            for name, scheduler, config in configs:
+                impl = makeImpl(FlatMatrix=True, **config)
+                twoLevel = scheduler is TwoLevelScheduler
+                stats = runScheduler(scheduler(impl, Arch()), impl, trace, missRate=missRate, counters=counters if twoLevel else ())
+                result = f"{traceName}, {missRate:.0%} load misses, {name}: IPC {stats['ipc']:.2f}"
+                if twoLevel:
+                    cycles = stats["cycles"]
+                    result += f"; window {stats['windowOccupancy'] / cycles:.1f} full, buffer {stats['bufferOccupancy'] / cycles:.1f} full, " \
+                              f"{stats['promotions'] / cycles:.2f} promotions/cycle, no slot free {stats['windowFull'] / cycles:.0%} of cycles"
+                print(result)
+
+@benchmark
+def sampled(phase=500, passes=4):
+    from core import Core
+    from traceSim import mixedTrace, program
+    from sampledSim import sampleCore, runProgram, runModel
+
+    # Alternating low and high ILP phases, so where the samples land matters. Fetch loops around the
+    # program, which can't be much longer as pysim builds its memory out of statements
+    trace = []
+    for k in range(4):
+        trace += mixedTrace(phase, seed=k) if k % 2 == 0 else mixedTrace(phase, seed=k, regs=32, locality=0.1)
+    length = len(trace) * passes
+
+    for name, config in [("64 registers", dict(registers=64)), ("128 registers", dict(registers=128, FlatMatrix=True))]:
+        impl = makeImpl(NumClears=8, **config)
+        full = runProgram(Core(impl, Arch(), program(trace)), length)
+        model = runModel(impl, Arch(), trace, length)
+        print(f"{name}, {length} instructions: full RTL IPC {full['ipc']:.3f} in {full['seconds']:.1f}s, python model {model['ipc']:.3f} in {model['seconds']:.1f}s")
+        # A few seeds, as any one set of sample points can be unlucky
+        for samples, instructions in [(16, 150), (32, 150)]:
+            for seed in range(3):
+                result = sampleCore(Core(impl, Arch(), program(trace)), impl, Arch(), trace, samples=samples, length=instructions, passes=passes, seed=seed)
+                print(f"  {samples} samples of {instructions} instructions, seed {seed}: IPC {result['ipc']:.3f} ({result['low']:.3f} - {result['high']:.3f}) in {result['seconds']:.1f}s")
+
+@benchmark
+def registerRelease(cycles=400):
+    from core import Core
+    from traceSim import mixedTrace, program, runCore
+
+    # When a superseded register goes back in the pool decides how many uops fit in flight at a given register count
+    modes = [("at retire", "retire"), ("after last reader", "readers"), ("once written (no reads)", "complete")]
+    traces = [("mixed", mixedTrace(512)), ("high ILP", mixedTrace(512, seed=1, regs=32, locality=0.1))]
+    for traceName, trace in traces:
+        for registers in [40, 64]:
+            results = []
+            for name, mode in modes:
+                stats = runCore(Core(makeImpl(registers=registers, NumClears=8, RegisterRelease=mode), Arch(), program(trace)), cycles)
+                results += [f"{name} {stats['ipc']:.2f} uops/cycle, {stats['window']:.1f} in flight"]
+            print(f"{traceName}, {registers} registers: {'; '.join(results)}")
+
+@benchmark
+def asymmetricDecode(cycles=400):
+    from core import Core
+    from decoder import Decoder, simpleOpcodes
+    from traceSim import mixedTrace, program, runCore, steerTrace
+
+    # The first slots decode everything, the rest only simple instructions. "no loads" leaves loads to the complex decoders too
+    aluOnly = ["add", "sub", "and", "or", "branch"]
+    configs = [("4 complex", dict()),
+               ("2 complex + 2 simple", dict(ComplexDecoders=2)),
+               ("1 complex + 3 simple", dict(ComplexDecoders=1)),
+               ("1 complex + 3 simple, no loads", dict(ComplexDecoders=1, SimpleOpcodes=aluOnly))]
+
+    for name, supported in [("complex", None), ("simple", simpleOpcodes), ("simple, no loads", aluOnly)]:
+        total = DepthAnalyzer(Decoder(0, external=True, supported=supported)).summary()
+        print(f"{name} decoder: ~{total['luts']} LUTs, {total['levels']} levels")
+
+    traces = [("mixed", mixedTrace(512)), ("high ILP", mixedTrace(512, seed=1, regs=32, locality=0.1))]
+    for traceName, trace in traces:
+        for name, config in configs:
+            impl = makeImpl(NumClears=8, **config)
+            perGroup = len(trace) / steerTrace(trace, impl.NumDecodes, config.get("ComplexDecoders", impl.NumDecodes), config.get("SimpleOpcodes", simpleOpcodes))
+            stats = runCore(Core(impl, Arch(), program(trace)), cycles)
+            print(f"{traceName}, {name}: {perGroup:.2f} instructions per decode group ({1 - perGroup / impl.NumDecodes:.0%} of decode bandwidth lost), "
+                  f"{stats['decoded'] / stats['cycles']:.2f} decoded/cycle, {stats['decodeSplits'] / stats['cycles']:.0%} of cycles split, {stats['ipc']:.2f} uops/cycle")
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        print(f"==== {name} ====")
+        benchmarks[name]()
+        print()
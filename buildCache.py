@@ -0,0 +1,272 @@
+import hashlib
+import inspect
+import json
+import os
+import sys
+import tempfile
+
+import nmigen
+from nmigen import *
+from nmigen.hdl.ir import Fragment
+from nmigen.back import rtlil
+
+# Content addressed cache of elaborated modules
+#
+# Wrap a submodule with cached(Impl, Class, *args) instead of Class(*args). When Impl.BuildCache
+# is set, the submodule becomes a CachedModule: the first time a given class, set of arguments and
+# source is seen it's elaborated on its own and its RTLIL stored on disk; after that the parent
+# just gets an Instance of it and the submodule is never elaborated again, in this process or any other.
+#
+# The key covers the class, its arguments (Impl and Arch objects by their public attributes),
+# the nmigen version and every source file in this repo reachable from the class's module.
+#
+# Generation only. A CachedModule is a black box to the simulator, so leave Impl.BuildCache unset
+# for anything that simulates.
+
+root = os.path.dirname(os.path.abspath(__file__))
+defaultPath = os.environ.get("CUBE_BUILD_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "cube-build"))
+
+
+def _sourceFiles(module, files):
+    # Every module in this repo that module uses, directly or through another one
+    file = getattr(module, "__file__", None)
+    if not file or not os.path.abspath(file).startswith(root + os.sep) or file in files:
+        return
+    files.add(file)
+    for value in vars(module).values():
+        dependency = value if inspect.ismodule(value) else inspect.getmodule(value)
+        if dependency is not None:
+            _sourceFiles(dependency, files)
+
+def _describe(value):
+    # Stable text for anything that can be passed to a constructor
+    if isinstance(value, (bool, int, float, str, type(None))):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(_describe(v) for v in value) + "]"
+    if isinstance(value, dict):
+        return "{" + ", ".join(f"{_describe(k)}: {_describe(v)}" for k, v in sorted(value.items(), key=repr)) + "}"
+    if isinstance(value, BuildCache):
+        return "BuildCache"
+    if inspect.isfunction(value) or inspect.isclass(value):
+        return f"{value.__module__}.{value.__qualname__}"
+
+    # Impl and Arch style objects, described by their settings
+    attrs = [name for name in dir(value) if not name.startswith("_")]
+    attrs = [(name, getattr(value, name)) for name in attrs]
+    attrs = [f"{name}={_describe(v)}" for name, v in attrs if not inspect.ismethod(v)]
+    return f"{type(value).__qualname__}({', '.join(attrs)})"
+
+def _interface(design):
+    # (path, signal) for every Signal attribute of design, including ones in (nested) lists
+    def walk(path, value):
+        if isinstance(value, Signal):
+            yield path, value
+        elif isinstance(value, (list, tuple)):
+            for i, v in enumerate(value):
+                yield from walk(f"{path}[{i}]", v)
+
+    for name, value in vars(design).items():
+        yield from walk(name, value)
+
+
+def _silence(value, seen):
+    if id(value) in seen:
+        return
+    seen.add(id(value))
+    if isinstance(value, (list, tuple)):
+        for v in value:
+            _silence(v, seen)
+    elif isinstance(value, Elaboratable):
+        value._MustUse__silence = True
+        for v in vars(value).values():
+            _silence(v, seen)
+
+
+class CachedModule(Elaboratable):
+    # Stands in for the real submodule. Attribute access goes to the real one, so the parent can
+    # wire up its signals as usual
+
+    def __init__(self, cache, key, design):
+        self._cache = cache
+        self._key = key
+        self._design = design
+
+        # It's only elaborated on a miss, so don't warn if it (or anything in it) isn't
+        _silence(design, set())
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._design, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            self.__dict__[name] = value
+        else:
+            setattr(self._design, name, value)
+
+    def elaborate(self, platform):
+        meta = self._cache.load(self._key)
+        if meta is None:
+            meta = self._cache.store(self._key, self._design, platform)
+
+        signals = dict(_interface(self._design))
+        ports = {}
+        for port in meta["ports"]:
+            kind, _, domain = port["path"].partition(":")
+            if kind == "clk":
+                signal = ClockSignal(domain)
+            elif kind == "rst":
+                signal = ResetSignal(domain)
+            else:
+                signal = signals[port["path"]]
+            ports[f"{port['dir']}_{port['name']}"] = signal
+
+        self._cache.use(self._key, platform)
+        return Instance(meta["module"], **ports)
+
+
+class BuildCache:
+    def __init__(self, path=defaultPath):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.used = [] # Keys of every cached module in the last design, and what they use, in order
+        self.stack = [] # Keys used by each cached module being elaborated
+
+        self.sources = {} # Module name -> hash of its source files
+
+    def key(self, cls, args, kwargs):
+        module = sys.modules[cls.__module__]
+        if module.__name__ not in self.sources:
+            files = set()
+            _sourceFiles(module, files)
+            digest = hashlib.sha256()
+            for file in sorted(files):
+                with open(file, "rb") as f:
+                    digest.update(os.path.basename(file).encode() + b"\0" + f.read())
+            self.sources[module.__name__] = digest.hexdigest()
+
+        description = f"{cls.__module__}.{cls.__qualname__}({_describe(list(args))}, {_describe(kwargs)}) " \
+                      f"nmigen {nmigen.__version__} source {self.sources[module.__name__]}"
+        return hashlib.sha256(description.encode()).hexdigest()[:32]
+
+    def module(self, cls, *args, **kwargs):
+        return CachedModule(self, self.key(cls, args, kwargs), cls(*args, **kwargs))
+
+    def _file(self, key, ext):
+        return os.path.join(self.path, f"{key}.{ext}")
+
+    def _write(self, key, ext, content):
+        # Write then rename, so another process never sees half a file
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.replace(tmp, self._file(key, ext))
+
+    def meta(self, key):
+        try:
+            with open(self._file(key, "json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load(self, key):
+        meta = self.meta(key)
+        if meta is not None:
+            self.hits += 1
+        return meta
+
+    def store(self, key, design, platform):
+        self.misses += 1
+
+        signals = list(_interface(design))
+        paths = {id(signal): path for path, signal in signals}
+
+        self.stack.append([])
+        fragment = Fragment.get(design, platform)
+        fragment = fragment.prepare(ports=[signal for _, signal in signals])
+        deps = self.stack.pop()
+
+        for name, domain in fragment.domains.items():
+            paths[id(domain.clk)] = f"clk:{name}"
+            if domain.rst is not None:
+                paths[id(domain.rst)] = f"rst:{name}"
+
+        module = f"{type(design).__name__}_{key[:12]}"
+        text, names = rtlil.convert_fragment(fragment, name=module)
+        text = text.replace("attribute \\top 1\n", "")
+
+        meta = {
+            "module": module,
+            "ports": [{"path": paths[id(signal)], "dir": dir, "name": names[signal][-1]} for signal, dir in fragment.ports.items()],
+            "deps": sorted(set(deps)),
+        }
+        self._write(key, "il", text)
+        self._write(key, "json", json.dumps(meta, indent=1))
+        return meta
+
+    def use(self, key, platform):
+        # Records key and everything inside it as part of the design being built
+        keys = [key]
+        while keys:
+            used = keys.pop()
+            if self.stack:
+                self.stack[-1].append(used)
+            if used in self.used:
+                continue
+            self.used.append(used)
+            keys += self.meta(used)["deps"]
+
+            # Building for a board, the toolchain needs the module too
+            if platform is not None and hasattr(platform, "add_file"):
+                platform.add_file(f"{used}.v", self.verilog(used))
+
+    def rtlil(self, key):
+        with open(self._file(key, "il")) as f:
+            return f.read()
+
+    def verilog(self, key):
+        # Needs yosys, like nmigen's own Verilog backend
+        from nmigen.back import verilog
+        if not os.path.exists(self._file(key, "v")):
+            self._write(key, "v", verilog._convert_rtlil_text(self.rtlil(key)))
+        with open(self._file(key, "v")) as f:
+            return f.read()
+
+    def convert(self, design, name="top", ports=()):
+        # RTLIL for a whole design, with every cached module it uses appended
+        self.used = []
+        if isinstance(design, CachedModule):
+            # It's just an Instance, so give it a top to live in
+            m = Module()
+            m.submodules.design = design
+            design = m
+        text = rtlil.convert(design, name=name, ports=ports)
+        return text + "".join(self.rtlil(key) for key in self.used)
+
+    def report(self):
+        return f"build cache: {self.hits} hits, {self.misses} misses, {len(self.used)} cached modules used"
+
+
+def cached(Impl, cls, *args, **kwargs):
+    cache = getattr(Impl, "BuildCache", None)
+    if cache is None:
+        return cls(*args, **kwargs)
+    return cache.module(cls, *args, **kwargs)
+
+
+if __name__ == "__main__":
+    # python buildCache.py [clear]: how big the cache is, or empty it
+    cache = BuildCache()
+    entries = [name for name in os.listdir(cache.path) if name.endswith(".json")]
+    if sys.argv[1:] == ["clear"]:
+        for name in os.listdir(cache.path):
+            os.remove(os.path.join(cache.path, name))
+        print(f"removed {len(entries)} modules from {cache.path}")
+    else:
+        size = sum(os.path.getsize(os.path.join(cache.path, name)) for name in os.listdir(cache.path))
+        print(f"{len(entries)} modules, {size // 1024} KiB in {cache.path}")
@@ -0,0 +1,193 @@
+from nmigen import *
+from nmigen.lib.coding import *
+from nmigen.cli import main
+from matrixScheduler import PiorityEncoder, Scoreboard
+from util import *
+
+class CamEntry(Elaboratable):
+    # A single waiting uop: the renaming IDs of its two sources and whether each one is ready.
+    # Every cycle each not yet ready source tag is compared against every broadcast tag,
+    # so storage grows with size * log2(size) rather than size^2 like the matrix rows
+
+    def __init__(self, width, num_inserts, num_broadcasts, entry_id):
+        self.id = entry_id
+
+        # inputs
+        self.inserts = [Signal(name=f"entry_{entry_id}_insert_{i}") for i in range(num_inserts)]
+        self.insertA = [Signal(width) for i in range(num_inserts)]
+        self.insertB = [Signal(width) for i in range(num_inserts)]
+        self.insertReadyA = [Signal() for i in range(num_inserts)]
+        self.insertReadyB = [Signal() for i in range(num_inserts)]
+
+        self.broadcasts = [Signal(width, name=f"broadcast_{p}") for p in range(num_broadcasts)]
+
+        # State
+        self.tagA = Signal(width, name=f"entry_{entry_id}_tagA")
+        self.tagB = Signal(width, name=f"entry_{entry_id}_tagB")
+        self.readyA = Signal(name=f"entry_{entry_id}_readyA")
+        self.readyB = Signal(name=f"entry_{entry_id}_readyB")
+
+        # outputs
+        self.all_ready = Signal(name=f"entry_{entry_id}_all_ready")
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # A source that matches a broadcast this cycle can issue next cycle
+        matchA = anyEqual(self.tagA, self.broadcasts)
+        matchB = anyEqual(self.tagB, self.broadcasts)
+
+        # Renamer never puts the same ID in two slots of a group, so at most one insert hits this entry
+        inserted = treeOR(self.inserts)
+        with m.If(inserted):
+            m.d.sync += [
+                self.tagA.eq(treeOR(Mux(insert, tag, 0) for insert, tag in zip(self.inserts, self.insertA))),
+                self.tagB.eq(treeOR(Mux(insert, tag, 0) for insert, tag in zip(self.inserts, self.insertB))),
+                self.readyA.eq(treeOR(insert & ready for insert, ready in zip(self.inserts, self.insertReadyA))),
+                self.readyB.eq(treeOR(insert & ready for insert, ready in zip(self.inserts, self.insertReadyB))),
+            ]
+        with m.Else():
+            m.d.sync += [
+                self.readyA.eq(self.readyA | matchA),
+                self.readyB.eq(self.readyB | matchB),
+            ]
+
+        m.d.comb += self.all_ready.eq(self.readyA & self.readyB)
+
+        return m
+
+
+class CamScheduler(Elaboratable):
+    # Tag broadcast alternative to the MatrixScheduler, with the same interface.
+    #
+    # Like the matrix, there's one entry per renaming register (the renamingID is the entry ID),
+    # so it never refuses a group. Instead of a bit per (uop, producer) pair, each entry holds
+    # its two source tags, and every completion is broadcast as a tag on clear_addr which every
+    # entry compares against. That's 2 * width flops per entry instead of numRenamingRegisters,
+    # paid for with 2 * len(clear_addr) comparators per entry.
+    #
+    # Sources are checked against the Scoreboard at insert, so producers that have already completed
+    # (or complete that cycle) start out ready.
+
+    def __init__(self, Impl, Arch):
+        self.width = width = Impl.numRenamingRegisters.bit_length()
+        self.NumIssues = Impl.NumIssues
+        self.NumDecodes = Impl.NumDecodes
+        self.NumQueueEntries = Impl.numRenamingRegisters
+
+        # Inputs from renamer
+        self.inA = [Signal(width, name=f"inA_{i}") for i in range(Impl.NumDecodes)]
+        self.inB = [Signal(width, name=f"inB_{i}") for i in range(Impl.NumDecodes)]
+        self.inOut = [Signal(width, name=f"inOut_{i}") for i in range(Impl.NumDecodes)]
+        self.inValid = [Signal(name=f"inValid_{i}") for i in range(Impl.NumDecodes)]
+
+        # Completions, broadcast to every entry. Defaults to one per issue
+        self.clear_addr = [Signal(width, name=f"clear_addr_{p}") for p in range(getattr(Impl, "NumClears", Impl.NumIssues))]
+
+        # Squashes every uop in the set in one cycle, like MatrixScheduler.flush_hot
+        self.flush_hot = Signal(self.NumQueueEntries)
+
+        # Entry zero is NULL, so there's no entry for it
+        self.entries = [CamEntry(width, Impl.NumDecodes, len(self.clear_addr), e) for e in range(1, self.NumQueueEntries)]
+
+        self.selecter = PiorityEncoder(self.NumQueueEntries, self.NumIssues)
+
+        self.scoreboard = Scoreboard(self.NumQueueEntries)
+
+        # Entries holding a uop that hasn't been selected yet
+        self.waiting_for_select = Signal(self.NumQueueEntries)
+
+        # Outputs
+        self.ready = [Signal(width, name=f"ready{i}") for i in range(self.NumIssues)]
+        self.readyHot = [Signal(self.NumQueueEntries, name=f"ready_hot{i}") for i in range(self.NumIssues)]
+        self.readyValid = [Signal(name=f"ready{i}_valid") for i in range(self.NumIssues)]
+
+        # There is an entry for every renaming register, so it can always take the next group
+        self.inReady = Signal(reset=1)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        for entry in self.entries:
+            m.submodules[f"entry_{entry.id}"] = entry
+        m.submodules.scoreboard = self.scoreboard
+        m.submodules += self.selecter
+
+        Inserts = []
+        ReadyA = []
+        ReadyB = []
+        for i in range(self.NumDecodes):
+            m.submodules[f"select_decoder_{i}"] = selectDecoder = Decoder(self.NumQueueEntries)
+            m.d.comb += selectDecoder.i.eq(self.inOut[i])
+            Inserts += [Mux(self.inValid[i], selectDecoder.o, 0)]
+
+            # Looked up once per slot and shared by every entry
+            readyA = Signal(name=f"ready_A_{i}")
+            readyB = Signal(name=f"ready_B_{i}")
+            m.d.comb += [
+                readyA.eq(self.scoreboard.ready.bit_select(self.inA[i], 1)),
+                readyB.eq(self.scoreboard.ready.bit_select(self.inB[i], 1)),
+            ]
+            ReadyA += [readyA]
+            ReadyB += [readyB]
+
+        Clears = []
+        for i, clear_addr in enumerate(self.clear_addr):
+            m.submodules[f"clear_decoder_{i}"] = clearDecoder = Decoder(self.NumQueueEntries)
+            m.d.comb += clearDecoder.i.eq(clear_addr)
+            Clears += [clearDecoder.o]
+
+        InsertedThisCycle = treeOR(Inserts)
+
+        m.d.comb += [
+            self.scoreboard.clear_hot.eq(treeOR(Clears)),
+            self.scoreboard.insert_hot.eq(InsertedThisCycle),
+            self.scoreboard.flush_hot.eq(self.flush_hot),
+        ]
+
+        for entry in self.entries:
+            for i in range(self.NumDecodes):
+                m.d.comb += [
+                    entry.inserts[i].eq(Inserts[i][entry.id]),
+                    entry.insertA[i].eq(self.inA[i]),
+                    entry.insertB[i].eq(self.inB[i]),
+                    entry.insertReadyA[i].eq(ReadyA[i]),
+                    entry.insertReadyB[i].eq(ReadyB[i]),
+                ]
+            for broadcast, clear_addr in zip(entry.broadcasts, self.clear_addr):
+                m.d.comb += broadcast.eq(clear_addr)
+
+        AllReady = Cat(Const(0, 1), *[entry.all_ready for entry in self.entries])
+        m.d.comb += self.selecter.input.eq(AllReady & self.waiting_for_select & ~self.flush_hot)
+
+        for i, (outHot, ready, readyHot, readyValid) in enumerate(zip(self.selecter.outHot, self.ready, self.readyHot, self.readyValid)):
+            m.submodules[f"ready_encoder_{i}"] = readyEncoder = Encoder(self.NumQueueEntries)
+            m.d.comb += [
+                readyHot.eq(outHot),
+                readyValid.eq(outHot[1:] != 0),
+                readyEncoder.i.eq(outHot),
+                ready.eq(readyEncoder.o),
+            ]
+
+        SelectedThisCycle = treeOR(self.selecter.outHot)
+
+        m.d.sync += self.waiting_for_select.eq(((self.waiting_for_select & ~SelectedThisCycle) | InsertedThisCycle) & ~self.flush_hot)
+
+        return m
+
+
+if __name__ == "__main__":
+    from bench import makeImpl, Arch
+    from traceSim import mixedTrace, runScheduler
+
+    impl = makeImpl(registers=64)
+    trace = mixedTrace(200)
+    stats = runScheduler(CamScheduler(impl, Arch()), impl, trace)
+    print(f"{stats['uops']} uops in {stats['cycles']} cycles, IPC {stats['ipc']:.2f}")
+
+    scheduler = CamScheduler(impl, Arch())
+    ports = scheduler.ready + scheduler.readyValid + scheduler.clear_addr
+    for inOut, inA, inB, inValid in zip(scheduler.inOut, scheduler.inA, scheduler.inB, scheduler.inValid):
+        ports += [inOut, inA, inB, inValid]
+
+    main(scheduler, ports=ports)
@@ -0,0 +1,272 @@
+from nmigen import *
+from nmigen.cli import main
+from multiMem import MultiMem
+from buildCache import cached
+from fetch import Fetch
+from renamer import Renamer
+from matrixScheduler import MatrixScheduler
+from camScheduler import CamScheduler
+from issueQueue import IssueQueue
+from execute import ExecutionPort
+from util import *
+
+class Arch:
+    NumGPR = 32
+
+class Impl:
+    NumDecodes = 4
+    NumIssues = 4
+    NumClears = 8 # Each issue port has a clear port for each latency
+    numRenamingRegisters = 64
+
+class Core(Elaboratable):
+    # Board independent top level: fetch -> decode/rename -> schedule -> execute, with
+    # completions fed back into the scheduler's clears and the renamer's register pool.
+    #
+    # There's no ROB yet, so nothing retires. Registers go back into the pool as soon as
+    # they are superseded and complete, or later with Impl.RegisterRelease (see Renamer).
+    #
+    # Stages are joined with valid/ready, so a full scheduler or an empty register pool
+    # stalls everything behind it instead of dropping uops.
+    #   Impl.Scheduler: "matrix" (never fills up, one slot per renaming register), "cam" (same, with tag broadcast
+    #   wakeup instead of the bit matrix) or "queues" (per-port issue queues)
+    #
+    # SMT: with Impl.Threads > 1, program is a list with one program per thread, each with its own fetch.
+    # Every cycle one thread's group goes into decode, picked by Impl.ThreadPolicy:
+    #   "roundRobin": take turns
+    #   "icount": the thread with the fewest uops renamed but not yet completed, so a thread that's
+    #   stuck on a long chain doesn't fill the scheduler
+    # Everything after the RAT is shared.
+
+    def __init__(self, Impl, Arch, program):
+        self.width = width = Impl.numRenamingRegisters.bit_length()
+        self.NumDecodes = Impl.NumDecodes
+        self.threads = getattr(Impl, "Threads", 1)
+        self.threadPolicy = getattr(Impl, "ThreadPolicy", "roundRobin")
+
+        programs = program if self.threads > 1 else [program]
+        assert len(programs) == self.threads, "need a program for each thread"
+        self.fetches = [Fetch(Impl, program) for program in programs]
+        self.fetch = self.fetches[0]
+        self.renamer = Renamer(Impl, Arch, closedLoop=True)
+        schedulers = {"matrix": MatrixScheduler, "cam": CamScheduler, "queues": IssueQueue}
+        self.scheduler = cached(Impl, schedulers[getattr(Impl, "Scheduler", "matrix")], Impl, Arch)
+
+        # Opcode of each uop in flight, by renaming register. Execution needs it to know the latency
+        self.opcodes = cached(Impl, MultiMem,
+            width=len(self.renamer.outOpcode[0]),
+            depth=Impl.numRenamingRegisters,
+            readPorts=self.scheduler.NumIssues,
+            writePorts=Impl.NumDecodes)
+
+        self.ports = [ExecutionPort(width, p) for p in range(self.scheduler.NumIssues)]
+
+        if self.renamer.release == "readers":
+            # Sources of each uop in flight, by renaming register. The renamer counts them off as it issues
+            self.sources = cached(Impl, MultiMem,
+                width=width * 2,
+                depth=Impl.numRenamingRegisters,
+                readPorts=self.scheduler.NumIssues,
+                writePorts=Impl.NumDecodes)
+            assert len(self.renamer.read) >= 2 * self.scheduler.NumIssues, "Impl.NumIssues needs to cover every issue port"
+
+        completions = sum(len(port.complete) for port in self.ports)
+        assert len(self.scheduler.clear_addr) >= completions, f"Impl.NumClears needs to be at least {completions}"
+
+        # Performance counters
+        self.cycles = Signal(32)
+        self.completed = Signal(32)
+        self.eliminated = Signal(32) # Moves and zero idioms the renamer handled without executing
+        self.fused = Signal(32)      # Fused uops, each one is two instructions
+        self.renamed = Signal(32)    # Uops into rename, fused ones count once
+        self.uopCacheHits = Signal(32)   # Groups delivered from the uop cache
+        self.uopCacheMisses = Signal(32) # Groups delivered from decode
+        self.ratSplits = Signal(32)      # Cycles renaming part of a group that didn't fit the RAT read ports
+        self.decodeSplits = Signal(32)   # Cycles decoding part of a group, the rest needed a complex decoder
+        self.decoded = Signal(32)        # Instructions into decode
+        self.window = Signal(32)         # Uops in flight (renamed, not completed), added up every cycle
+        self.inWindow = Signal(range(Impl.numRenamingRegisters + 1))
+
+        if self.threads > 1:
+            # Thread of each uop in flight, by renaming register
+            self.owners = cached(Impl, MultiMem,
+                width=self.renamer.threadBits,
+                depth=Impl.numRenamingRegisters,
+                readPorts=completions,
+                writePorts=Impl.NumDecodes)
+
+            self.select = Signal(self.renamer.threadBits) # Thread going into decode this cycle
+            self.lastSelect = Signal(self.renamer.threadBits)
+            self.inFlight = [Signal(range(Impl.numRenamingRegisters + 1), name=f"inFlight_{t}") for t in range(self.threads)]
+
+            # Per thread performance counters, like uops on the whole core
+            self.threadUops = [Signal(32, name=f"threadUops_{t}") for t in range(self.threads)]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        for t, fetch in enumerate(self.fetches):
+            m.submodules[f"fetch{t}" if self.threads > 1 else "fetch"] = fetch
+        m.submodules.renamer = self.renamer
+        m.submodules.scheduler = self.scheduler
+        m.submodules.opcodes = self.opcodes
+        for p, port in enumerate(self.ports):
+            m.submodules[f"port{p}"] = port
+
+        if self.threads > 1:
+            self.elaborateThreads(m)
+        else:
+            m.d.comb += [
+                self.fetch.ready.eq(self.renamer.inReady),
+                self.fetch.redirect.eq(self.renamer.redirect),
+                self.fetch.redirectAddr.eq(self.renamer.redirectAddr),
+                self.renamer.inAddr.eq(self.fetch.addr),
+                self.renamer.inNextAddr.eq(self.fetch.nextAddr),
+            ]
+
+            m.d.comb += self.fetch.taken.eq(self.renamer.steering.taken)
+            for fetched, valid, inst, instValid in zip(self.fetch.inst, self.fetch.valid, self.renamer.steering.inst, self.renamer.steering.instValid):
+                m.d.comb += [
+                    inst.eq(fetched),
+                    instValid.eq(valid),
+                ]
+
+        for i, _ in enumerate(self.renamer.outA):
+            m.d.comb += [
+                self.scheduler.inA[i].eq(self.renamer.outA[i]),
+                self.scheduler.inB[i].eq(self.renamer.outB[i]),
+                self.scheduler.inOut[i].eq(self.renamer.outOut[i]),
+                self.scheduler.inValid[i].eq(self.renamer.outValid[i]),
+
+                self.opcodes.write_addr[i].eq(self.renamer.outOut[i]),
+                self.opcodes.write_data[i].eq(self.renamer.outOpcode[i]),
+                self.opcodes.write_enable[i].eq(self.renamer.outValid[i] & self.renamer.outReady),
+            ]
+            if hasattr(self.scheduler, "inUnits"):
+                m.d.comb += self.scheduler.inUnits[i].eq(self.renamer.outUnits[i])
+
+        m.d.comb += self.renamer.outReady.eq(self.scheduler.inReady)
+
+        # Issue
+        for p, port in enumerate(self.ports):
+            m.d.comb += [
+                self.opcodes.read_addr[p].eq(self.scheduler.ready[p]),
+                port.issue.eq(self.scheduler.ready[p]),
+                port.issueValid.eq(self.scheduler.readyValid[p]),
+                port.opcode.eq(self.opcodes.read_data[p]),
+            ]
+
+        if self.renamer.release == "readers":
+            m.submodules.sources = self.sources
+            for i, _ in enumerate(self.renamer.outA):
+                m.d.comb += [
+                    self.sources.write_addr[i].eq(self.renamer.outOut[i]),
+                    self.sources.write_data[i].eq(Cat(self.renamer.outA[i], self.renamer.outB[i])),
+                    self.sources.write_enable[i].eq(self.renamer.outValid[i] & self.renamer.outReady),
+                ]
+            for p, port in enumerate(self.ports):
+                sources = self.sources.read_data[p]
+                m.d.comb += [
+                    self.sources.read_addr[p].eq(self.scheduler.ready[p]),
+                    self.renamer.read[2 * p].eq(Mux(self.scheduler.readyValid[p], sources[:self.width], 0)),
+                    self.renamer.read[2 * p + 1].eq(Mux(self.scheduler.readyValid[p], sources[self.width:], 0)),
+                ]
+
+        # Complete
+        completions = [complete for port in self.ports for complete in port.complete]
+        for i, (clear, complete) in enumerate(zip(self.scheduler.clear_addr, self.renamer.complete)):
+            completion = completions[i] if i < len(completions) else 0
+            m.d.comb += [
+                clear.eq(completion),
+                complete.eq(completion),
+            ]
+
+        m.d.sync += [
+            self.cycles.eq(self.cycles + 1),
+            self.completed.eq(self.completed + popcount(completion != 0 for completion in completions)),
+            self.eliminated.eq(self.eliminated + popcount(self.renamer.eliminated)),
+            self.fused.eq(self.fused + popcount(self.renamer.fused)),
+            self.renamed.eq(self.renamed + popcount(self.renamer.isWriter)),
+            self.uopCacheHits.eq(self.uopCacheHits + self.renamer.uopCacheHit),
+            self.uopCacheMisses.eq(self.uopCacheMisses + self.renamer.uopCacheMiss),
+            self.ratSplits.eq(self.ratSplits + self.renamer.split),
+            self.decodeSplits.eq(self.decodeSplits + (self.renamer.steering.split & self.renamer.inReady)),
+            self.decoded.eq(self.decoded + Mux(self.renamer.inReady, self.renamer.steering.taken, 0)),
+            self.inWindow.eq(self.inWindow + popcount(valid & self.renamer.outReady for valid in self.renamer.outValid)
+                - popcount(completion != 0 for completion in completions)),
+            self.window.eq(self.window + self.inWindow),
+        ]
+
+        return m
+
+    def elaborateThreads(self, m):
+        m.submodules.owners = self.owners
+
+        # Feed decode from the selected thread's fetch, the others hold their group
+        for t, fetch in enumerate(self.fetches):
+            selected = self.select == t
+            m.d.comb += fetch.ready.eq(self.renamer.inReady & selected)
+            with m.If(selected):
+                m.d.comb += [
+                    self.renamer.inAddr.eq(fetch.addr),
+                    self.renamer.inNextAddr.eq(fetch.nextAddr),
+                ]
+                for fetched, valid, inst, instValid in zip(fetch.inst, fetch.valid, self.renamer.steering.inst, self.renamer.steering.instValid):
+                    m.d.comb += [
+                        inst.eq(fetched),
+                        instValid.eq(valid),
+                    ]
+            m.d.comb += fetch.taken.eq(self.renamer.steering.taken)
+        m.d.comb += self.renamer.inThread.eq(self.select)
+
+        # Round robin starts from the thread after the last one picked, icount takes the first
+        # thread (in that order) with the fewest uops in flight
+        wrap = lambda thread: Mux(thread >= self.threads, thread - self.threads, thread)
+        order = [wrap(self.lastSelect + 1 + k) for k in range(self.threads)]
+        if self.threadPolicy == "icount":
+            count = lambda thread: Array(self.inFlight)[thread]
+            best = order[0]
+            for thread in order[1:]:
+                best = Mux(count(thread) < count(best), thread, best)
+            m.d.comb += self.select.eq(best)
+        else:
+            m.d.comb += self.select.eq(order[0])
+
+        with m.If(self.renamer.inReady):
+            m.d.sync += self.lastSelect.eq(self.select)
+
+        # Which thread each uop belongs to, written as it goes into the scheduler and read as it completes
+        entered = [valid & self.renamer.outReady for valid in self.renamer.outValid]
+        for i, enter in enumerate(entered):
+            m.d.comb += [
+                self.owners.write_addr[i].eq(self.renamer.outOut[i]),
+                self.owners.write_data[i].eq(self.renamer.outThread),
+                self.owners.write_enable[i].eq(enter),
+            ]
+
+        completions = [complete for port in self.ports for complete in port.complete]
+        for p, completion in enumerate(completions):
+            m.d.comb += self.owners.read_addr[p].eq(completion)
+
+        # Eliminated uops are counted in fix-up and fused ones at lookup, which are different groups with 2 rename stages
+        for t in range(self.threads):
+            ours = lambda thread: thread == t
+            completed = popcount((completion != 0) & ours(owner) for completion, owner in zip(completions, self.owners.read_data))
+            entering = popcount(enter & ours(self.renamer.outThread) for enter in entered)
+            m.d.sync += [
+                self.inFlight[t].eq(self.inFlight[t] + entering - completed),
+                self.threadUops[t].eq(self.threadUops[t] + completed
+                    + Mux(ours(self.renamer.fixupThread), popcount(self.renamer.eliminated), 0)
+                    + Mux(ours(self.renamer.thread), popcount(self.renamer.fused), 0)),
+            ]
+
+
+if __name__ == "__main__":
+    from traceSim import mixedTrace, program, runCore
+
+    core = Core(Impl(), Arch(), program(mixedTrace(256)))
+    stats = runCore(core, 1000)
+    print(f"{stats['uops']} uops ({stats['eliminated']} eliminated, {stats['fused']} fused pairs) in {stats['cycles']} cycles, {stats['ipc']:.2f} uops/cycle")
+
+    core = Core(Impl(), Arch(), program(mixedTrace(256)))
+    main(core, ports=[core.cycles, core.completed, core.eliminated, core.fused, core.renamed, core.uopCacheHits, core.uopCacheMisses, core.ratSplits])
@@ -1,12 +1,70 @@
 from nmigen import *
+from util import *
+
+# Execution units, one bit each in Decoder.executionUnits
+ALU0, ALU1, ALU2, MUL, LSU, BRANCH = [1 << i for i in range(6)]
+ALU = ALU0 | ALU1 | ALU2
+
+# name: (opcode, execution units, latency in cycles)
+opcodes = {
+    "add":    (13, ALU, 1),
+    "sub":    (14, ALU, 1),
+    "and":    (15, ALU, 1),
+    "or":     (16, ALU, 1),
+    "mul":    (20, MUL, 3),
+    "load":   (32, LSU, 3),
+    "branch": (40, BRANCH, 1),
+}
+
+# Instruction encoding
+#   [0:6]   regOut
+#   [6:12]  regB
+#   [12:18] regA
+#   [18:24] opcode
+#   [24:32] immediate
+def encode(opcode, regOut, regA, regB, immediate=0):
+    return regOut | regB << 6 | regA << 12 | opcode << 18 | immediate << 24
+
+# Idioms which don't need executing, both with regA == regB
+#   move: and/or of a register with itself just copies it
+#   zero: sub of a register from itself is always zero
+moveOpcodes = [opcodes["and"][0], opcodes["or"][0]]
+zeroOpcodes = [opcodes["sub"][0]]
+
+# Fused uops, which Fusion makes out of two adjacent instructions. They only exist after
+# decode and can't be encoded in an instruction.
+# name: (opcode, execution units, latency in cycles, first instruction, second instruction)
+fusedOpcodes = {
+    "subBranch": (41, BRANCH, 1, "sub", "branch"), # compare and branch
+    "addLoad":   (33, LSU, 3, "add", "load"),      # the address add is folded into the LSU's AGU
+}
+
+# Every opcode a uop can have after decode
+uopOpcodes = {**opcodes, **{name: fused[:3] for name, fused in fusedOpcodes.items()}}
+
+# Instructions a simple decoder handles, everything else needs a complex one (see Steering)
+simpleOpcodes = ["add", "sub", "and", "or", "load", "branch"]
 
 # Each decoder decodes one instruction and outputs ONE uop into the ROB.
 #   TODO: We will eventually need a slow path that inserts multiple uops from a microcode rom
 class Decoder(Elaboratable):
+    # With external set, instructions come in through inst/instValid (from Fetch).
+    # Otherwise the decoder just loops over its own dummy icache
+    #
+    # A new instruction is only taken when ready is high, otherwise the outputs are held
+    #
+    # move and zero flag idioms the renamer can handle without executing anything
+    #
+    # supported: names from opcodes this decoder recognises, all of them by default (a complex decoder).
+    # Anything else decodes like an unknown opcode, so Steering keeps those instructions away from it
 
-    def __init__(self, offset):
+    def __init__(self, offset, external=False, supported=None):
         self.offset = offset
+        self.external = external
+        self.supported = list(supported or opcodes)
         self.inst = Signal(32)
+        self.instValid = Signal()
+        self.ready = Signal(reset=1)
         self.executionUnits = Signal(6)
         self.opcode = Signal(6)
         self.regA = Signal(6)
@@ -14,6 +72,8 @@ class Decoder(Elaboratable):
         self.regOut = Signal(6)
         self.immediate = Signal(16)
         self.valid = Signal(3) # one for each reg
+        self.move = Signal()
+        self.zero = Signal()
 
         self.dummy_icache = Memory(width=5*3, depth=256, init=[
             0b000001_000010_000001,
@@ -40,20 +100,44 @@ class Decoder(Elaboratable):
 
         # Takes in 32bit opcode
 
+        if self.external:
+            sameSources = self.inst[12:18] == self.inst[6:12]
+
+            with m.If(self.ready):
+                m.d.sync += [
+                    self.opcode.eq(self.inst[18:24]),
+                    self.regA.eq(self.inst[12:18]),
+                    self.regB.eq(self.inst[6:12]),
+                    self.regOut.eq(self.inst[0:6]),
+                    self.immediate.eq(self.inst[24:32]),
+                    self.valid.eq(Mux(self.instValid, 7, 0)),
+                    self.executionUnits.eq(0), # Unknown opcodes can't execute anywhere
+                    self.move.eq(anyEqual(self.inst[18:24], moveOpcodes) & sameSources),
+                    self.zero.eq(anyEqual(self.inst[18:24], zeroOpcodes) & sameSources),
+                ]
+
+                with m.Switch(self.inst[18:24]):
+                    for opcode, executionUnits, _ in (opcodes[name] for name in self.supported):
+                        with m.Case(opcode):
+                            m.d.sync += self.executionUnits.eq(executionUnits)
+
+            return m
+
         counter = Signal(8, reset=self.offset)
 
-        m.d.sync += [
-            # Just continually output dummy instructions from icache
-            self.executionUnits.eq(Const(7)), # Can execute on execution units 1, 2 or 3
-            self.opcode.eq(Const(13)), # random opcode. Might mean add
-            self.regA.eq(self.dummy_icache[counter][12:17]),
-            self.regB.eq(self.dummy_icache[counter][6:11]),
-            self.regOut.eq(self.dummy_icache[counter][0:5]),
-            self.immediate.eq(Const(0)), # unused
-            self.valid.eq(Const(7)),
-
-            counter.eq(counter + 1)
-        ]
+        with m.If(self.ready):
+            m.d.sync += [
+                # Just continually output dummy instructions from icache
+                self.executionUnits.eq(opcodes["add"][1]), # Can execute on execution units 1, 2 or 3
+                self.opcode.eq(opcodes["add"][0]),
+                self.regA.eq(self.dummy_icache[counter][12:17]),
+                self.regB.eq(self.dummy_icache[counter][6:11]),
+                self.regOut.eq(self.dummy_icache[counter][0:5]),
+                self.immediate.eq(Const(0)), # unused
+                self.valid.eq(Const(7)),
+
+                counter.eq(counter + 1)
+            ]
 
         # Outputs:
         #   * Which execution unit(s) can execute this
@@ -63,4 +147,131 @@ class Decoder(Elaboratable):
         #   * Immediate
         #   * If uop might cause a rollback
 
-        return m
\ No newline at end of file
+        return m
+
+class Steering(Elaboratable):
+    # Sits between fetch and the decoders when only some decode slots have complex decoders.
+    #   Impl.ComplexDecoders: how many slots, from slot 0, can decode everything (and would start microcode
+    #   sequences, once there are any). The rest only decode simpleOpcodes (or Impl.SimpleOpcodes).
+    #   All of them by default
+    #
+    # Instructions stay in order, the Nth of a fetched group going to slot N. The group is split before the first
+    # instruction its slot can't decode: the ones before it are decoded this cycle, and taken tells fetch where
+    # to start the next group, which brings that instruction round to slot 0.
+
+    def __init__(self, Impl, decoders):
+        self.decoders = decoders
+
+        # inputs
+        self.inst = [Signal(32, name=f"steer_{i}_inst") for i in range(len(decoders))]
+        self.instValid = [Signal(name=f"steer_{i}_valid") for i in range(len(decoders))]
+
+        # outputs
+        self.taken = Signal(range(len(decoders) + 1)) # Instructions of the group going into decode
+        self.split = Signal() # Some of a valid group was left for the next cycle
+
+    def elaborate(self, platform):
+        m = Module()
+
+        fits = Const(1)
+        takes = []
+        for i, (decoder, inst, valid) in enumerate(zip(self.decoders, self.inst, self.instValid)):
+            if set(decoder.supported) != set(opcodes):
+                fits = fits & anyEqual(inst[18:24], [opcodes[name][0] for name in decoder.supported])
+            take = Signal(name=f"steer_{i}_take")
+            m.d.comb += [
+                take.eq(valid & fits),
+                decoder.inst.eq(inst),
+                decoder.instValid.eq(take),
+            ]
+            takes += [take]
+
+        m.d.comb += [
+            self.taken.eq(popcount(takes)),
+            self.split.eq(self.instValid[0] & ~takes[-1]),
+        ]
+
+        return m
+
+
+class DecodedUop:
+    # The decoder outputs the renamer uses. fused is set when Fusion merged two instructions into it
+    def __init__(self, decoder, name):
+        self.regA = Signal.like(decoder.regA, name=f"{name}_regA")
+        self.regB = Signal.like(decoder.regB, name=f"{name}_regB")
+        self.regOut = Signal.like(decoder.regOut, name=f"{name}_regOut")
+        self.opcode = Signal.like(decoder.opcode, name=f"{name}_opcode")
+        self.executionUnits = Signal.like(decoder.executionUnits, name=f"{name}_executionUnits")
+        self.valid = Signal(name=f"{name}_valid")
+        self.move = Signal(name=f"{name}_move")
+        self.zero = Signal(name=f"{name}_zero")
+        self.fused = Signal(name=f"{name}_fused")
+
+    def fields(self):
+        return [self.regA, self.regB, self.regOut, self.opcode, self.executionUnits, self.valid, self.move, self.zero, self.fused]
+
+
+class Fusion(Elaboratable):
+    # Sits between the decoders and rename, and fuses adjacent pairs of instructions into one
+    # uop, which then only takes one rename, scheduler and execution slot.
+    #
+    # The second instruction has to read and overwrite the first one's result, and take its
+    # other source from the first one's sources (or the result again). The fused uop then still
+    # has two sources and one destination, and nothing else can see the intermediate value.
+    # Pairs are matched greedily from slot 0 within a decode group, the second slot of a pair is left empty.
+    #   Impl.FusionRules: names from fusedOpcodes to enable, all of them by default. [] turns fusion off
+
+    def __init__(self, Impl, decoders):
+        self.decoders = decoders
+        self.rules = [fusedOpcodes[name] for name in getattr(Impl, "FusionRules", fusedOpcodes)]
+
+        # outputs
+        self.uops = [DecodedUop(decoder, f"fused{i}") for i, decoder in enumerate(decoders)]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        pairs = []
+        for i, (first, second) in enumerate(zip(self.decoders, self.decoders[1:])):
+            pair = Signal(name=f"fuse_{i}_{i + 1}")
+            opcode = Signal.like(first.opcode, name=f"fuse_{i}_opcode")
+            executionUnits = Signal.like(first.executionUnits, name=f"fuse_{i}_executionUnits")
+
+            dependent = (second.regOut == first.regOut) & (second.regA == first.regOut) & \
+                anyEqual(second.regB, [first.regOut, first.regA, first.regB])
+            eligible = first.valid[2] & second.valid[2] & ~first.move & ~first.zero & dependent
+
+            matches = [(first.opcode == opcodes[firstName][0]) & (second.opcode == opcodes[secondName][0])
+                       for _, _, _, firstName, secondName in self.rules]
+            m.d.comb += [
+                pair.eq(eligible & treeOR(matches)),
+                opcode.eq(treeOR(Mux(match, rule[0], 0) for match, rule in zip(matches, self.rules))),
+                executionUnits.eq(treeOR(Mux(match, rule[1], 0) for match, rule in zip(matches, self.rules))),
+            ]
+            pairs += [(pair, opcode, executionUnits)]
+
+        consumed = Const(0) # Second half of the pair before
+        for i, (decoder, uop) in enumerate(zip(self.decoders, self.uops)):
+            m.d.comb += [
+                uop.regA.eq(decoder.regA),
+                uop.regB.eq(decoder.regB),
+                uop.regOut.eq(decoder.regOut),
+                uop.opcode.eq(decoder.opcode),
+                uop.executionUnits.eq(decoder.executionUnits),
+                # All uops must write to a renaming reg to be valid
+                uop.valid.eq(decoder.valid[2] & ~consumed),
+                uop.move.eq(decoder.move),
+                uop.zero.eq(decoder.zero),
+            ]
+
+            if i < len(pairs):
+                pair, opcode, executionUnits = pairs[i]
+                with m.If(pair & ~consumed):
+                    m.d.comb += [
+                        uop.opcode.eq(opcode),
+                        uop.executionUnits.eq(executionUnits),
+                        uop.fused.eq(1),
+                    ]
+                consumed = pair & ~consumed
+
+        return m
@@ -0,0 +1,366 @@
+import os
+import sys
+from bisect import insort
+from math import ceil, log2
+
+from nmigen import *
+from nmigen.hdl.ast import Operator, Slice, Part, Cat, Repl, ArrayProxy, UserValue, Assign, Switch, SignalDict
+from nmigen.hdl.ir import Fragment, Instance
+
+# Static estimate of combinational depth for an elaborated design.
+#
+# This walks the nmigen fragment tree (before any yosys pass), builds a signal level
+# dependency graph out of every comb assignment and then works out the arrival time
+# of every comb signal and every register input in LUT levels. It's a crude model, but it
+# is good enough to spot linear chains (mux chains, accumulation chains) long before
+# we wait hours for Quartus to tell us the same thing.
+#
+# The model works on whole signals, not bits, so anything that assigns to slices of a
+# signal from multiple sources will look as slow as the slowest slice.
+
+def _log2(n):
+    return ceil(log2(n)) if n > 1 else 0
+
+LUT_INPUTS = 6
+
+# Depth is counted in LUT6 levels. Expressions are tracked as "cones": (base, fanin) where
+# base is the number of LUT levels already completed underneath and fanin is the number of
+# inputs used so far by the LUT that is still being filled. Registers and inputs are plain
+# wires (0, 0). This roughly mimics what the synthesis tools do when they pack logic into
+# LUTs, so a chain of small operations costs less than one level per operation, but a
+# long chain still costs a lot more than a balanced tree.
+
+def _depth(cone):
+    base, fanin = cone
+    return base + (1 if fanin else 0)
+
+def _close(cone):
+    return (_depth(cone), 0)
+
+def _pack(inputs):
+    # Combine inputs (each (cone, critical) or None for constants) into a single LUT cone,
+    # closing input cones or building a tree when they don't fit into one LUT
+    inputs = [i for i in inputs if i is not None]
+    if not inputs:
+        return None
+
+    critical = max(inputs, key=lambda i: _depth(i[0]))[1]
+    cones = [cone for cone, _ in inputs]
+
+    def fanin(cone):
+        return max(cone[1], 1)
+
+    while sum(fanin(c) for c in cones) > LUT_INPUTS:
+        openCones = [i for i, c in enumerate(cones) if c[1] > 0]
+        if not openCones:
+            break
+        # Close whichever cone costs the least depth to close
+        i = min(openCones, key=lambda i: (_depth(cones[i]), -cones[i][1]))
+        cones[i] = _close(cones[i])
+
+    if sum(fanin(c) for c in cones) <= LUT_INPUTS:
+        return ((max(c[0] for c in cones), sum(fanin(c) for c in cones)), critical)
+
+    # Too many inputs for a single LUT, reduce them as a tree, earliest arrivals first
+    arrivals = sorted(c[0] for c in cones)
+    while len(arrivals) > LUT_INPUTS:
+        group, arrivals = arrivals[:LUT_INPUTS], arrivals[LUT_INPUTS:]
+        insort(arrivals, max(group) + 1)
+    return ((max(arrivals), len(arrivals)), critical)
+
+def _closed(packed, extra=0):
+    # Result of a hard block (carry chain, multiplier, LUTRAM) which can't absorb anything after it
+    if packed is None:
+        return None
+    cone, critical = packed
+    return ((_depth(cone) + extra, 0), critical)
+
+def _opLuts(op, widths):
+    # Estimated number of LUT6s for a single operator
+    w = max(widths) if widths else 1
+    if op in ("~", "u", "s"):
+        return 0
+    if op in ("&", "|", "^"):
+        return ceil(w / 2)
+    if op == "m":
+        return w
+    if op in ("==", "!="):
+        n = ceil(w / 3)
+        return n + ceil((n - 1) / 5)
+    if op in ("r|", "r&", "r^", "b"):
+        return ceil((w - 1) / 5)
+    if op in ("+", "-", "<", "<=", ">", ">="):
+        return w
+    if op in ("<<", ">>"):
+        return w * _log2(w)
+    if op == "*":
+        return w * w // 2
+    return w
+
+
+class _MemRead:
+    # Stands in for the data output of an async memory read port
+    def __init__(self, addr):
+        self.addr = addr
+
+
+class DepthAnalyzer:
+    # Usage:
+    #   analyzer = DepthAnalyzer(Renamer(Impl(), Arch()))
+    #   print("\n".join(analyzer.report()))
+
+    def __init__(self, design, platform=None, name="top"):
+        self.fragment = Fragment.get(design, platform)
+
+        self.combAssigns = SignalDict() # signal -> [(rhs, conds)]
+        self.syncAssigns = SignalDict() # signal -> [(rhs, conds)]
+        self.owner = SignalDict() # signal -> module name
+        self.luts = {} # module name -> estimated luts
+        self.modules = []
+        self.memories = set()
+        self.memoryPorts = {} # memory -> [read ports, write ports]
+
+        self._collect(self.fragment, name)
+
+        self.arrival = SignalDict() # signal -> (levels, critical predecessor, cone)
+        self.regInput = SignalDict()
+
+        oldLimit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(oldLimit, 20000))
+        try:
+            for signal in self.combAssigns:
+                self._signalArrival(signal)
+            for signal, assigns in self.syncAssigns.items():
+                cone, critical = self._assignsArrival(assigns)
+                self.regInput[signal] = (_depth(cone), critical)
+        finally:
+            sys.setrecursionlimit(oldLimit)
+
+    def _collect(self, fragment, name):
+        self.modules.append(name)
+        self.luts[name] = 0
+
+        if isinstance(fragment, Instance):
+            if "MEMID" in fragment.parameters:
+                memory = fragment.parameters["MEMID"]
+                self.memories.add(memory)
+                ports = self.memoryPorts.setdefault(memory, [0, 0])
+                ports[fragment.type == "$memwr"] += 1
+
+            # The only instances we care about are memory read ports. Async ones look like
+            # a single level of LUTRAM from address to data
+            if fragment.type == "$memrd" and not fragment.parameters["CLK_ENABLE"]:
+                addr, _ = fragment.named_ports["ADDR"]
+                data, _ = fragment.named_ports["DATA"]
+                self.combAssigns.setdefault(data, []).append((_MemRead(addr), []))
+                self.owner[data] = name
+            return
+
+        comb = SignalDict()
+        for domain, signal in fragment.iter_drivers():
+            comb[signal] = domain is None
+            self.owner[signal] = name
+
+        def walk(stmts, conds):
+            for stmt in stmts:
+                if isinstance(stmt, Assign):
+                    self.luts[name] += self._exprLuts(stmt.rhs) + len(conds) * len(stmt.lhs)
+                    for signal in stmt.lhs._lhs_signals():
+                        assigns = self.combAssigns if comb.get(signal, True) else self.syncAssigns
+                        assigns.setdefault(signal, []).append((stmt.rhs, conds))
+                elif isinstance(stmt, Switch):
+                    self.luts[name] += self._exprLuts(stmt.test)
+                    for stmts in stmt.cases.values():
+                        walk(stmts, conds + [stmt.test])
+
+        walk(fragment.statements, [])
+
+        for i, (subfragment, subname) in enumerate(fragment.subfragments):
+            self._collect(subfragment, f"{name}.{subname or f'U${i}'}")
+
+    def _exprLuts(self, value):
+        if isinstance(value, UserValue):
+            return self._exprLuts(value._lazy_lower())
+        if isinstance(value, Operator):
+            return _opLuts(value.operator, [len(op) for op in value.operands]) + \
+                sum(self._exprLuts(op) for op in value.operands)
+        if isinstance(value, Slice):
+            return self._exprLuts(value.value)
+        if isinstance(value, Part):
+            return value.width * _log2(len(value.value)) + self._exprLuts(value.value) + self._exprLuts(value.offset)
+        if isinstance(value, Cat):
+            return sum(self._exprLuts(part) for part in value.parts)
+        if isinstance(value, Repl):
+            return self._exprLuts(value.value)
+        if isinstance(value, ArrayProxy):
+            elems = list(value._iter_as_values())
+            return len(value) * ceil(len(elems) / 4) + sum(self._exprLuts(e) for e in elems) + self._exprLuts(value.index)
+        return 0
+
+    def _exprArrival(self, value):
+        # Returns (cone, critical signal), or None for constants
+        if isinstance(value, Const):
+            return None
+        if isinstance(value, _MemRead):
+            return _closed(self._exprArrival(value.addr), 1)
+        if isinstance(value, Signal):
+            if value in self.combAssigns:
+                return (self._signalArrival(value)[2], value)
+            return ((0, 0), value)
+        if isinstance(value, UserValue):
+            return self._exprArrival(value._lazy_lower())
+        if isinstance(value, (Slice, Repl)):
+            return self._exprArrival(value.value)
+        if isinstance(value, Cat):
+            parts = [self._exprArrival(part) for part in value.parts]
+            parts = [part for part in parts if part is not None]
+            return max(parts, key=lambda p: _depth(p[0])) if parts else None
+        if isinstance(value, Part):
+            choices = min(ceil(len(value.value) / value.stride), 2 ** len(value.offset))
+            return _pack([self._exprArrival(value.value)] * choices + [self._exprArrival(value.offset)] * len(value.offset))
+        if isinstance(value, ArrayProxy):
+            elems = [self._exprArrival(e) for e in value._iter_as_values()]
+            return _pack(elems + [self._exprArrival(value.index)] * len(value.index))
+        if isinstance(value, Operator):
+            op = value.operator
+            operands = [self._exprArrival(operand) for operand in value.operands]
+            w = max(len(operand) for operand in value.operands)
+            if op in ("~", "u", "s"):
+                return operands[0]
+            if op in ("&", "|", "^", "m"):
+                return _pack(operands)
+            if op in ("==", "!="):
+                return _pack([operand for operand, v in zip(operands, value.operands) for _ in range(len(v))])
+            if op in ("r|", "r&", "r^", "b"):
+                return _pack(operands * w)
+            if op in ("<<", ">>"):
+                if operands[1] is None:
+                    return operands[0] # Constant shifts are just wiring
+                amount = len(value.operands[1])
+                return _pack([operands[0]] * min(w, 2 ** amount) + [operands[1]] * amount)
+            if op in ("+", "-", "<", "<=", ">", ">="):
+                # Dedicated carry chains, fast but they can't be merged into following logic
+                return _closed(_pack(operands), w // 16)
+            if op == "*":
+                return _closed(_pack(operands), _log2(w) + 1)
+            return _closed(_pack(operands), w)
+        return None
+
+    def _assignsArrival(self, assigns):
+        best = None
+        for rhs, conds in assigns:
+            arrival = self._exprArrival(rhs)
+            # Each enclosing If/Switch adds a mux in front of the destination
+            for cond in reversed(conds):
+                test = self._exprArrival(cond)
+                arrival = _pack([arrival, ((0, 0), None)] + [test] * min(len(cond), LUT_INPUTS))
+            if arrival is not None and (best is None or _depth(arrival[0]) > _depth(best[0])):
+                best = arrival
+        return best or ((0, 0), None)
+
+    def _signalArrival(self, signal):
+        if signal in self.arrival:
+            return self.arrival[signal]
+        # Break combinational loops (or false loops due to whole-signal granularity)
+        self.arrival[signal] = (0, None, (0, 0))
+        cone, critical = self._assignsArrival(self.combAssigns[signal])
+        self.arrival[signal] = (_depth(cone), critical, cone)
+        return self.arrival[signal]
+
+    def path(self, signal, regInput=False):
+        # Walk back from an endpoint along the critical predecessors
+        levels, pred = self.regInput[signal] if regInput else self.arrival[signal][:2]
+        names = [self.signalName(signal)]
+        seen = {id(signal)}
+        while pred is not None and id(pred) not in seen:
+            seen.add(id(pred))
+            names.append(self.signalName(pred))
+            if pred not in self.arrival:
+                break
+            pred = self.arrival[pred][1]
+        return levels, list(reversed(names))
+
+    def signalName(self, signal):
+        name = signal.name
+        if name is None:
+            # The tracer couldn't work out a name, so fall back to where it was created
+            file, line = signal.src_loc
+            name = f"$signal@{os.path.basename(file)}:{line}"
+        owner = self.owner.get(signal)
+        return f"{owner}.{name}" if owner else name
+
+    def endpoints(self, module=None):
+        # All register inputs and comb signals, worst first
+        ends = [(levels, signal, False) for signal, (levels, _, _) in self.arrival.items()]
+        ends += [(levels, signal, True) for signal, (levels, _) in self.regInput.items()]
+        if module is not None:
+            ends = [end for end in ends if self.owner.get(end[1]) == module]
+        return sorted(ends, key=lambda end: -end[0])
+
+    def moduleDepth(self, module=None):
+        ends = self.endpoints(module)
+        return ends[0][0] if ends else 0
+
+    def totalLuts(self):
+        return sum(self.luts.values())
+
+    def flops(self):
+        return sum(len(signal) for signal in self.syncAssigns)
+
+    def memoryBits(self):
+        return sum(memory.width * memory.depth for memory in self.memories)
+
+    def memoryLuts(self):
+        # LUTRAM is 64 deep with one write port, and gets a copy for each read port. With more write
+        # ports than that it ends up as flops, with write selection and a read mux for every bit
+        luts = 0
+        for memory, (reads, writes) in self.memoryPorts.items():
+            if writes <= 1:
+                luts += reads * ceil(memory.depth / 64) * memory.width
+            else:
+                luts += memory.depth * memory.width * ceil(writes / 2) + reads * memory.width * ceil(memory.depth / 4)
+        return luts
+
+    def widestMemory(self):
+        # (read ports, write ports) of the memory with the most ports
+        return max(self.memoryPorts.values(), key=sum, default=(0, 0))
+
+    def summary(self):
+        return {
+            "levels": self.moduleDepth(),
+            "luts": self.totalLuts(),
+            "flops": self.flops(),
+            "memoryBits": self.memoryBits(),
+            "memoryLuts": self.memoryLuts(),
+            "signals": len(self.owner),
+            "modules": len(self.modules),
+        }
+
+    def report(self, paths=3, modules=8):
+        lines = []
+        total = self.summary()
+        lines.append(f"{self.modules[0]}: {total['levels']} levels, ~{total['luts']} LUTs, {total['flops']} flops, "
+                     f"{total['memoryBits']} memory bits (~{total['memoryLuts']} LUTs), {total['signals']} signals, {total['modules']} modules")
+
+        for levels, signal, isReg in self.endpoints()[:paths]:
+            _, names = self.path(signal, isReg)
+            kind = "reg" if isReg else "comb"
+            lines.append(f"  {levels:3d} levels ({kind}): " + " -> ".join(names))
+
+        if modules:
+            children = []
+            for module in self.modules[1:]:
+                if module.count(".") > 1:
+                    continue # Only report direct children, they have everything else in them
+                inside = [m for m in self.modules if m == module or m.startswith(module + ".")]
+                ends = [end for end in self.endpoints() if self.owner.get(end[1]) in inside]
+                if ends:
+                    children += [(ends[0], module, sum(self.luts[m] for m in inside))]
+
+            children.sort(key=lambda child: -child[0][0])
+            for (levels, signal, isReg), module, luts in children[:modules]:
+                _, names = self.path(signal, isReg)
+                lines.append(f"  {module}: {levels} levels, ~{luts} LUTs, worst: " + " -> ".join(names[-4:]))
+
+        return lines
+
@@ -1,4 +1,5 @@
 from nmigen import *
+from decoder import uopOpcodes
 
 
 class IntegerUnit(Elaboratable):
@@ -15,3 +16,51 @@ class IntegerUnit(Elaboratable):
 
         # outputs
         self.stalled = Signal()
+
+
+class ExecutionPort(Elaboratable):
+    # Timing model of one issue port. There's no datapath yet, a uop just takes the latency
+    # from the opcode table (fused uops included) to complete.
+    #
+    # Each latency gets its own pipeline so that uops issued in different cycles can't
+    # complete on top of each other.
+    # A uop issued in cycle t with latency N completes in cycle t + N - 1 (on the clear port the
+    # scheduler sees that cycle) so a dependent uop can issue in cycle t + N.
+
+    def __init__(self, width, port):
+        self.latencies = sorted({latency for _, _, latency in uopOpcodes.values()})
+
+        # inputs from scheduler
+        self.issue = Signal(width, name=f"port{port}_issue")
+        self.issueValid = Signal(name=f"port{port}_issue_valid")
+        self.opcode = Signal(6, name=f"port{port}_opcode")
+
+        # outputs, zero when nothing completes
+        self.complete = [Signal(width, name=f"port{port}_complete_{latency}") for latency in self.latencies]
+
+        # State: stage s of each latency's pipeline holds the uop issued s + 1 cycles ago
+        self.stages = {latency: [Signal(width, name=f"port{port}_latency_{latency}_stage_{stage}") for stage in range(latency - 1)]
+                       for latency in self.latencies}
+
+    def elaborate(self, platform):
+        m = Module()
+
+        isLatency = {latency: Signal(name=f"latency_{latency}") for latency in self.latencies}
+        with m.Switch(self.opcode):
+            for opcode, _, latency in uopOpcodes.values():
+                with m.Case(opcode):
+                    m.d.comb += isLatency[latency].eq(1)
+            with m.Default():
+                m.d.comb += isLatency[self.latencies[0]].eq(1)
+
+        for latency, complete in zip(self.latencies, self.complete):
+            issued = Mux(self.issueValid & isLatency[latency], self.issue, 0)
+
+            # Shift down a pipeline of latency - 1 stages
+            for delayed in self.stages[latency]:
+                m.d.sync += delayed.eq(issued)
+                issued = delayed
+
+            m.d.comb += complete.eq(issued)
+
+        return m
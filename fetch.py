@@ -0,0 +1,73 @@
+from nmigen import *
+from nmigen.cli import main
+
+class Fetch(Elaboratable):
+    # Fetches NumDecodes instructions a cycle out of a program held in memory, looping back
+    # to the start when it runs off the end.
+    #
+    # No branches yet: the program is one big loop, redirect only comes from the uop cache
+    #
+    # redirect restarts fetch from redirectAddr, that group is fetched in the same cycle
+    #
+    # When decode only takes the first few instructions of a group (taken, see Steering),
+    # the next group starts from the first one it left
+
+    def __init__(self, Impl, program):
+        self.NumDecodes = Impl.NumDecodes
+        self.length = len(program)
+        assert self.length >= self.NumDecodes
+
+        self.mem = Memory(width=32, depth=self.length, init=program)
+
+        # inputs
+        self.ready = Signal(reset=1)
+        self.redirect = Signal()
+        self.redirectAddr = Signal(range(self.length))
+        self.taken = Signal(range(self.NumDecodes + 1), reset=self.NumDecodes)
+
+        # State
+        self.pc = Signal(range(self.length))
+
+        # outputs
+        self.inst = [Signal(32, name=f"fetched_{i}") for i in range(Impl.NumDecodes)]
+        self.valid = [Signal(name=f"fetched_{i}_valid") for i in range(Impl.NumDecodes)]
+        self.addr = Signal(range(self.length))     # Address of the fetched group
+        self.nextAddr = Signal(range(self.length)) # and of the group after it
+
+    def wrap(self, address):
+        return Mux(address >= self.length, address - self.length, address)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        nextFrom = Mux(self.valid[0], self.wrap(self.addr + self.taken), self.pc)
+        fetchFrom = Mux(self.redirect, self.redirectAddr, nextFrom)
+
+        for i, (inst, valid) in enumerate(zip(self.inst, self.valid)):
+            m.submodules[f"read_{i}"] = rport = self.mem.read_port(domain="comb")
+            m.d.comb += rport.addr.eq(self.wrap(fetchFrom + i))
+
+            # Move on to the next group once this one has been taken
+            with m.If(self.redirect | self.ready | ~valid):
+                m.d.sync += [
+                    inst.eq(rport.data),
+                    valid.eq(1),
+                ]
+
+        with m.If(self.redirect | self.ready | ~self.valid[0]):
+            m.d.sync += [
+                self.addr.eq(fetchFrom),
+                self.pc.eq(self.wrap(fetchFrom + self.NumDecodes)),
+            ]
+
+        m.d.comb += self.nextAddr.eq(nextFrom)
+
+        return m
+
+
+if __name__ == "__main__":
+    class Impl:
+        NumDecodes = 4
+
+    fetch = Fetch(Impl(), list(range(10)))
+    main(fetch, ports=[fetch.ready, fetch.redirect, fetch.redirectAddr, fetch.addr, fetch.nextAddr] + fetch.inst + fetch.valid)
@@ -1,7 +1,225 @@
 from nmigen import *
+from nmigen.lib.coding import *
 from nmigen.cli import main
-from multiMem import MultiMem
-from renamer import Renamer
+from decoder import ALU0, ALU1, ALU2, MUL, LSU, BRANCH
+from matrixScheduler import PiorityEncoder, Scoreboard
+from util import *
+
+class PortQueue(Elaboratable):
+    # The waiting uops for a single issue port.
+    # Each entry holds the renaming ID of a uop and a bit for every renaming register it's still
+    # waiting on. So it's a size x numRenamingRegisters slice rather than the full square matrix,
+    # and select only has to look at size entries.
+    #
+    # Like the matrix scheduler, select picks the lowest numbered ready slot, not the oldest
+
+    def __init__(self, size, numRegs, numInserts, width, port):
+        self.size = size
+        self.port = port
+
+        # inputs
+        self.insert = [Signal(name=f"port{port}_insert_{i}") for i in range(numInserts)]
+        self.insertTag = [Signal(width, name=f"port{port}_insert_tag_{i}") for i in range(numInserts)]
+        self.insertDeps = [Signal(numRegs, name=f"port{port}_insert_deps_{i}") for i in range(numInserts)]
+
+        self.clear_hot = Signal(numRegs, name=f"port{port}_clear_hot")
+
+        # State
+        self.valid = Signal(size, name=f"port{port}_valid")
+        self.tags = [Signal(width, name=f"port{port}_tag_{e}") for e in range(size)]
+        self.pending = [Signal(numRegs, name=f"port{port}_pending_{e}") for e in range(size)]
+
+        self.freeSlots = PiorityEncoder(size, numInserts)
+        self.selecter = PiorityEncoder(size, 1)
+
+        # outputs
+        self.occupancy = Signal(range(size + 1), name=f"port{port}_occupancy")
+        self.ready = Signal(width, name=f"port{port}_ready")
+        self.readyValid = Signal(name=f"port{port}_ready_valid")
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.freeSlots = self.freeSlots
+        m.submodules.selecter = self.selecter
+
+        m.d.comb += self.occupancy.eq(popcount(self.valid))
+
+        # Select
+        m.d.comb += self.selecter.input.eq(Cat(*[valid & (pending == 0) for valid, pending in zip(self.valid, self.pending)]))
+        selected = self.selecter.outHot[0]
+
+        m.d.comb += [
+            self.ready.eq(treeOR(Mux(selected[e], tag, 0) for e, tag in enumerate(self.tags))),
+            self.readyValid.eq(selected.any()),
+        ]
+
+        # Insert
+        # The Nth uop steered to this queue this cycle takes the Nth free slot.
+        # The IssueQueue never steers more uops here than there are free slots.
+        m.d.comb += self.freeSlots.input.eq(~self.valid)
+
+        slots = []
+        for i, insert in enumerate(self.insert):
+            slot = Signal(self.size, name=f"port{self.port}_insert_{i}_slot")
+            rank = popcount(self.insert[:i])
+            freeSlot = treeOR(Mux(rank == k, self.freeSlots.outHot[k], 0) for k in range(i + 1))
+
+            m.d.comb += slot.eq(Mux(insert, freeSlot, 0))
+            slots += [slot]
+
+        for e, (tag, pending) in enumerate(zip(self.tags, self.pending)):
+            written = treeOR(slot[e] for slot in slots)
+
+            with m.If(written):
+                m.d.sync += [
+                    tag.eq(treeOR(Mux(slot[e], insertTag, 0) for slot, insertTag in zip(slots, self.insertTag))),
+
+                    # A producer completing this cycle has already been cleared
+                    pending.eq(treeOR(Mux(slot[e], deps, 0) for slot, deps in zip(slots, self.insertDeps)) & ~self.clear_hot),
+                ]
+            with m.Else():
+                m.d.sync += pending.eq(pending & ~self.clear_hot)
+
+        m.d.sync += self.valid.eq((self.valid & ~selected) | treeOR(slots))
+
+        return m
+
 
 class IssueQueue(Elaboratable):
+    # Distributed alternative to the MatrixScheduler.
+    #
+    # There is one PortQueue per issue port. Each port can execute the uops whose executionUnits
+    # mask (from the decoder) overlaps the port's mask. At insert, each uop is steered to the least
+    # occupied queue it can execute on, also counting earlier uops in the group headed there.
+    #
+    # If a queue doesn't have room for everything steered to it, the whole group is refused
+    # (inReady low) and must be presented again next cycle.
+    #
+    # Ports are set with Impl.IssuePorts (a list of execution unit masks), queue size with
+    # Impl.IssueQueueSize
+
+    # ALUs share ports with the other units, loads get a second port
+    DefaultPorts = [ALU0 | BRANCH, ALU1 | MUL, ALU2 | LSU, LSU]
+
     def __init__(self, Impl, Arch):
+        self.width = width = Impl.numRenamingRegisters.bit_length()
+        self.NumDecodes = Impl.NumDecodes
+        self.numRegs = Impl.numRenamingRegisters
+        self.ports = getattr(Impl, "IssuePorts", self.DefaultPorts)
+        self.NumIssues = len(self.ports)
+        self.size = getattr(Impl, "IssueQueueSize", 16)
+
+        # Inputs from renamer
+        self.inA = [Signal(width, name=f"inA_{i}") for i in range(Impl.NumDecodes)]
+        self.inB = [Signal(width, name=f"inB_{i}") for i in range(Impl.NumDecodes)]
+        self.inOut = [Signal(width, name=f"inOut_{i}") for i in range(Impl.NumDecodes)]
+        self.inUnits = [Signal(6, name=f"inUnits_{i}") for i in range(Impl.NumDecodes)]
+        self.inValid = [Signal(name=f"inValid_{i}") for i in range(Impl.NumDecodes)]
+
+        # Completions, one per clear port. Defaults to one per issue port
+        self.clear_addr = [Signal(width, name=f"clear_addr_{p}") for p in range(getattr(Impl, "NumClears", self.NumIssues))]
+
+        self.queues = [PortQueue(self.size, self.numRegs, Impl.NumDecodes, width, p) for p in range(self.NumIssues)]
+
+        self.scoreboard = Scoreboard(self.numRegs)
+
+        # steer[i][p] is high if uop i goes to port p
+        self.steer = [[Signal(name=f"steer_{i}_to_{p}") for p in range(self.NumIssues)] for i in range(Impl.NumDecodes)]
+
+        # Outputs
+        self.inReady = Signal()
+        self.ready = [Signal(width, name=f"ready{p}") for p in range(self.NumIssues)]
+        self.readyValid = [Signal(name=f"ready{p}_valid") for p in range(self.NumIssues)]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        for p, queue in enumerate(self.queues):
+            m.submodules[f"queue{p}"] = queue
+        m.submodules.scoreboard = self.scoreboard
+
+        # Steering
+        # Each uop picks the least loaded port that can execute it, lowest port wins ties.
+        # Load is the queue occupancy plus the number of earlier uops in this group whose first
+        # choice (by occupancy alone) was that port. Using first choices rather than the final
+        # decisions keeps every uop's steering independent, so it doesn't chain across the group.
+        def leastLoaded(capable, load, picks):
+            for p in range(self.NumIssues):
+                beats = [~capable[q] | (load[p] < load[q] if q < p else load[p] <= load[q]) for q in range(self.NumIssues) if q != p]
+                m.d.comb += picks[p].eq(capable[p] & treeAND(beats))
+
+        firstChoice = [[Signal(name=f"first_choice_{i}_{p}") for p in range(self.NumIssues)] for i in range(self.NumDecodes)]
+        for i in range(self.NumDecodes):
+            capable = [self.inValid[i] & ((self.inUnits[i] & mask) != 0) for mask in self.ports]
+            leastLoaded(capable, [queue.occupancy for queue in self.queues], firstChoice[i])
+
+            load = [queue.occupancy + popcount(choice[p] for choice in firstChoice[:i]) for p, queue in enumerate(self.queues)]
+            leastLoaded(capable, load, self.steer[i])
+
+        # The group is only accepted if every queue has room for what was steered to it
+        fits = [popcount(steer[p] for steer in self.steer) <= self.size - queue.occupancy for p, queue in enumerate(self.queues)]
+        m.d.comb += self.inReady.eq(treeAND(fits))
+
+        # Decode sources to 1-hot dependency bits, shared by all queues
+        Inserts = []
+        for i in range(self.NumDecodes):
+            m.submodules[f"select_decoder_{i}"] = selectDecoder = Decoder(self.numRegs)
+            m.submodules[f"argA_decoder_{i}"] = argADecoder = Decoder(self.numRegs)
+            m.submodules[f"argB_decoder_{i}"] = argBDecoder = Decoder(self.numRegs)
+
+            deps = Signal(self.numRegs, name=f"deps_{i}")
+            m.d.comb += [
+                selectDecoder.i.eq(self.inOut[i]),
+                argADecoder.i.eq(self.inA[i]),
+                argBDecoder.i.eq(self.inB[i]),
+
+                # Only wait on producers which haven't completed yet (zero is NULL and always ready)
+                deps.eq((argADecoder.o | argBDecoder.o) & ~self.scoreboard.ready),
+            ]
+            Inserts += [Mux(self.inValid[i] & self.inReady, selectDecoder.o, 0)]
+
+            for p, queue in enumerate(self.queues):
+                m.d.comb += [
+                    queue.insert[i].eq(self.steer[i][p] & self.inReady),
+                    queue.insertTag[i].eq(self.inOut[i]),
+                    queue.insertDeps[i].eq(deps),
+                ]
+
+        # Completions wake up every queue
+        Clears = []
+        for p, clear_addr in enumerate(self.clear_addr):
+            m.submodules[f"clear_decoder_{p}"] = clearDecoder = Decoder(self.numRegs)
+            m.d.comb += clearDecoder.i.eq(clear_addr)
+            Clears += [clearDecoder.o]
+
+        m.d.comb += [
+            self.scoreboard.clear_hot.eq(treeOR(Clears)),
+            self.scoreboard.insert_hot.eq(treeOR(Inserts)),
+        ]
+
+        for p, queue in enumerate(self.queues):
+            m.d.comb += [
+                queue.clear_hot.eq(self.scoreboard.clear_hot),
+                self.ready[p].eq(queue.ready),
+                self.readyValid[p].eq(queue.readyValid),
+            ]
+
+        return m
+
+
+if __name__ == "__main__":
+    from bench import makeImpl, Arch
+    from traceSim import mixedTrace, runScheduler
+
+    impl = makeImpl(registers=64, IssueQueueSize=8)
+    trace = mixedTrace(200)
+    stats = runScheduler(IssueQueue(impl, Arch()), impl, trace)
+    print(f"{stats['uops']} uops in {stats['cycles']} cycles, IPC {stats['ipc']:.2f}")
+
+    queue = IssueQueue(impl, Arch())
+    ports = queue.ready + queue.readyValid + queue.clear_addr + [queue.inReady]
+    for inOut, inA, inB, inUnits, inValid in zip(queue.inOut, queue.inA, queue.inB, queue.inUnits, queue.inValid):
+        ports += [inOut, inA, inB, inUnits, inValid]
+
+    main(queue, ports=ports)
@@ -1,20 +1,30 @@
+import sys
+
 from nmigen import *
 from nmigen.lib.coding import *
 from nmigen.cli import main
 from multiMem import MultiMem
 from util import *
 
+def columnFanout(rows):
+    # (any, many) for each column: at least one, and at least two, of rows have it set
+    def combine(a, b):
+        return (a[0] | b[0], a[1] | b[1] | (a[0] & b[0]))
+    return treeReduce(combine, [(row, Const(0)) for row in rows])
+
 class MatrixRow(Elaboratable):
-    def __init__(self, num_values, num_sets, row_id):
+    def __init__(self, num_values, num_sets, row_id, replay=False):
         self.num_values = num_values
         self.num_sets = num_sets
         self.id = row_id
+        self.replay = replay
 
         # inputs
         self.row_selects  = [Signal(name=f"row_select_{i}") for i in range(num_sets)]
         self.row_sets = [Signal(num_values) for j in range(num_sets)]
 
         self.clears = Signal(num_values, name=f"col_clear")
+        self.squash = Signal(name=f"row_{row_id}_squash")
 
         # State
         self.values = Signal(num_values, name=f"row_{row_id}_values") # Value of each matrix cell
@@ -25,25 +35,46 @@ class MatrixRow(Elaboratable):
         # outputs
         self.all_clear = Signal(name=f"row_{row_id}_all_clear")
 
+        if replay:
+            # Every producer this row was inserted with, even ones that had already (speculatively) cleared.
+            # Cancelling one of them sets its bit again
+            self.row_sources = [Signal(num_values) for j in range(num_sets)]
+            self.cancels = Signal(num_values, name=f"col_cancel")
+            self.retires = Signal(num_values, name=f"col_retire") # Can't be cancelled any more, and the ID might be reused
+            self.live = Signal(name=f"row_{row_id}_live") # Still waiting or issued but unconfirmed
+
+            self.sources = Signal(num_values, name=f"row_{row_id}_sources")
+
+            self.victim = Signal(name=f"row_{row_id}_victim")
+
     def elaborate(self, platform):
         m = Module()
 
         # Mask and combine all row selects so we have a single row_set that's only
         # relevant  to this row
-        this_row_set = Const(0)
-        for i in range(self.num_sets):
-            masked_row_set = Signal(self.num_values, name=f"select_{i}_masked")
-            this_row_set_acc = Signal(self.num_values, name=f"this_row_set_acc_{i}")
+        this_row_set = Signal(self.num_values, name="this_row_set")
+        m.d.comb += this_row_set.eq(treeOR(Mux(row_select, row_set, 0) for row_select, row_set in zip(self.row_selects, self.row_sets)))
 
-            m.d.comb += [
-                masked_row_set.eq(Mux(self.row_selects[i], self.row_sets[i], 0)),
-                this_row_set_acc.eq(this_row_set | masked_row_set)
-            ]
+        # Update all cells in the row
+        updated = ((this_row_set | self.values) & ~self.clears) & self.permanent_mask
+
+        if self.replay:
+            this_row_sources = Signal(self.num_values, name="this_row_sources")
+            m.d.comb += this_row_sources.eq(treeOR(Mux(row_select, row_sources, 0) for row_select, row_sources in zip(self.row_selects, self.row_sources)))
+            with m.If(treeOR(self.row_selects)):
+                m.d.sync += self.sources.eq(this_row_sources & self.permanent_mask)
+            with m.Else():
+                m.d.sync += self.sources.eq(self.sources & ~self.retires)
 
-            this_row_set = this_row_set_acc
+            # A cancel wins over a clear of the same producer in the same cycle
+            cancelled = self.sources & self.cancels
+            m.d.comb += self.victim.eq(self.live & (cancelled != 0))
+            updated = updated | Mux(self.live, cancelled, 0)
 
-        # Update all cells in the row
-        m.d.sync += self.values.eq(((this_row_set | self.values) & ~self.clears) & self.permanent_mask)
+        with m.If(self.squash):
+            m.d.sync += self.values.eq(0)
+        with m.Else():
+            m.d.sync += self.values.eq(updated)
 
         # Check if whole row is clear
         m.d.comb += self.all_clear.eq(self.values == 0)
@@ -60,9 +91,11 @@ class Matrix(Elaboratable):
     #   The main downside to this optimization is if we only need half of a pair in one cycle
     #   the other half is unusable until both are freed
 
-    def __init__(self, size, num_sets):
+    def __init__(self, size, num_sets, replay=False, fanout=False):
         self.size = size
         self.num_sets = num_sets
+        self.replay = replay
+        self.fanout = fanout
         addr_width = (size-1).bit_length()
 
         # set ports
@@ -71,11 +104,25 @@ class Matrix(Elaboratable):
 
         # clear ports
         self.clear_hot = Signal(size, name=f"clear_data")
+        self.flush_hot = Signal(size, name=f"flush_data") # Squashes both the row and the column
 
         # outputs
         self.is_clear = Signal(size)
 
-        self.rows = [MatrixRow(size, num_sets, i) for i in range(1, size)]
+        if replay:
+            self.source_data = [Signal(size, name=f"source_data_{i}") for i in range(num_sets)]
+            self.cancel_hot = Signal(size, name=f"cancel_data") # Sets the column again in every live row that depends on it
+            self.retire_hot = Signal(size, name=f"retire_data") # Drops the column from every row's sources
+            self.live_hot = Signal(size, name=f"live_data")
+
+            self.victims = Signal(size) # Live rows that depend on a cancelled column
+
+        if fanout:
+            # Columns with at least one, and at least two, rows still waiting on them
+            self.has_consumer = Signal(size)
+            self.many_consumers = Signal(size)
+
+        self.rows = [MatrixRow(size, num_sets, i, replay) for i in range(1, size)]
 
     def elaborate(self, platform):
         m = Module()
@@ -93,7 +140,20 @@ class Matrix(Elaboratable):
                 m.d.comb += row_set.eq(Cat(*src_set))
 
             # Distribute the clear signals
-            m.d.comb += row.clears.eq(self.clear_hot)
+            m.d.comb += [
+                row.clears.eq(self.clear_hot | self.flush_hot),
+                row.squash.eq(self.flush_hot[row.id]),
+            ]
+
+            if self.replay:
+                for row_sources, src_sources in zip(row.row_sources, self.source_data):
+                    m.d.comb += row_sources.eq(src_sources)
+                m.d.comb += [
+                    row.cancels.eq(self.cancel_hot),
+                    row.retires.eq(self.retire_hot),
+                    row.live.eq(self.live_hot[row.id]),
+                    self.victims[row.id].eq(row.victim),
+                ]
 
             # Collect all_clear signals
             m.d.comb += self.is_clear[row.id].eq(row.all_clear)
@@ -101,6 +161,104 @@ class Matrix(Elaboratable):
         # row zero is hardwired to clear
         m.d.comb += self.is_clear[0].eq(1)
 
+        if self.fanout:
+            consumer, many = columnFanout(row.values for row in self.rows)
+            m.d.comb += [
+                self.has_consumer.eq(consumer),
+                self.many_consumers.eq(many),
+            ]
+
+        return m
+
+class FlatMatrix(Elaboratable):
+    # Same ports and cycle behaviour as Matrix, but all the cells live in one size * size wide signal
+    # (row r is bits r*size to (r+1)*size) and are updated with a few wide operations in a single module,
+    # instead of a MatrixRow submodule per renaming register. Much quicker to elaborate and simulate.
+    #
+    # Row zero is never set, so it reads as clear just like the missing row in Matrix
+
+    def __init__(self, size, num_sets, replay=False, fanout=False):
+        self.size = size
+        self.num_sets = num_sets
+        self.replay = replay
+        self.fanout = fanout
+
+        # pysim writes masks out as decimal, and past ~120 entries they have more digits than python allows by default
+        if hasattr(sys, "get_int_max_str_digits") and 0 < sys.get_int_max_str_digits() < size * size:
+            sys.set_int_max_str_digits(size * size)
+
+        # set ports
+        self.row_selects = [Signal(size, name=f"row_selects_{i}") for i in range(num_sets)]
+        self.row_data = [Signal(size, name=f"row_data_{i}") for i in range(num_sets)]
+
+        # clear ports
+        self.clear_hot = Signal(size, name=f"clear_data")
+        self.flush_hot = Signal(size, name=f"flush_data") # Squashes both the row and the column
+
+        # State
+        self.values = Signal(size * size, name="values")
+
+        # Constants
+        self.permanent_mask = Const(sum(~(1 | 1 << r) % (1 << size) << r * size for r in range(1, size)), size * size)
+
+        # outputs
+        self.is_clear = Signal(size)
+
+        if replay:
+            self.source_data = [Signal(size, name=f"source_data_{i}") for i in range(num_sets)]
+            self.cancel_hot = Signal(size, name=f"cancel_data")
+            self.retire_hot = Signal(size, name=f"retire_data")
+            self.live_hot = Signal(size, name=f"live_data")
+
+            self.sources = Signal(size * size, name="sources")
+
+            self.victims = Signal(size)
+
+        if fanout:
+            self.has_consumer = Signal(size)
+            self.many_consumers = Signal(size)
+
+    def row(self, value, r):
+        return value[r * self.size:(r + 1) * self.size]
+
+    def spread(self, hot):
+        # Every bit of hot repeated across its whole row
+        return Cat(*[Repl(hot[r], self.size) for r in range(self.size)])
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Each set port's data lands on the rows it selects
+        row_set = Signal(self.size * self.size)
+        m.d.comb += row_set.eq(treeOR(Repl(data, self.size) & self.spread(selects) for selects, data in zip(self.row_selects, self.row_data)))
+
+        clears = self.clear_hot | self.flush_hot
+        updated = ((row_set | self.values) & ~Repl(clears, self.size)) & self.permanent_mask
+
+        if self.replay:
+            selected = self.spread(treeOR(self.row_selects))
+            row_sources = treeOR(Repl(data, self.size) & self.spread(selects) for selects, data in zip(self.row_selects, self.source_data))
+            m.d.sync += self.sources.eq(((row_sources & selected) | (self.sources & ~Repl(self.retire_hot, self.size) & ~selected)) & self.permanent_mask)
+
+            # A cancel wins over a clear of the same producer in the same cycle
+            cancelled = Signal(self.size * self.size)
+            m.d.comb += [
+                cancelled.eq(self.sources & Repl(self.cancel_hot, self.size)),
+                self.victims.eq(self.live_hot & Cat(*[self.row(cancelled, r) != 0 for r in range(self.size)])),
+            ]
+            updated = updated | (cancelled & self.spread(self.live_hot))
+
+        m.d.sync += self.values.eq(updated & ~self.spread(self.flush_hot))
+
+        m.d.comb += self.is_clear.eq(Cat(*[self.row(self.values, r) == 0 for r in range(self.size)]))
+
+        if self.fanout:
+            consumer, many = columnFanout(self.row(self.values, r) for r in range(1, self.size))
+            m.d.comb += [
+                self.has_consumer.eq(consumer),
+                self.many_consumers.eq(many),
+            ]
+
         return m
 
 class PiorityEncoder(Elaboratable):
@@ -131,25 +289,87 @@ class PiorityEncoder(Elaboratable):
     def elaborate(self, platform):
         m = Module()
 
-        negated = Signal(self.size)
-
-        # FPGAs have dedicated carry propagation chains in their adders which we can take
-        # advantage of to quickly find the first bit
-        m.d.comb += negated.eq(~self.input + 1)
-
-        prevInput = self.input
-        prevNegated = negated
+        remaining = self.input
 
-        for outHot in self.outHot:
-            nextInput = Signal(prevInput.width - 1)
-            nextNegated = Signal(prevNegated.width - 1)
+        for i, outHot in enumerate(self.outHot):
+            negated = Signal(self.size, name=f"negated_{i}")
 
+            # FPGAs have dedicated carry propagation chains in their adders which we can take
+            # advantage of to quickly find the first bit
             m.d.comb += [
-                outHot.eq(prevNegated & prevInput),
-                nextNegated.eq((prevNegated + outHot) >> 2),
-                nextInput.eq(prevInput >> 1)
+                negated.eq(~remaining + 1),
+                outHot.eq(negated & remaining),
             ]
-            (prevInput, prevNegated) = (nextInput, nextNegated)
+
+            # Then knock that bit out before looking for the next one
+            remaining = remaining & ~outHot
+
+        return m
+
+
+class CriticalSelect(Elaboratable):
+    # Same ports as a PiorityEncoder, plus a list of priority classes (masks over the inputs).
+    # Every input in the first class is picked before any in the second, and so on, with inputs
+    # in no class last. Within a class it's by position, like PiorityEncoder.
+    #
+    # It's one PiorityEncoder over the classes laid end to end, so the carry chain is
+    # (num_classes + 1) times as long
+
+    def __init__(self, size, num_outs, num_classes):
+        self.size = size
+        self.num_outs = num_outs
+
+        self.input = Signal(size)
+        self.classes = [Signal(size, name=f"class_{c}") for c in range(num_classes)]
+
+        self.encoder = PiorityEncoder(size * (num_classes + 1), num_outs)
+
+        self.outHot = [Signal(size, name=f"Selected_1hot_{i}") for i in range(num_outs)]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.encoder = self.encoder
+
+        masks = []
+        classified = Const(0, self.size)
+        for cls in self.classes + [Const(-1, self.size)]:
+            masks += [self.input & cls & ~classified]
+            classified = classified | cls
+        m.d.comb += self.encoder.input.eq(Cat(*masks))
+
+        for outHot, encoded in zip(self.outHot, self.encoder.outHot):
+            m.d.comb += outHot.eq(treeOR(encoded[c * self.size:(c + 1) * self.size] for c in range(len(masks))))
+
+        return m
+
+
+class Scoreboard(Elaboratable):
+    # One bit per renaming register, high once the uop writing it has completed.
+    # Schedulers check it at insert so that only producers still in flight set dependency bits,
+    # otherwise a consumer of a long finished value would wait for a clear that never comes.
+
+    def __init__(self, size):
+        # inputs
+        self.clear_hot = Signal(size, name="scoreboard_clear")    # Completing this cycle
+        self.insert_hot = Signal(size, name="scoreboard_insert")  # Allocated to new uops this cycle
+        self.flush_hot = Signal(size, name="scoreboard_flush")    # Squashed, nothing will ever complete them
+        self.cancel_hot = Signal(size, name="scoreboard_cancel")  # Woken speculatively, but the data wasn't there
+
+        # State
+        self.completed = Signal(size, reset=(1 << size) - 1) # Nothing is in flight at reset
+
+        # outputs
+        self.ready = Signal(size, name="scoreboard_ready")
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Producers completing this cycle are bypassed straight through.
+        # Registers allocated this cycle are in flight, no matter how long ago the last uop
+        # to use that register completed
+        m.d.comb += self.ready.eq((self.completed | self.clear_hot) & ~self.insert_hot & ~self.cancel_hot)
+        m.d.sync += self.completed.eq(self.ready | self.flush_hot)
 
         return m
 
@@ -175,12 +395,55 @@ class MatrixScheduler(Elaboratable):
         self.inOut = [Signal(width, name=f"inOut_{i}") for i in range(Impl.NumDecodes)]
         self.inValid = [Signal(name=f"inValid_{i}") for i in range(Impl.NumDecodes)]
 
-        self.clear_addr = [Signal(width) for i in range(Impl.NumDecodes)]
-
-        # wakeup matrix
-        self.matrix = Matrix(Impl.numRenamingRegisters, Impl.NumDecodes)
-
-        self.selecter = PiorityEncoder(self.matrix.size, self.NumIssues)
+        # Completions, one per clear port. Defaults to one per issue
+        self.clear_addr = [Signal(width) for i in range(getattr(Impl, "NumClears", Impl.NumIssues))]
+
+        # Squashes every uop in the set (one-hot for a single uop, or a whole age mask) in one cycle.
+        # IDs aren't handed out in age order, so whoever tracks age (the ROB) builds the mask.
+        # Squashed uops can't be selected in the flush cycle, and inserts that cycle are squashed too if they're in the set
+        self.flush_hot = Signal(self.NumQueueEntries)
+
+        # Replay, for wakeups sent speculatively (a load assumed to hit) that can turn out wrong.
+        # Issued uops are kept until they are confirmed executed on good data. Cancelling a producer
+        # sets its dependency bit again in every live uop that reads it, and any that already issued
+        # go back to waiting. Those show up on replay_hot so execution can drop them, and their own
+        # wakeups are cancelled the cycle after. The real wakeup is just another clear.
+        self.replay = getattr(Impl, "Replay", False)
+        if self.replay:
+            self.cancel_addr = [Signal(width, name=f"cancel_addr_{i}") for i in range(getattr(Impl, "NumCancels", 1))]
+            self.confirm_addr = [Signal(width, name=f"confirm_addr_{i}") for i in range(len(self.clear_addr))]
+
+            # Selected but not confirmed yet
+            self.issued = Signal(self.NumQueueEntries)
+
+            # Issued uops sent back to waiting this cycle
+            self.replay_hot = Signal(self.NumQueueEntries)
+
+            # Wakeups from last cycle's replayed uops, cancelled this cycle
+            self.cascade_hot = Signal(self.NumQueueEntries)
+
+        # Select, Impl.Select:
+        #   "position": the lowest numbered ready uops
+        #   "fanout": ready uops with two or more waiting consumers first, then ones with one, then the rest.
+        #   The consumer counts come straight out of the matrix columns. A uop that has waited
+        #   Impl.SelectAgeLimit cycles since insert goes ahead of all of them, so the lower the limit the more
+        #   select is by age instead (0, the default, for no limit: an age limit adds a third priority level to select)
+        self.criticality = getattr(Impl, "Select", "position") == "fanout"
+        self.ageLimit = getattr(Impl, "SelectAgeLimit", 0) if self.criticality else 0
+
+        # wakeup matrix. Impl.FlatMatrix builds it as one wide vector instead of a submodule per row
+        matrix = FlatMatrix if getattr(Impl, "FlatMatrix", False) else Matrix
+        self.matrix = matrix(Impl.numRenamingRegisters, Impl.NumDecodes, self.replay, self.criticality)
+
+        if self.criticality:
+            self.selecter = CriticalSelect(self.matrix.size, self.NumIssues, 3 if self.ageLimit else 2)
+            if self.ageLimit:
+                # Cycles since insert, up to the limit
+                self.waited = [Signal(range(self.ageLimit + 1), name=f"waited_{e}") for e in range(self.NumQueueEntries)]
+        else:
+            self.selecter = PiorityEncoder(self.matrix.size, self.NumIssues)
+
+        self.scoreboard = Scoreboard(self.NumQueueEntries)
 
         # Tracks which instructions in the matrix would be elegable for select if all their dependences are met
         self.waiting_for_select = Signal(self.NumQueueEntries)
@@ -193,12 +456,17 @@ class MatrixScheduler(Elaboratable):
         self.readyHot = [Signal(self.NumQueueEntries, name=f"ready_hot{i}") for i in range(Impl.NumDecodes)]
         self.readyValid = [Signal(width, name=f"ready{i}_valid") for i in range(Impl.NumDecodes)]
 
+        # There is an entry for every renaming register, so it can always take the next group
+        self.inReady = Signal(reset=1)
+
 
     def elaborate(self, platform):
         m = Module()
 
         m.submodules["bit_matrix"] = self.matrix
+        m.submodules.scoreboard = self.scoreboard
         all_row_selects = []
+        all_sources = []
 
         # Decode inputs to 1-hot and pass into the matrix
         for i in range(self.NumDecodes):
@@ -211,8 +479,10 @@ class MatrixScheduler(Elaboratable):
                 argADecoder.i.eq(self.inA[i]),
                 argBDecoder.i.eq(self.inB[i]),
 
-                self.matrix.row_data[i].eq(argADecoder.o | argBDecoder.o),
+                # Only wait on producers which haven't completed yet
+                self.matrix.row_data[i].eq((argADecoder.o | argBDecoder.o) & ~self.scoreboard.ready),
             ]
+            all_sources += [argADecoder.o | argBDecoder.o]
 
             with m.If(self.inValid[i]):
                 m.d.comb += self.matrix.row_selects[i].eq(selectDecoder.o)
@@ -223,34 +493,106 @@ class MatrixScheduler(Elaboratable):
 
 
         Clears = []
-        for i in range(self.NumIssues):
+        for i, clear_addr in enumerate(self.clear_addr):
             m.submodules[f"clear_decoder_{i}"] = clearDecoder = Decoder(self.NumQueueEntries)
 
-            m.d.comb += clearDecoder.i.eq(self.clear_addr[i])
+            m.d.comb += clearDecoder.i.eq(clear_addr)
             Clears += [clearDecoder.o]
-        m.d.comb += self.matrix.clear_hot.eq(acclumnateOR(m.d.comb, Clears))
+        m.d.comb += [
+            self.matrix.clear_hot.eq(treeOR(Clears)),
+            self.scoreboard.clear_hot.eq(self.matrix.clear_hot),
+            self.scoreboard.insert_hot.eq(treeOR(all_row_selects)),
+            self.matrix.flush_hot.eq(self.flush_hot),
+            self.scoreboard.flush_hot.eq(self.flush_hot),
+        ]
 
 
         # The selector takes the output of the matrix and chooses NumIssue instructions that are ready
         m.submodules += self.selecter
 
-        m.d.comb += self.selecter.input.eq(self.matrix.is_clear & (self.waiting_for_select)),
+        m.d.comb += self.selecter.input.eq(self.matrix.is_clear & self.waiting_for_select & ~self.flush_hot),
+
+        if self.criticality:
+            classes = [self.matrix.many_consumers, self.matrix.has_consumer]
+            if self.ageLimit:
+                old = Cat(*[waited == self.ageLimit for waited in self.waited])
+                classes = [old] + classes
+
+                inserted = treeOR(all_row_selects)
+                for e, waited in enumerate(self.waited):
+                    with m.If(inserted[e]):
+                        m.d.sync += waited.eq(0)
+                    with m.Elif(waited != self.ageLimit):
+                        m.d.sync += waited.eq(waited + 1)
 
-        for outHot, readyHot, readyValid in zip(self.selecter.outHot, self.readyHot, self.readyValid):
+            for cls, mask in zip(self.selecter.classes, classes):
+                m.d.comb += cls.eq(mask)
+
+        for i, (outHot, ready, readyHot, readyValid) in enumerate(zip(self.selecter.outHot, self.ready, self.readyHot, self.readyValid)):
+            m.submodules[f"ready_encoder_{i}"] = readyEncoder = Encoder(self.NumQueueEntries)
             m.d.comb += [
                 readyHot.eq(outHot),
-                readyValid.eq(outHot[1:] != 0)
+                readyValid.eq(outHot[1:] != 0),
+                readyEncoder.i.eq(outHot),
+                ready.eq(readyEncoder.o),
             ]
 
-        InsertedThisCycle = acclumnateOR(m.d.comb, all_row_selects)
-        SelectedThisCycle = acclumnateOR(m.d.comb, self.selecter.outHot)
+        InsertedThisCycle = treeOR(all_row_selects)
+        SelectedThisCycle = treeOR(self.selecter.outHot)
+
+        if self.replay:
+            Replayed = self.elaborateReplay(m, all_sources, InsertedThisCycle, SelectedThisCycle)
+        else:
+            Replayed = 0
 
         # We want to remove the uops we selected this cycle from the eligible set
-        # And mark any new uops as eligible
-        m.d.sync += self.waiting_for_select.eq((self.waiting_for_select & ~SelectedThisCycle) | InsertedThisCycle)
+        # And mark any new uops as eligible. Replayed uops are eligible again
+        m.d.sync += self.waiting_for_select.eq(((self.waiting_for_select & ~SelectedThisCycle) | InsertedThisCycle | Replayed) & ~self.flush_hot)
 
         return m
 
+    def elaborateReplay(self, m, all_sources, InsertedThisCycle, SelectedThisCycle):
+        Cancels = []
+        for i, cancel_addr in enumerate(self.cancel_addr):
+            m.submodules[f"cancel_decoder_{i}"] = cancelDecoder = Decoder(self.NumQueueEntries)
+            m.d.comb += cancelDecoder.i.eq(cancel_addr)
+            Cancels += [cancelDecoder.o]
+
+        Confirms = []
+        for i, confirm_addr in enumerate(self.confirm_addr):
+            m.submodules[f"confirm_decoder_{i}"] = confirmDecoder = Decoder(self.NumQueueEntries)
+            m.d.comb += confirmDecoder.i.eq(confirm_addr)
+            Confirms += [confirmDecoder.o]
+
+        CancelledThisCycle = treeOR(Cancels + [self.cascade_hot]) & ~1
+        ConfirmedThisCycle = treeOR(Confirms) & ~1
+
+        Live = self.waiting_for_select | self.issued
+        Retired = ConfirmedThisCycle | self.flush_hot
+
+        # Only remember sources that can still be cancelled. Anything else has been confirmed (or was never there),
+        # and once its ID is reused, cancelling the new owner mustn't drag this uop back
+        for source_data, sources in zip(self.matrix.source_data, all_sources):
+            m.d.comb += source_data.eq(sources & (Live | InsertedThisCycle) & ~Retired)
+
+        m.d.comb += [
+            self.matrix.cancel_hot.eq(CancelledThisCycle),
+            self.matrix.retire_hot.eq(Retired),
+            self.matrix.live_hot.eq(Live),
+            self.scoreboard.cancel_hot.eq(CancelledThisCycle),
+
+            # Including uops selected this cycle, they haven't made it into issued yet.
+            # Victims that were still waiting just wait longer
+            self.replay_hot.eq(self.matrix.victims & (self.issued | SelectedThisCycle) & ~self.flush_hot),
+        ]
+
+        m.d.sync += [
+            self.issued.eq((self.issued | SelectedThisCycle) & ~self.replay_hot & ~ConfirmedThisCycle & ~self.flush_hot),
+            self.cascade_hot.eq(self.replay_hot),
+        ]
+
+        return self.replay_hot
+
 
 
 if __name__ == "__main__":
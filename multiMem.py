@@ -2,22 +2,40 @@ from nmigen import *
 from nmigen.cli import main
 
 class MultiMem(Elaboratable):
-    def __init__(self, width, depth, readPorts, writePorts, init=None):
+    # backend picks how the ports are built:
+    #   "lut": LUTmem with a physical port per logical port. Reads are combinational
+    #   "lvt": a replica per (read, write) port pair plus a live value table
+    #   "pumped": see elaboratePumped. Reads take a cycle (readLatency)
+    #
+    # The backends are standalone only for now: nothing in Renamer, the schedulers or Core picks one,
+    # they all use "lut", and none of them could cope with the pumped backend's read latency yet.
+    #
+    # Writes land at the end of the cycle, and a read never sees writes from its own cycle.
+    # Two write ports writing the same address in one cycle is undefined (pysim picks one of them)
+
+    def __init__(self, width, depth, readPorts, writePorts, init=None, backend="lut", fastDomain="fast"):
 
         lvt_width = (writePorts - 1).bit_length()
 
         # Pick the best approach for implementing this memory
         self.UseLVT = width >= (lvt_width * 2) # If the LVT is larger than just using LUTmem
 
-        self.UseLVT = False
+        self.UseLVT = backend == "lvt"
 
         # TODO: we also might want to use LUTmem when depth is much lower than economical for blockram
 
-        if self.UseLVT:
-            self.mem = [ [ Memory(width=width, depth=depth, name=f"mem_{i}_{j}") for i in range(writePorts)] for j in range(readPorts)]
+        self.pumped = backend == "pumped"
+        self.fastDomain = fastDomain
+        self.readLatency = 1 if self.pumped else 0
+
+        if self.pumped:
+            # Two logical ports share each physical one, the lower half in the first half of the cycle
+            self.pumpedMem = Memory(width=width, depth=depth, name="pumped_mem", init=init)
+        elif self.UseLVT:
+            self.mem = [ [ Memory(width=width, depth=depth, name=f"mem_{i}_{j}", init=init) for i in range(writePorts)] for j in range(readPorts)]
 
             # we need a small bit of true multiport ram for the live value table
-            self.lvt = Memory(width=(writePorts - 1).bit_length(), depth=depth, name="lvt")
+            self.lvt = Memory(width=max(lvt_width, 1), depth=depth, name="lvt")
         else: # Otherwise, LUTmem
             self.lutMem = Memory(width=width, depth=depth, name="mem", init=init)
 
@@ -34,10 +52,100 @@ class MultiMem(Elaboratable):
         self.writePorts = writePorts
         self.width = width
 
+    def simWrite(self, addr, value):
+        # Simulation only: commands for a pysim process that set an entry directly, as if it had been
+        # written some time ago. A pumped write still pending isn't affected
+        if self.pumped:
+            memories = [self.pumpedMem]
+        elif self.UseLVT:
+            memories = [mem for replicas in self.mem for mem in replicas] # Every replica agrees, whatever the LVT says
+        else:
+            memories = [self.lutMem]
+        for mem in memories:
+            yield mem[addr].eq(value)
+
+    def elaboratePumped(self, m):
+        # Block RAM on the Cyclone V runs at twice our core clock, so each physical port does two logical
+        # ports per cycle from fastDomain, whose rising edges must line up with sync's (one PLL, 2x).
+        #
+        # Each core cycle has a mid edge and an end edge in fastDomain:
+        #   mid:  read the lower half of the read ports, write last cycle's upper half of the write ports
+        #   end:  read the upper half of the read ports, write this cycle's lower half of the write ports
+        #
+        # The upper writes wait half a cycle so that the upper reads (at the end edge) can't see this
+        # cycle's writes. The lower reads happen on the same edge as last cycle's upper writes, so
+        # those are forwarded.
+        # Read data comes back the next core cycle.
+        fast = self.fastDomain
+        half = lambda n: (n + 1) // 2
+        pad = lambda ports, n, value: ports + [value] * (2 * n - len(ports))
+
+        # toggles every core cycle, and seen catches up at the mid edge, so they differ in the first half
+        tick = Signal()
+        seen = Signal()
+        firstHalf = Signal()
+        m.d.sync += tick.eq(~tick)
+        m.d[fast] += seen.eq(tick)
+        m.d.comb += firstHalf.eq(tick != seen)
+
+        # write ports
+        writes = half(self.writePorts)
+        addrs = pad(self.write_addr, writes, 0)
+        enables = pad(self.write_enable, writes, 0)
+        datas = pad(self.write_data, writes, 0)
+
+        pendingAddr = [Signal.like(addr) for addr in self.write_addr[:writes]]
+        pendingEnable = [Signal() for _ in range(writes)]
+        pendingData = [Signal(self.width) for _ in range(writes)]
+        for k in range(writes):
+            m.d.sync += [
+                pendingAddr[k].eq(addrs[writes + k]),
+                pendingEnable[k].eq(enables[writes + k]),
+                pendingData[k].eq(datas[writes + k]),
+            ]
+
+            m.submodules[f"pumped_write_{k}"] = wport = self.pumpedMem.write_port(domain=fast)
+            m.d.comb += [
+                wport.en.eq(Mux(firstHalf, pendingEnable[k], enables[k])),
+                wport.addr.eq(Mux(firstHalf, pendingAddr[k], addrs[k])),
+                wport.data.eq(Mux(firstHalf, pendingData[k], datas[k])),
+            ]
+
+        # read ports
+        reads = half(self.readPorts)
+        readAddrs = pad(self.read_addr, reads, 0)
+        for k in range(reads):
+            m.submodules[f"pumped_read_{k}"] = rport = self.pumpedMem.read_port(domain=fast, transparent=False)
+            m.d.comb += rport.addr.eq(Mux(firstHalf, readAddrs[k], readAddrs[reads + k]))
+
+            # The pending write to the same address, if any
+            forwarded = Signal(self.width)
+            hit = Signal()
+            for addr, enable, data in zip(pendingAddr, pendingEnable, pendingData):
+                with m.If(enable & (addr == self.read_addr[k])):
+                    m.d.comb += [
+                        hit.eq(1),
+                        forwarded.eq(data),
+                    ]
+
+            # The lower read's data is ready for the end edge, the upper's only lasts until the next mid edge
+            lower = Signal(self.width)
+            upper = Signal(self.width)
+            with m.If(~firstHalf):
+                m.d[fast] += lower.eq(Mux(hit, forwarded, rport.data))
+            with m.Else():
+                m.d[fast] += upper.eq(rport.data)
+
+            m.d.comb += self.read_data[k].eq(lower)
+            if reads + k < self.readPorts:
+                m.d.comb += self.read_data[reads + k].eq(Mux(firstHalf, rport.data, upper))
+
     def elaborate(self, platform):
         m = Module()
 
-        if self.UseLVT:
+        if self.pumped:
+            self.elaboratePumped(m)
+        elif self.UseLVT:
             for j in range(self.writePorts):
                 m.submodules["mem_" + chr(ord('a') + j) + "_lvt_write"] = lvt_wport = self.lvt.write_port()
 
@@ -55,7 +163,7 @@ class MultiMem(Elaboratable):
                 for j in range(self.writePorts):
                     name = "mem_" + str(i) + chr(ord('a') + j)
 
-                    m.submodules[name + "_read"] = read_port = self.mem[i][j].read_port()
+                    m.submodules[name + "_read"] = read_port = self.mem[i][j].read_port(domain="comb")
                     m.submodules[name + "_write"] = write_port = self.mem[i][j].write_port()
 
                     m.d.comb += [
@@ -71,7 +179,7 @@ class MultiMem(Elaboratable):
                         read_data_buffer[Const(j)].eq(read_port.data),
                     ]
 
-                m.submodules[f"mem_{i}_lvt"] = lvt_rport = self.lvt.read_port()
+                m.submodules[f"mem_{i}_lvt"] = lvt_rport = self.lvt.read_port(domain="comb")
                 m.d.comb += [
                     # Query Live Value Table for which memory has the correct result
                     lvt_rport.addr.eq(self.read_addr[i]),
@@ -100,7 +208,71 @@ class MultiMem(Elaboratable):
         return m
 
 
+def testBackend(backend, readPorts=3, writePorts=3, depth=8, cycles=2000, seed=0):
+    # Random traffic against a python model of the memory, with sync and (for pumped) a 2x fast clock.
+    # Small depth so reads keep hitting addresses being written. Returns how many reads came back wrong
+    import random
+    from nmigen.back.pysim import Simulator, Settle, Tick
+
+    rng = random.Random(seed)
+    init = [rng.getrandbits(8) for _ in range(depth)]
+    mem = MultiMem(8, depth, readPorts, writePorts, init=init, backend=backend)
+
+    m = Module()
+    m.domains.sync = ClockDomain("sync")
+    if mem.pumped:
+        m.domains.fast = ClockDomain("fast")
+    m.submodules.mem = mem
+
+    model = list(init)
+    errors = []
+    def process():
+        expected = None
+        for cycle in range(cycles):
+            addrs = [rng.randrange(depth) for _ in range(readPorts)]
+            for addr, port in zip(addrs, mem.read_addr):
+                yield port.eq(addr)
+            writes = [(addr, rng.random() < 0.7, rng.getrandbits(8)) for addr in rng.sample(range(depth), writePorts)]
+            for (addr, enable, data), port, portEnable, portData in zip(writes, mem.write_addr, mem.write_enable, mem.write_data):
+                yield port.eq(addr)
+                yield portEnable.eq(enable)
+                yield portData.eq(data)
+            yield Settle()
+
+            # Reads never see this cycle's writes, and come back readLatency cycles later
+            if mem.readLatency == 0:
+                expected = [model[addr] for addr in addrs]
+            if expected is not None:
+                for port, value in zip(mem.read_data, expected):
+                    if (yield port) != value:
+                        errors.append(cycle)
+            expected = [model[addr] for addr in addrs]
+            for addr, enable, data in writes:
+                if enable:
+                    model[addr] = data
+            yield Tick()
+
+    sim = Simulator(m)
+    # Rising edges have to line up exactly, so the periods are powers of two which pysim adds up without rounding
+    sim.add_clock(2 ** -19)
+    if mem.pumped:
+        sim.add_clock(2 ** -20, phase=2 ** -20, domain="fast")
+    sim.add_sync_process(process)
+    sim.run()
+    return len(errors)
+
+
 if __name__ == "__main__":
+    import sys
+
+    # python multiMem.py test: checks every backend against a model
+    if sys.argv[1:] == ["test"]:
+        for backend in ["lut", "lvt", "pumped"]:
+            for readPorts, writePorts in [(2, 2), (3, 3), (4, 1), (1, 4)]:
+                errors = testBackend(backend, readPorts, writePorts)
+                print(f"{backend} {readPorts}R/{writePorts}W: {'ok' if errors == 0 else f'{errors} bad reads'}")
+        sys.exit()
+
     mm = MultiMem(32, 4, 2, 2)
     ports = []
     for i in range(2):
@@ -110,8 +282,3 @@ if __name__ == "__main__":
         ports += [mm.write_addr[i], mm.write_enable[i], mm.write_data[i]]
 
     main(mm, ports = ports)
-
-
-
-
-
@@ -1,9 +1,7 @@
 from nmigen import *
 from nmigen.cli import main
-from decoder import Decoder
-from renamer import Renamer
-from scheduler import Scheduler
-from matrixScheduler import MatrixScheduler
+from core import Core
+from traceSim import mixedTrace, program
 
 from nmigen_boards.de10_nano import *
 
@@ -13,6 +11,7 @@ class Arch:
 class Impl:
     NumDecodes = 4
     NumIssues = 4
+    NumClears = 8
     numFinalizes = 4
     numExecutions = 4
     numEntries = 128
@@ -20,49 +19,41 @@ class Impl:
     MWTSize = 16
 
 class Pipeline(Elaboratable):
+    # DE10-Nano shell around the Core. Everything interesting happens in Core, this just
+    # shows the completed uop counter on the LEDs
 
-    def __init__(self, Impl, Arch):
+    def __init__(self, Impl, Arch, program):
 
-        self.renamer = Renamer(Impl, Arch)
-        self.scheduler = MatrixScheduler(Impl, Arch)
+        self.core = Core(Impl, Arch, program)
 
 
     def elaborate(self, platform: DE10NanoPlatform):
         m = Module()
 
-        m.submodules.renamer = self.renamer
-        m.submodules.scheduler = self.scheduler
-
-        for i, _ in enumerate(self.renamer.outA):
-            m.d.comb += [
-                self.scheduler.inA[i].eq(self.renamer.outA[i]),
-                self.scheduler.inB[i].eq(self.renamer.outB[i]),
-                self.scheduler.inOut[i].eq(self.renamer.outOut[i]),
-                self.scheduler.inValid[i].eq(self.renamer.outValid[i]),
-            ]
-
+        m.submodules.core = self.core
 
         led = [platform.request("led", i) for i in range(8)]
         led_buffer = Signal(8)
 
-        switch = platform.request("switch", 0)
-        switch_buffer = Signal(6 * 4)
-
+        m.d.comb += Cat(*led).eq(led_buffer)
 
-        m.d.comb += [
-            Cat(*self.scheduler.clear_addr).eq(switch_buffer),
-            Cat(led[0], led[1], led[2], led[3], led[4], led[5], led[6], led[7]).eq(led_buffer)
-        ]
-
-        m.d.sync += [
-            switch_buffer.eq(Cat(switch, switch_buffer[1:4])), # just shift an address in
-           # led_buffer.eq(Cat(self.scheduler.readyValid[0], self.scheduler.readyValid[1], self.scheduler.readyValid[2], self.scheduler.readyValid[3]))
-           led_buffer.eq(Cat(*self.scheduler.readyValid))
-        ]
+        # Top bits of the counter, so it's slow enough to see
+        m.d.sync += led_buffer.eq(self.core.completed[-8:])
 
         return m
 
 
 if __name__ == "__main__":
+    import sys
+    from buildCache import BuildCache
+
+    # python pipeline.py cached: submodules that haven't changed since the last build come straight out of
+    # the cache. Opt in only, until a cached board build has actually been through the toolchain
+    cache = sys.argv[1:] == ["cached"]
+    if cache:
+        Impl.BuildCache = BuildCache()
+
     platform = DE10NanoPlatform()
-    platform.build(Pipeline(Impl(), Arch()))
+    platform.build(Pipeline(Impl(), Arch(), program(mixedTrace(256))))
+    if cache:
+        print(Impl.BuildCache.report())
@@ -1,7 +1,13 @@
 from nmigen import *
 from nmigen.cli import main
+import nmigen.lib.coding as coding
 from multiMem import MultiMem
-from decoder import Decoder
+from buildCache import cached
+from decoder import Decoder, DecodedUop, Fusion, Steering, simpleOpcodes
+from matrixScheduler import PiorityEncoder
+from stream import SkidBuffer
+from uopCache import UopCache
+from util import *
 
 class Arch:
     NumGPR = 32
@@ -13,34 +19,320 @@ class Impl:
     numExecutions = 4
     numEntries = 128
     numRenamingRegisters = 150
+    RenameResolver = "chain" # or "prefix" for the log-depth resolver
+    RenameStages = 1
+
+class Resolver(Elaboratable):
+    # Works out which renaming register each source of a decode group should read.
+    # Sources normally come from the RAT, but if an earlier uop in the same group writes
+    # that arch register, the source must use that uop's freshly allocated register instead
+    # (the RAT isn't updated until the end of the cycle).
+    # It also works out which uops should write to the RAT: if multiple uops in a group
+    # write the same arch register, only the last one is allowed to.
+
+    def __init__(self, numDecodes, width, regWidth):
+        self.numDecodes = numDecodes
+        self.width = width
+
+        # inputs
+        self.regA = [Signal(regWidth, name=f"resolve_regA_{i}") for i in range(numDecodes)]
+        self.regB = [Signal(regWidth, name=f"resolve_regB_{i}") for i in range(numDecodes)]
+        self.regOut = [Signal(regWidth, name=f"resolve_regOut_{i}") for i in range(numDecodes)]
+        self.isAllocated = [Signal(name=f"resolve_isAllocated_{i}") for i in range(numDecodes)]
+        self.allocated = [Signal(width, name=f"resolve_allocated_{i}") for i in range(numDecodes)]
+        self.ratA = [Signal(width, name=f"resolve_ratA_{i}") for i in range(numDecodes)]
+        self.ratB = [Signal(width, name=f"resolve_ratB_{i}") for i in range(numDecodes)]
+
+        # outputs
+        self.outA = [Signal(width, name=f"resolved_A_{i}") for i in range(numDecodes)]
+        self.outB = [Signal(width, name=f"resolved_B_{i}") for i in range(numDecodes)]
+        self.updateEnabled = [Signal(name=f"resolve_updateEnabled_{i}") for i in range(numDecodes)]
+
+
+class ChainResolver(Resolver):
+    # Each slot checks every earlier slot in order and threads the result through a
+    # chain of muxes. Simple, but the depth grows linearly with decode width.
+
+    def elaborate(self, platform):
+        m = Module()
+
+        conflictables = []
+
+        for i in range(self.numDecodes):
+            regA_final = self.ratA[i]
+            regB_final = self.ratB[i]
+
+            # check for conflicts
+            for archRegId, decoderId in conflictables:
+                dependsA = Signal(name=f"decoder{i}A_depends_on_{decoderId}out")
+                dependsB = Signal(name=f"decoder{i}B_depends_on_{decoderId}out")
+
+                outA = Signal(self.width, name=f"decoder{i}A_resloved{decoderId}")
+                outB = Signal(self.width, name=f"decoder{i}B_resloved{decoderId}")
+                m.d.comb += [
+                    # Check if input registers match the output of a previous uop this cycle
+                    dependsA.eq((self.regA[i] == archRegId) & self.isAllocated[decoderId]),
+                    dependsB.eq((self.regB[i] == archRegId) & self.isAllocated[decoderId]),
+
+                    # select correct renaming id
+                    outA.eq(Mux(dependsA, self.allocated[decoderId], regA_final)),
+                    outB.eq(Mux(dependsB, self.allocated[decoderId], regB_final))
+                ]
+
+                # Accumulate mux chains
+                regA_final = outA
+                regB_final = outB
+
+            m.d.comb += [
+                self.outA[i].eq(regA_final),
+                self.outB[i].eq(regB_final),
+            ]
+
+            # Each decoder down the chain needs to check for more and more conflicts
+            conflictables += [(self.regOut[i], i)]
+
+        # Find which outputs are written to more than once in a single cycle
+        # We need to update the RAT only once for each ArchReg.
+        # This works in reverse to conflicts. the last uop can't be suppressed by anything
+        for i in range(self.numDecodes):
+            overwritten = [(self.regOut[i] == self.regOut[j]) & self.isAllocated[j] for j in range(i + 1, self.numDecodes)]
+            m.d.comb += self.updateEnabled[i].eq(self.isAllocated[i] & ~treeOR(overwritten))
+
+        return m
+
+
+class PrefixResolver(Resolver):
+    # Compares every source against every earlier slot in parallel (one-hot matching) and then
+    # uses a priority select so the last writer wins.
+    #
+    # The priority part doesn't depend on the sources at all: writer j is the last writer
+    # for slot i if no slot between j and i writes the same arch register. That's a
+    # parallel-prefix OR over the pairwise destination compares, which is calculated at the
+    # same time as the source compares, so the depth grows with log2(decode width).
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # killed[j][t] is high if any slot in j+1 .. j+1+t writes the same arch register as slot j
+        killed = []
+        for j in range(self.numDecodes):
+            sameDest = [(self.regOut[j] == self.regOut[k]) & self.isAllocated[k] for k in range(j + 1, self.numDecodes)]
+            killed += [prefixOR(sameDest)]
+
+        for i in range(self.numDecodes):
+            for src, rat, out, nnn in [(self.regA[i], self.ratA[i], self.outA[i], "A"),
+                                       (self.regB[i], self.ratB[i], self.outB[i], "B")]:
+                if i == 0:
+                    m.d.comb += out.eq(rat)
+                    continue
+
+                # One-hot match against every earlier writer in this group
+                matches = [Signal(name=f"decoder{i}{nnn}_matches_{j}") for j in range(i)]
+                m.d.comb += [match.eq((src == self.regOut[j]) & self.isAllocated[j]) for j, match in enumerate(matches)]
+
+                # Masked down to the last writer
+                hits = [Signal(name=f"decoder{i}{nnn}_last_writer_{j}") for j in range(i)]
+                for j, hit in enumerate(hits):
+                    if i - j >= 2:
+                        m.d.comb += hit.eq(matches[j] & ~killed[j][i - j - 2])
+                    else:
+                        m.d.comb += hit.eq(matches[j])
+
+                # AND-OR select between the last writer and the RAT value
+                candidates = [Mux(hits[j], self.allocated[j], 0) for j in range(i)]
+                candidates += [Mux(Cat(*matches).any(), 0, rat)]
+                m.d.comb += out.eq(treeOR(candidates))
+
+        # Uops are only allowed to update the RAT if no later uop in this group writes the same arch register
+        for i in range(self.numDecodes):
+            if i + 1 < self.numDecodes:
+                m.d.comb += self.updateEnabled[i].eq(self.isAllocated[i] & ~killed[i][-1])
+            else:
+                m.d.comb += self.updateEnabled[i].eq(self.isAllocated[i])
+
+        return m
+
 
 class Renamer(Elaboratable):
     # Tracks which renaming register contains each architectural register in the RAT
     # converts arch register IDs to renaming register IDs
-
-    def __init__(self, Impl, Arch):
+    #
+    # In a closed loop (closedLoop=True) the decoders take their instructions from outside and
+    # renaming registers come from a pool: a register goes back in the pool once it has been
+    # superseded in the RAT and the uop writing it has completed (complete inputs).
+    # Otherwise registers are just handed out from a counter.
+    #
+    # Impl.RegisterRelease picks when it does:
+    #   "complete" (default): superseded and written, as above. That ignores any uops still to read it,
+    #     which is only safe because nothing reads the renaming registers yet
+    #   "retire": only once the uop which superseded it retires, the usual way. There's no ROB, so every
+    #     renamed group waits in a queue (Impl.RetireGroups long, numRenamingRegisters by default) and
+    #     retires, in order, once all the registers it allocated have been written
+    #   "readers": superseded, written, and read by every uop renamed against it. Each register counts its
+    #     outstanding readers, up at rename for every source going to the scheduler, down as they issue
+    #     and read their operands (read inputs)
+    #
+    # With a pool, moves and zero idioms are eliminated (Impl.MoveElimination, on by default):
+    # they don't allocate and don't go to the scheduler, the RAT just points their destination
+    # at the source's register, or at NULL (0) which always reads as zero. Several arch registers
+    # can then share a renaming register, so the pool counts references instead.
+    #
+    # In a closed loop, instructions come in through Steering, which can split a fetched group when some
+    # decode slots only have simple decoders (Impl.ComplexDecoders).
+    #
+    # Adjacent instructions can be fused into one uop on the way in, see Fusion. In a closed loop,
+    # decoded groups can also be cached and replayed without fetch or decode (Impl.UopCacheEntries, see UopCache).
+    #
+    # Decode groups come in through a skid buffer and go out with outValid/outReady. The whole
+    # renamer advances together: when the output is stalled, or there aren't enough free
+    # registers for the next group, nothing moves and the RAT isn't touched.
+    #
+    # The RAT can have fewer source read ports than the 2 per decode slot (Impl.RATReadPorts).
+    # Reads of the same arch register within a group share a port, and each source takes its
+    # data from whichever port read its register. A group needing more unique reads than there
+    # are ports is split: the slots that fit are renamed this cycle and the rest stay in the
+    # skid buffer for the next, reading a RAT that already holds the first part's writes.
+    #
+    # With Impl.Threads > 1 (SMT) each group comes from one thread, given on inThread as it goes into
+    # decode, and carries its thread through to outThread. Every thread has its own RAT, kept as its own
+    # range of entries in gprRAT, but they share the register pool, so the scheduler and execution never
+    # need to know about threads. There's no uop cache with SMT.
+
+    def __init__(self, Impl, Arch, closedLoop=False):
         self.width = width = Impl.numRenamingRegisters.bit_length()
-
-        self.decoders = [ Decoder(i) for i in range(Impl.NumDecodes)]
+        self.numRegs = Impl.numRenamingRegisters
+        self.closedLoop = closedLoop
+
+        self.threads = getattr(Impl, "Threads", 1)
+        self.threadBits = (self.threads - 1).bit_length()
+        self.archBits = (Arch.NumGPR - 1).bit_length()
+
+        # The first Impl.ComplexDecoders slots decode everything, the rest only simple instructions (see Steering)
+        complexDecoders = getattr(Impl, "ComplexDecoders", Impl.NumDecodes)
+        assert complexDecoders >= 1, "slot 0 has to take any instruction"
+        simple = getattr(Impl, "SimpleOpcodes", simpleOpcodes)
+        self.decoders = [ Decoder(i, external=closedLoop, supported=None if i < complexDecoders else simple) for i in range(Impl.NumDecodes)]
+        if closedLoop:
+            # Fetched instructions come in through steering
+            self.steering = Steering(Impl, self.decoders)
+
+        # Read ports for source registers, shared by the whole group
+        self.sourcePorts = getattr(Impl, "RATReadPorts", Impl.NumDecodes * 2)
+        self.constrained = self.sourcePorts < Impl.NumDecodes * 2
+        assert self.sourcePorts >= 2, "a single uop must always fit"
 
         # The RAT holds the id for the renaming register which holds current value of each architecture register
-        self.gprRAT = MultiMem(
+        self.gprRAT = cached(Impl, MultiMem,
             width=width,
-            depth=Arch.NumGPR,
-            readPorts=Impl.NumDecodes*2, # Every decode might output 2 reads
+            depth=Arch.NumGPR * self.threads,
+            readPorts=self.sourcePorts + (Impl.NumDecodes if closedLoop else 0), # Source reads, plus the register each decode replaces
             writePorts=Impl.NumDecodes)  # Every decode might output 1 writes
 
         self.allocated = [Signal(width, name=f"allocated_{i}") for i in range(Impl.NumDecodes)]
         self.isAllocated = [Signal(name=f"isAllocated_{i}") for i in range(Impl.NumDecodes)]
+        self.isWriter = [Signal(name=f"isWriter_{i}") for i in range(Impl.NumDecodes)] # Allocated or eliminated, either way it updates the RAT
         self.updateEnabled = [Signal(name=f"updateEnabled_{i}") for i in range(Impl.NumDecodes)]
+        self.fixupValid = [Signal(name=f"fixupValid_{i}") for i in range(Impl.NumDecodes)]
+        self.uopValid = [Signal(name=f"uopValid_{i}") for i in range(Impl.NumDecodes)]
+        self.advance = Signal()
+        self.fixupUnits = [Signal(len(decoder.executionUnits), name=f"fixupUnits_{i}") for i, decoder in enumerate(self.decoders)]
+        self.fixupOpcode = [Signal(len(decoder.opcode), name=f"fixupOpcode_{i}") for i, decoder in enumerate(self.decoders)]
+        self.fixupAllocated = [Signal(width, name=f"fixupAllocated_{i}") for i in range(Impl.NumDecodes)]
+        self.fixupMove = [Signal(name=f"fixupMove_{i}") for i in range(Impl.NumDecodes)]
+        self.fixupZero = [Signal(name=f"fixupZero_{i}") for i in range(Impl.NumDecodes)]
+
+        # 1: RAT lookup, allocation, fix-up and RAT update all happen in one cycle
+        # 2: RAT lookup and allocation in the first cycle, fix-up and RAT update in the second
+        self.stages = getattr(Impl, "RenameStages", 1)
 
         self.nextFreeRegister = Signal(width, reset=1) # keep zero as NULL
 
+        self.eliminate = closedLoop and getattr(Impl, "MoveElimination", True)
+
+        if closedLoop:
+            # Register pool state, one bit per renaming register
+            self.live = Signal(self.numRegs, reset=1)  # Allocated and not yet back in the pool. Zero is NULL, always live
+            self.done = Signal(self.numRegs)           # Uop writing it has completed
+            if self.eliminate:
+                # How many arch registers map to each renaming register. Zero is never freed so its count is unused
+                self.refs = [Signal(range(Arch.NumGPR * self.threads + 1), name=f"refs_{r}") for r in range(self.numRegs)]
+            else:
+                self.superseded = Signal(self.numRegs) # No longer in the RAT
+            self.pool = PiorityEncoder(self.numRegs, Impl.NumDecodes)
+
+            # The register each uop replaces in the RAT
+            self.oldMapping = [Signal(width, name=f"oldMapping_{i}") for i in range(Impl.NumDecodes)]
+
+            # inputs
+            self.complete = [Signal(width, name=f"complete_{i}") for i in range(getattr(Impl, "NumClears", Impl.NumIssues))]
+
+            self.release = getattr(Impl, "RegisterRelease", "complete")
+            assert self.release in ("complete", "retire", "readers")
+            if self.release == "retire":
+                # Each renamed group's allocated registers, then the registers it releases. 0 for none
+                self.retireDepth = getattr(Impl, "RetireGroups", self.numRegs)
+                self.retireQueue = MultiMem(width=width * Impl.NumDecodes * 2, depth=self.retireDepth, readPorts=1, writePorts=1)
+                self.retireHead = Signal(range(self.retireDepth))
+                self.retireTail = Signal(range(self.retireDepth))
+                self.retireCount = Signal(range(self.retireDepth + 1))
+            elif self.release == "readers":
+                # Uops renamed to read each renaming register which haven't issued yet
+                self.readers = [Signal(range(2 * self.numRegs), name=f"readers_{r}") for r in range(self.numRegs)]
+                # inputs: the sources of every uop issued this cycle, 0 for none
+                self.read = [Signal(width, name=f"read_{i}") for i in range(2 * Impl.NumIssues)]
+
+            # outputs
+            self.freeCount = Signal(range(self.numRegs + 1))
+
+        self.fusion = Fusion(Impl, self.decoders)
+        self.uops = [DecodedUop(decoder, f"uop{i}") for i, decoder in enumerate(self.decoders)]
+        self.skid = SkidBuffer(sum(len(field) for uop in self.uops for field in uop.fields()) + self.threadBits, name="decoded")
+
+        if self.constrained:
+            # Slots of the group at the head of the skid buffer which were renamed in an earlier cycle
+            self.splitDone = Signal(Impl.NumDecodes)
+
+        # Fetch address of the group in decode
+        self.decodedAddr = Signal(16)
+        self.decodedNext = Signal(16)
+
+        # Thread of the group in decode, at the head of the skid buffer, and in fix-up
+        self.decodedThread = Signal(self.threadBits)
+        self.thread = Signal(self.threadBits)
+        self.fixupThread = Signal(self.threadBits)
+
+        self.uopCache = None
+        if closedLoop and getattr(Impl, "UopCacheEntries", 0):
+            assert self.threads == 1, "no uop cache with SMT"
+            self.uopCache = UopCache(Impl, len(self.skid.i_data), len(self.decodedAddr))
+
+        # Resolves dependencies between uops within a single decode group
+        resolvers = {"chain": ChainResolver, "prefix": PrefixResolver}
+        self.resolver = resolvers[getattr(Impl, "RenameResolver", "chain")](Impl.NumDecodes, width, len(self.decoders[0].regA))
+
         # outputs
         self.outA = [Signal(width, name=f"outA_{i}") for i in range(Impl.NumDecodes)]
         self.outB = [Signal(width, name=f"outB_{i}") for i in range(Impl.NumDecodes)]
         self.outOut = [Signal(width, name=f"outOut_{i}") for i in range(Impl.NumDecodes)]
         self.outValid = [Signal(name=f"outValid_{i}") for i in range(Impl.NumDecodes)]
+        self.outUnits = [Signal(len(decoder.executionUnits), name=f"outUnits_{i}") for i, decoder in enumerate(self.decoders)]
+        self.outOpcode = [Signal(len(decoder.opcode), name=f"outOpcode_{i}") for i, decoder in enumerate(self.decoders)]
+        self.outEliminated = [Signal(name=f"outEliminated_{i}") for i in range(Impl.NumDecodes)] # outOut is the register it aliases
+        self.outThread = Signal(self.threadBits)
+        self.eliminated = [Signal(name=f"eliminated_{i}") for i in range(Impl.NumDecodes)] # Eliminated this cycle
+        self.fused = [Signal(name=f"fused_{i}") for i in range(Impl.NumDecodes)] # Fused uop renamed this cycle
+        self.inReady = Signal()
+        self.redirect = Signal() # Restart fetch from redirectAddr
+        self.redirectAddr = Signal(16)
+        self.uopCacheHit = Signal()  # A group was delivered from the uop cache
+        self.uopCacheMiss = Signal() # A group was delivered from decode
+        self.split = Signal()        # Part of the group was renamed, the rest didn't fit in the RAT read ports
+
+        # inputs
+        self.outReady = Signal(reset=1)
+        self.inAddr = Signal(16)     # Fetch address of the group going into decode
+        self.inNextAddr = Signal(16) # and of the group after it
+        self.inThread = Signal(self.threadBits) # and which thread it's from
 
 
     def elaborate(self, platform):
@@ -48,115 +340,408 @@ class Renamer(Elaboratable):
 
         # Register submodules
         m.submodules.gprRAT = self.gprRAT
+        m.submodules.resolver = self.resolver
         for i, decoder in enumerate(self.decoders):
             m.submodules[f"decoder{i}"] = decoder
-
-        # Allocate a renaming register for each uop which needs it
-        # TODO: Because we are planning to always keep our architectural registers in
-        #       the renaming register file, this allocator is wildly deficient once
-        #       we start retiring instructions.
-        #       I think we need an implementation that allocates register out of a
-        #       list (fifo?) of free registers.
-        allocatedCount = Const(0)
-        for i, decoder in enumerate(self.decoders):
-            oldAllocatedCount = allocatedCount
-            allocatedCount = Signal(self.width, name=f"decoder_{i}_allocate_counter")
+        m.submodules.fusion = self.fusion
+        m.submodules.skid = self.skid
+        if self.closedLoop:
+            m.submodules.steering = self.steering
+
+        # Decoders -> fusion -> (uop cache) -> skid buffer
+        decoded = Cat(*[field for uop in self.fusion.uops for field in uop.fields()], self.decodedThread)
+        decodedValid = treeOR(uop.valid for uop in self.fusion.uops)
+        decodeReady = Signal()
+
+        if self.uopCache:
+            m.submodules.uopCache = self.uopCache
             m.d.comb += [
-                # if the uop writes to a register, then we need to allocate
-                self.isAllocated[i].eq(decoder.valid[2]),
-
-                # Allocate the next register
-                # Will contain junk when this uop doesn't allocate
-                self.allocated[i].eq(self.nextFreeRegister + oldAllocatedCount),
-
-                # Keep track of how many we have allocated this cycle
-                allocatedCount.eq(oldAllocatedCount + self.isAllocated[i])
+                self.uopCache.d_data.eq(decoded),
+                self.uopCache.d_valid.eq(decodedValid),
+                self.uopCache.d_addr.eq(self.decodedAddr),
+                self.uopCache.d_next.eq(self.decodedNext),
+                self.uopCache.o_ready.eq(self.skid.i_ready),
+                self.skid.i_data.eq(self.uopCache.o_data),
+                self.skid.i_valid.eq(self.uopCache.o_valid),
+                decodeReady.eq(self.uopCache.d_ready),
+                self.redirect.eq(self.uopCache.redirect),
+                self.redirectAddr.eq(self.uopCache.redirectAddr),
+                self.uopCacheHit.eq(self.uopCache.hit),
+                self.uopCacheMiss.eq(self.uopCache.miss),
+            ]
+        else:
+            m.d.comb += [
+                self.skid.i_data.eq(decoded),
+                self.skid.i_valid.eq(decodedValid),
+                decodeReady.eq(self.skid.i_ready),
+                self.uopCacheMiss.eq(decodedValid & self.skid.i_ready),
             ]
 
-         # Increment the free register pointer
-        m.d.sync += self.nextFreeRegister.eq(self.nextFreeRegister + allocatedCount)
-
-
-        conflictables = []
-
-        # Every cycle, pull all read arch registers from the decoders and look them up in RAT
-        for i, decoder in enumerate(self.decoders):
-            regA_rat = Signal(self.width, name=f"decoder{i}_regA_RAT")
-            regB_rat = Signal(self.width, name=f"decoder{i}_regB_RAT")
+        m.d.comb += [
+            Cat(*[field for uop in self.uops for field in uop.fields()], self.thread).eq(self.skid.o_data),
+            self.inReady.eq(decodeReady),
+        ]
+        for decoder in self.decoders:
+            m.d.comb += decoder.ready.eq(decodeReady)
+        with m.If(decodeReady):
+            m.d.sync += [
+                self.decodedAddr.eq(self.inAddr),
+                self.decodedNext.eq(self.inNextAddr),
+                self.decodedThread.eq(self.inThread),
+            ]
 
-            # Read RAT entries for each input register
+        # Slots of the group still to be renamed
+        pending = [uop.valid & self.skid.o_valid for uop in self.uops]
+        if self.constrained:
+            pending = [valid & ~self.splitDone[i] for i, valid in enumerate(pending)]
+
+        ratA, ratB, fits = self.readSources(m, pending)
+
+        idioms = []
+        for i, uop in enumerate(self.uops):
+            m.d.comb += self.uopValid[i].eq(pending[i] & fits[i])
+            idioms += [(uop.move | uop.zero) if self.eliminate else Const(0)]
+
+        # Only take the next group if there is somewhere to put it, and enough registers for it
+        outputFree = ~treeOR(self.outValid) | self.outReady
+        if self.closedLoop:
+            enoughRegisters = popcount(valid & ~idiom for valid, idiom in zip(self.uopValid, idioms)) <= self.freeCount
+        else:
+            enoughRegisters = 1
+        if self.closedLoop and self.release == "retire":
+            # Somewhere to put the group in the retire queue
+            enoughRegisters &= self.retireCount < self.retireDepth
+        m.d.comb += self.advance.eq(outputFree & enoughRegisters)
+
+        if self.constrained:
+            # The group only leaves the skid buffer once its last slot has been renamed
+            allFit = ~treeOR(valid & ~fit for valid, fit in zip(pending, fits))
+            m.d.comb += [
+                self.skid.o_ready.eq(self.advance & allFit),
+                self.split.eq(self.advance & ~allFit),
+            ]
+            with m.If(self.advance & allFit):
+                m.d.sync += self.splitDone.eq(0)
+            with m.Elif(self.advance):
+                m.d.sync += self.splitDone.eq(self.splitDone | Cat(*self.uopValid))
+        else:
+            m.d.comb += self.skid.o_ready.eq(self.advance)
+
+        # Allocate a renaming register for each uop which needs it: from the pool in a closed loop
+        # (see allocatePool and refillPool), otherwise from a counter that never takes them back
+        for i in range(len(self.decoders)):
+            # if the uop writes to a register, then we need to allocate. Unless it's eliminated
             m.d.comb += [
-                self.gprRAT.read_addr[i * 2    ].eq(decoder.regA),
-                self.gprRAT.read_addr[i * 2 + 1].eq(decoder.regB),
-                regA_rat.eq(self.gprRAT.read_data[i * 2    ]),
-                regB_rat.eq(self.gprRAT.read_data[i * 2 + 1])
+                self.isWriter[i].eq(self.uopValid[i] & self.advance),
+                self.isAllocated[i].eq(self.isWriter[i] & ~idioms[i]),
+                self.fused[i].eq(self.isWriter[i] & self.uops[i].fused),
             ]
 
-            regA_final = regA_rat
-            regB_final = regB_rat
+        if self.closedLoop:
+            allocatedHot = self.allocatePool(m)
+        else:
+            for i in range(len(self.decoders)):
+                # Allocate the next register, skipping over any allocated by earlier uops this cycle
+                # Will contain junk when this uop doesn't allocate
+                m.d.comb += self.allocated[i].eq(self.nextFreeRegister + popcount(self.isAllocated[:i]))
+
+            # Increment the free register pointer by how many we have allocated this cycle
+            m.d.sync += self.nextFreeRegister.eq(self.nextFreeRegister + popcount(self.isAllocated))
+
+
+        # In the two stage renamer, the results of RAT lookup and allocation are registered
+        # before the dependency fix-up and RAT update, and held while it's stalled.
+        # With one stage the resolver is fed straight from lookup. It doesn't wait for advance,
+        # everything it drives (isWriter, updateEnabled, eliminated, the out registers) is qualified by advance instead
+        fixup = []
+
+        ratOut = []
+
+        fixup += [self.fixupThread.eq(self.thread)]
+
+        for i, uop in enumerate(self.uops):
+            # The resolver fixes up any dependencies on earlier uops in this group
+            fixup += [
+                self.resolver.regA[i].eq(uop.regA),
+                self.resolver.regB[i].eq(uop.regB),
+                self.resolver.regOut[i].eq(uop.regOut),
+                self.resolver.isAllocated[i].eq(self.uopValid[i]),
+                self.fixupAllocated[i].eq(self.allocated[i]),
+                self.fixupMove[i].eq(uop.move & idioms[i]),
+                self.fixupZero[i].eq(uop.zero & idioms[i]),
+                self.fixupValid[i].eq(self.uopValid[i] & ~idioms[i]),
+                self.fixupUnits[i].eq(uop.executionUnits),
+                self.fixupOpcode[i].eq(uop.opcode),
+            ]
 
-            # check for conflicts
-            for archRegId, decoderId in conflictables:
-                dependsA = Signal(name=f"decoder{i}A_depends_on_{decoderId}out")
-                dependsB = Signal(name=f"decoder{i}B_depends_on_{decoderId}out")
+            # Eliminated uops write whatever their source resolved to, so later uops in the group see through them
+            if self.eliminate:
+                m.d.comb += self.resolver.allocated[i].eq(
+                    Mux(self.fixupZero[i], 0, Mux(self.fixupMove[i], self.resolver.outA[i], self.fixupAllocated[i])))
+            else:
+                m.d.comb += self.resolver.allocated[i].eq(self.fixupAllocated[i])
 
-                outA = Signal(self.width, name=f"decoder{i}A_resloved{decoderId}")
-                outB = Signal(self.width, name=f"decoder{i}B_resloved{decoderId}")
+            if self.closedLoop:
+                regOut_rat = Signal(self.width, name=f"decoder{i}_regOut_RAT")
                 m.d.comb += [
-                    # Check if input registers match the output of a previous uop this cycle
-                    dependsA.eq((decoder.regA == archRegId) & self.isAllocated[decoderId]),
-                    dependsB.eq((decoder.regB == archRegId) & self.isAllocated[decoderId]),
-
-                    # select correct renaming id
-                    outA.eq(Mux(dependsA, self.allocated[decoderId], regA_final)),
-                    outB.eq(Mux(dependsB, self.allocated[decoderId], regB_final))
+                    self.gprRAT.read_addr[self.sourcePorts + i].eq(self.ratAddr(uop.regOut, self.thread)),
+                    regOut_rat.eq(self.gprRAT.read_data[self.sourcePorts + i]),
                 ]
+                ratOut += [regOut_rat]
 
-                # Accumulate mux chains
-                regA_final = outA
-                regB_final = outB
+        if self.stages == 1:
+            m.d.comb += fixup
+        else:
+            with m.If(self.advance):
+                m.d.sync += fixup
 
-            m.d.sync += [
-                self.outA[i].eq(regA_final),
-                self.outB[i].eq(regB_final),
-                self.outOut[i].eq(self.allocated[i]),
-                # All uops must write to a renaming reg to be valid
-                self.outValid[i].eq(decoder.valid[2])
+        if self.stages == 1:
+            for i in range(len(self.decoders)):
+                m.d.comb += [
+                    self.resolver.ratA[i].eq(ratA[i]),
+                    self.resolver.ratB[i].eq(ratB[i]),
+                ]
+                if self.closedLoop:
+                    m.d.comb += self.oldMapping[i].eq(ratOut[i])
+        else:
+            # The group in the lookup stage reads the RAT before the group in the fix-up stage
+            # has written its results back, so forward those writes before registering.
+            # Just like the RAT update, the last writer in that group wins.
+            # Everything here comes straight out of registers, so it runs in parallel with the RAT read
+            for i, uop in enumerate(self.uops):
+                lookups = [(uop.regA, ratA[i], self.resolver.ratA[i], "A"),
+                           (uop.regB, ratB[i], self.resolver.ratB[i], "B")]
+                if self.closedLoop:
+                    lookups += [(uop.regOut, ratOut[i], self.oldMapping[i], "Out")]
+
+                for src, rat, resolved, nnn in lookups:
+                    forwarded = rat
+                    for j in range(len(self.decoders)):
+                        inFlight = Signal(name=f"decoder{i}{nnn}_forward_from_{j}")
+                        m.d.comb += inFlight.eq((src == self.resolver.regOut[j]) & self.resolver.isAllocated[j] & (self.thread == self.fixupThread))
+                        forwarded = Mux(inFlight, self.resolver.allocated[j], forwarded)
+
+                    with m.If(self.advance):
+                        m.d.sync += resolved.eq(forwarded)
+
+        for i in range(len(self.decoders)):
+            # In the two stage renamer the fix-up stage holds its group while stalled, so it mustn't update the RAT until it moves on
+            m.d.comb += [
+                self.updateEnabled[i].eq(self.resolver.updateEnabled[i] & self.advance),
+                self.eliminated[i].eq((self.fixupMove[i] | self.fixupZero[i]) & self.resolver.isAllocated[i] & self.advance),
             ]
 
-            # Each decoder down the chain needs to check for more and more conflicts
-            conflictables += [(decoder.regOut, i)]
-
-        # Find which outputs are written to more than once in a single cycle
-        # We need to update the RAT only once for each ArchReg
-        suppressables = []
-        for i, decoder in reversed(list(enumerate(self.decoders))):
-
-            enableChain = self.isAllocated[i]
-
-            # This works in reverse to conflicts. the last uop can't be suppressed by anything
-            for archRegId, decoderId in suppressables:
-                enabled = Signal(name=f"is_{i}_enabled{decoderId}")
-                m.d.comb += enabled.eq((~self.isAllocated[decoderId] | (decoder.regOut != archRegId)) & enableChain)
-                enableChain = enabled
-
-            m.d.comb += self.updateEnabled[i].eq(enableChain)
-            suppressables += [(decoder.regOut, i)]
+            with m.If(self.advance):
+                m.d.sync += [
+                    self.outA[i].eq(self.resolver.outA[i]),
+                    self.outB[i].eq(self.resolver.outB[i]),
+                    self.outOut[i].eq(self.resolver.allocated[i]),
+                    self.outValid[i].eq(self.fixupValid[i]),
+                    self.outUnits[i].eq(self.fixupUnits[i]),
+                    self.outOpcode[i].eq(self.fixupOpcode[i]),
+                    self.outEliminated[i].eq(self.eliminated[i]),
+                    self.outThread.eq(self.fixupThread),
+                ]
+            with m.Elif(self.outReady):
+                m.d.sync += [
+                    self.outValid[i].eq(0),
+                    self.outEliminated[i].eq(0),
+                ]
 
         # Update RAT with all write arch registers
         # TODO: need an unwinding mode which updates the RAT back to the required state
-        for i, decoder in enumerate(self.decoders):
+        for i in range(len(self.decoders)):
             m.d.comb += [
-                self.gprRAT.write_addr[i].eq(decoder.regOut),
-                self.gprRAT.write_data[i].eq(self.allocated[i]),
+                self.gprRAT.write_addr[i].eq(self.ratAddr(self.resolver.regOut[i], self.fixupThread)),
+                self.gprRAT.write_data[i].eq(self.resolver.allocated[i]),
                 self.gprRAT.write_enable[i].eq(self.updateEnabled[i])
             ]
 
         # TODO: Write some kind of data structure to allow rewinding
         #       Prehaps a list of
 
+        if self.closedLoop:
+            self.refillPool(m, allocatedHot)
+
         return m
 
+    def ratAddr(self, reg, thread):
+        # Each thread's RAT is its own range of gprRAT
+        return Cat(reg[:self.archBits], thread)
+
+    def readSources(self, m, pending):
+        # Every cycle, pull all read arch registers from the decoders and look them up in RAT.
+        # Returns the lookups for A and B, and whether each slot fits in the read ports this cycle
+        ratA = [Signal(self.width, name=f"decoder{i}_regA_RAT") for i in range(len(self.uops))]
+        ratB = [Signal(self.width, name=f"decoder{i}_regB_RAT") for i in range(len(self.uops))]
+        reads = [(self.ratAddr(reg, self.thread), rat) for uop, a, b in zip(self.uops, ratA, ratB) for reg, rat in ((uop.regA, a), (uop.regB, b))]
+
+        if not self.constrained:
+            # A port for every source
+            for k, (reg, rat) in enumerate(reads):
+                m.d.comb += [
+                    self.gprRAT.read_addr[k].eq(reg),
+                    rat.eq(self.gprRAT.read_data[k]),
+                ]
+            return ratA, ratB, [Const(1)] * len(self.uops)
+
+        # A read needs a port of its own unless an earlier read in the group is of the same register
+        unique = []
+        for k, (reg, _) in enumerate(reads):
+            first = Signal(name=f"read_{k}_unique")
+            m.d.comb += first.eq(pending[k // 2] & ~treeOR(pending[j // 2] & (reads[j][0] == reg) for j in range(k)))
+            unique += [first]
+
+        # The Nth unique read goes to the Nth port
+        for p in range(self.sourcePorts):
+            m.d.comb += self.gprRAT.read_addr[p].eq(
+                treeOR(Mux(unique[k] & (popcount(unique[:k]) == p), reads[k][0], 0) for k in range(p, len(reads))))
+
+        # Crossbar: each read takes the data from a port reading its register.
+        # Idle ports read register zero, which is fine as any port reading a register returns the same data
+        for reg, rat in reads:
+            m.d.comb += rat.eq(treeOR(Mux(self.gprRAT.read_addr[p] == reg, self.gprRAT.read_data[p], 0) for p in range(self.sourcePorts)))
+
+        # Slots fit up to the last one whose reads are all within the ports
+        fits = []
+        for i in range(len(self.uops)):
+            fit = Signal(name=f"decoder{i}_fits_RAT")
+            m.d.comb += fit.eq(popcount(unique[:i * 2 + 2]) <= self.sourcePorts)
+            fits += [fit]
+
+        return ratA, ratB, fits
+
+    def allocatePool(self, m):
+        # The Nth uop to allocate this cycle takes the Nth free register in the pool
+        m.submodules.pool = self.pool
+        m.d.comb += self.pool.input.eq(~self.live)
+
+        allocatedHot = []
+        for i in range(len(self.decoders)):
+            hot = Signal(self.numRegs, name=f"allocated_{i}_hot")
+            rank = popcount(self.isAllocated[:i])
+            m.d.comb += hot.eq(Mux(self.isAllocated[i], treeOR(Mux(rank == k, self.pool.outHot[k], 0) for k in range(i + 1)), 0))
+
+            m.submodules[f"allocated_encoder_{i}"] = encoder = coding.Encoder(self.numRegs)
+            m.d.comb += [
+                encoder.i.eq(hot),
+                self.allocated[i].eq(encoder.o),
+            ]
+            allocatedHot += [hot]
+
+        m.d.comb += self.freeCount.eq(popcount(~self.live))
+
+        return treeOR(allocatedHot)
+
+    def refillPool(self, m, allocatedHot):
+        # Uops which update the RAT release the register they replace.
+        # Uops overwritten by a later uop in the same group never make it into the RAT, so they release their own
+        releases = []
+        for i in range(len(self.decoders)):
+            release = Signal(self.width, name=f"release_{i}")
+            m.d.comb += release.eq(Mux(self.resolver.isAllocated[i] & self.advance,
+                Mux(self.updateEnabled[i], self.oldMapping[i], self.resolver.allocated[i]), 0))
+            releases += [release]
+
+        if self.release == "retire":
+            releases = self.retire(m, releases)
+
+        Released = []
+        Referenced = []
+        for i, release in enumerate(releases):
+            writes = self.resolver.isAllocated[i] & self.advance
+
+            m.submodules[f"release_decoder_{i}"] = releaseDecoder = coding.Decoder(self.numRegs)
+            m.d.comb += releaseDecoder.i.eq(release)
+            Released += [Mux(release != 0, releaseDecoder.o, 0)]
+
+            if self.eliminate:
+                m.submodules[f"reference_decoder_{i}"] = referenceDecoder = coding.Decoder(self.numRegs)
+                m.d.comb += referenceDecoder.i.eq(self.resolver.allocated[i])
+                Referenced += [Mux(writes, referenceDecoder.o, 0)]
+
+        Completed = []
+        for i, complete in enumerate(self.complete):
+            m.submodules[f"complete_decoder_{i}"] = completeDecoder = coding.Decoder(self.numRegs)
+            m.d.comb += completeDecoder.i.eq(complete)
+            Completed += [completeDecoder.o]
+
+        # Newly allocated registers start again from scratch.
+        # But a register can be released in the same cycle it's allocated, if it's overwritten within the group
+        done = (self.done & ~allocatedHot) | treeOR(Completed)
+
+        if self.eliminate:
+            # Every RAT write references what it writes and releases what it replaces (or itself, if overwritten)
+            unreferenced = []
+            for r in range(1, self.numRegs):
+                refs = self.refs[r] + popcount(hot[r] for hot in Referenced) - popcount(hot[r] for hot in Released)
+                m.d.sync += self.refs[r].eq(refs)
+                unreferenced += [refs == 0]
+            superseded = Cat(Const(0), *unreferenced)
+        else:
+            superseded = (self.superseded & ~allocatedHot) | treeOR(Released)
+            m.d.sync += self.superseded.eq(superseded)
+
+        free = superseded & done
+        if self.release == "readers":
+            free &= self.unread(m)
+
+        m.d.sync += [
+            self.done.eq(done),
+            self.live.eq(((self.live | allocatedHot) & ~free) | 1),
+        ]
+
+    def retire(self, m, releases):
+        # Queues up each renamed group's releases, and returns the releases of the group retiring this cycle:
+        # the oldest, once every register it allocated has been written
+        m.submodules.retireQueue = queue = self.retireQueue
+        waits = [Mux(self.fixupValid[i] & self.resolver.isAllocated[i] & self.advance, self.fixupAllocated[i], 0)
+                 for i in range(len(self.decoders))]
+        push = treeOR(reg != 0 for reg in waits + releases)
+
+        head = queue.read_data[0]
+        headWaits = [head[i * self.width:(i + 1) * self.width] for i in range(len(self.decoders))]
+        headReleases = [head[(len(self.decoders) + i) * self.width:(len(self.decoders) + i + 1) * self.width] for i in range(len(self.decoders))]
+        pop = Signal()
+        m.d.comb += pop.eq((self.retireCount != 0) & treeAND(self.done.bit_select(reg, 1) | (reg == 0) for reg in headWaits))
+
+        wrap = lambda pointer: Mux(pointer == self.retireDepth - 1, 0, pointer + 1)
+        m.d.comb += [
+            queue.read_addr[0].eq(self.retireHead),
+            queue.write_addr[0].eq(self.retireTail),
+            queue.write_data[0].eq(Cat(*waits, *releases)),
+            queue.write_enable[0].eq(push),
+        ]
+        with m.If(push):
+            m.d.sync += self.retireTail.eq(wrap(self.retireTail))
+        with m.If(pop):
+            m.d.sync += self.retireHead.eq(wrap(self.retireHead))
+        m.d.sync += self.retireCount.eq(self.retireCount + push - pop)
+
+        return [Mux(pop, reg, 0) for reg in headReleases]
+
+    def unread(self, m):
+        # Counts each register's readers, returning a bit for every register that has none left after this cycle
+        Reading = []
+        for i in range(len(self.decoders)):
+            for src, name in ((self.resolver.outA[i], "A"), (self.resolver.outB[i], "B")):
+                m.submodules[f"reader_decoder_{i}{name}"] = readerDecoder = coding.Decoder(self.numRegs)
+                m.d.comb += readerDecoder.i.eq(src)
+                Reading += [Mux(self.fixupValid[i] & self.resolver.isAllocated[i] & self.advance, readerDecoder.o, 0)]
+
+        Read = []
+        for k, read in enumerate(self.read):
+            m.submodules[f"read_decoder_{k}"] = readDecoder = coding.Decoder(self.numRegs)
+            m.d.comb += readDecoder.i.eq(read)
+            Read += [Mux(read != 0, readDecoder.o, 0)]
+
+        unread = []
+        for r in range(1, self.numRegs):
+            readers = self.readers[r] + popcount(hot[r] for hot in Reading) - popcount(hot[r] for hot in Read)
+            m.d.sync += self.readers[r].eq(readers)
+            unread += [readers == 0]
+        return Cat(Const(1), *unread)
+
 from nmigen.back.pysim import *
 
 def printState(renamer):
@@ -0,0 +1,487 @@
+import math
+import random
+import time
+
+from nmigen.back.pysim import Simulator, Settle, Tick
+from decoder import opcodes, fusedOpcodes, uopOpcodes, moveOpcodes, zeroOpcodes
+from matrixScheduler import FlatMatrix
+
+# Sampled simulation of the closed loop Core
+#
+# Simulating a whole program cycle by cycle on the RTL is too slow. sampleCore runs a python model of
+# the core (CoreModel) through the program instead, and only hands over to the RTL for a short detailed
+# window at a few sample points spread through the program:
+#   fast-forward: the model just moves through the instructions, keeping track of which arch registers
+#     share a renaming register (or are zero) and nothing else
+#   warming: the model's timing mode for at least the last thousand or so instructions before the sample point,
+#     which leaves uops in flight: waiting in the matrix, in the execution pipelines and on their way out of rename.
+#     It starts from a drained machine, which takes a while to wear off with a big window, so when the next
+#     point is closer than that the model just keeps timing from one point to the next
+#   injection: the model's state is written straight into the RTL's registers and memories: gprRAT, the
+#     register pool, Matrix rows, waiting_for_select, the scoreboard, the opcodes, the execution pipelines
+#     and the fetch address. The front end starts out empty
+#   detailed window: a few instructions while the front end fills, then the measured instructions
+#
+# The measured windows are combined into an IPC estimate with a confidence interval, see estimate.
+# One Simulator is reused for every window, as building it takes longer than most windows.
+
+# A uop after decode and fusion. idiom is "move", "zero" or None
+class _Uop:
+    def __init__(self, opcode, out, a, b, idiom=None, fused=False):
+        self.opcode = opcode
+        self.out = out
+        self.a = a
+        self.b = b
+        self.idiom = idiom
+        self.fused = fused
+
+latencies = {opcode: latency for opcode, _, latency in uopOpcodes.values()}
+units = {opcode: executionUnits for opcode, executionUnits, _ in uopOpcodes.values()}
+
+
+class CoreModel:
+    # Python model of Core, cycle for cycle with the RTL in the configurations sampleCore supports: one thread,
+    # MatrixScheduler with position select and no replay, single stage rename with a RAT port for every source,
+    # no uop cache. Fusion and move elimination follow Impl like the RTL does.
+    #
+    # The front end is assumed to hand rename a group every cycle it can take one, except for refill
+    # cycles after the model state has been injected, where the RTL's front end is still filling.
+    #
+    # fastForward moves through the program without timing. startTiming switches to the timing model
+    # from a drained machine, step runs it a cycle at a time and stopTiming drains it again (instantly).
+
+    def __init__(self, Impl, Arch, trace):
+        assert getattr(Impl, "Threads", 1) == 1, "no SMT"
+        assert getattr(Impl, "Scheduler", "matrix") == "matrix", "only the MatrixScheduler"
+        assert getattr(Impl, "Select", "position") == "position" and not getattr(Impl, "Replay", False), "only position select, no replay"
+        assert not getattr(Impl, "UopCacheEntries", 0), "no uop cache"
+        assert getattr(Impl, "RenameStages", 1) == 1, "single stage rename only"
+        assert getattr(Impl, "RATReadPorts", Impl.NumDecodes * 2) >= Impl.NumDecodes * 2, "RAT read ports for every source"
+        assert getattr(Impl, "RegisterRelease", "complete") == "complete", "registers go back once superseded and written"
+        assert getattr(Impl, "ComplexDecoders", Impl.NumDecodes) == Impl.NumDecodes, "every decoder complex"
+
+        self.trace = trace
+        self.NumDecodes = Impl.NumDecodes
+        self.NumIssues = Impl.NumIssues
+        self.numRegs = Impl.numRenamingRegisters
+        self.eliminate = getattr(Impl, "MoveElimination", True)
+        self.rules = [fusedOpcodes[name] for name in getattr(Impl, "FusionRules", fusedOpcodes)]
+
+        self.pc = 0           # Next group to rename
+        self.instructions = 0 # Instructions renamed (or gone by in fast-forward) so far
+        self.timing = False
+
+        # Fast-forward state: what's in each arch register, None for zero. Registers with the same
+        # value share a renaming register
+        self.values = [None] * Arch.NumGPR
+        self.nextValue = 0
+
+        # Counters of the timing model, like the Core's
+        self.cycles = 0
+        self.completed = 0
+        self.eliminated = 0
+        self.fused = 0
+
+    def decode(self):
+        # The group at pc, after fusion. Slots left empty by fusion are None
+        insts = [self.trace[(self.pc + i) % len(self.trace)] for i in range(self.NumDecodes)]
+
+        uops = []
+        consumed = False # Second half of the pair before
+        for i, inst in enumerate(insts):
+            if consumed:
+                uops += [None]
+                consumed = False
+                continue
+
+            opcode = opcodes[inst.op][0]
+            idiom = None
+            if inst.a == inst.b:
+                idiom = "move" if opcode in moveOpcodes else "zero" if opcode in zeroOpcodes else None
+            uop = _Uop(opcode, inst.out, inst.a, inst.b, idiom)
+
+            if i + 1 < len(insts) and idiom is None:
+                second = insts[i + 1]
+                dependent = second.out == inst.out and second.a == inst.out and second.b in (inst.out, inst.a, inst.b)
+                for fusedOpcode, _, _, firstName, secondName in self.rules:
+                    if dependent and (inst.op, second.op) == (firstName, secondName):
+                        uop = _Uop(fusedOpcode, inst.out, inst.a, inst.b, fused=True)
+                        consumed = True
+            uops += [uop]
+        return uops
+
+    def nextGroup(self):
+        self.pc = (self.pc + self.NumDecodes) % len(self.trace)
+        self.instructions += self.NumDecodes
+
+    def fastForward(self, instructions):
+        # Moves on by whole groups until at least this many instructions have gone by
+        assert not self.timing
+        target = self.instructions + instructions
+        while self.instructions < target:
+            for uop in self.decode():
+                if uop is None:
+                    continue
+                if self.eliminate and uop.idiom == "move":
+                    self.values[uop.out] = self.values[uop.a]
+                elif self.eliminate and uop.idiom == "zero":
+                    self.values[uop.out] = None
+                else:
+                    self.values[uop.out] = self.nextValue
+                    self.nextValue += 1
+            self.nextGroup()
+
+    def startTiming(self):
+        # Every value gets a renaming register of its own, and nothing is in flight
+        assert not self.timing
+        self.timing = True
+
+        registers = {}
+        for value in self.values:
+            if value is not None and value not in registers:
+                registers[value] = len(registers) + 1
+        assert len(registers) < self.numRegs, "more live values than renaming registers"
+
+        self.rat = [registers[value] if value is not None else 0 for value in self.values]
+        self.refs = [0] * self.numRegs
+        for register in self.rat:
+            self.refs[register] += 1
+        self.superseded = [register not in self.rat for register in range(self.numRegs)]
+        self.done = [True] * self.numRegs
+        self.live = [r == 0 or self.refs[r] > 0 for r in range(self.numRegs)]
+
+        self.renamed = []     # (id, uop) renamed last cycle, going into the scheduler this cycle
+        self.waiting = {}     # id -> producers still to complete, for uops in the matrix waiting for select
+        self.inFlight = set() # In the scheduler and not completed: clear in the scoreboard
+        self.executing = []   # (id, port, latency, cycle issued)
+        self.opcodes = {}     # id -> opcode, for uops in the scheduler
+        self.refill = 0       # Cycles before the front end delivers again
+
+    def stopTiming(self):
+        # Everything in flight completes at once, which keeps only the RAT
+        assert self.timing
+        self.timing = False
+        self.values = [("register", register) if register else None for register in self.rat]
+
+    def run(self, instructions):
+        # Timing model until at least this many more instructions have been renamed
+        target = self.instructions + instructions
+        while self.instructions < target:
+            self.step()
+
+    def step(self):
+        assert self.timing
+        cycle = self.cycles
+
+        # Select the lowest numbered waiting uops whose producers have all completed
+        selected = sorted(id for id, producers in self.waiting.items() if not producers)[:self.NumIssues]
+        for port, id in enumerate(selected):
+            del self.waiting[id]
+            self.executing += [(id, port, latencies.get(self.opcodes[id], min(latencies.values())), cycle)]
+
+        # A uop with latency N issued in cycle t completes in cycle t + N - 1
+        cleared = {id for id, _, latency, issued in self.executing if issued + latency - 1 == cycle}
+        self.executing = [entry for entry in self.executing if entry[0] not in cleared]
+
+        # Insert last cycle's group. Producers completing this cycle have been bypassed, ones going in alongside haven't
+        inserting = {id for id, _ in self.renamed}
+        for id, uop in self.renamed:
+            self.waiting[id] = {source for source in (uop.a, uop.b) if source and source != id and
+                                (source in inserting or (source in self.inFlight and source not in cleared))}
+            self.opcodes[id] = uop.opcode
+        self.inFlight = (self.inFlight - cleared) | inserting
+        for producers in self.waiting.values():
+            producers -= cleared
+
+        self.rename(cleared)
+        self.completed += len(cleared)
+        self.cycles += 1
+
+    def rename(self, cleared):
+        self.renamed = []
+        allocated = set()
+
+        uops = [uop for uop in self.decode() if uop is not None] if self.refill == 0 else []
+        self.refill = max(self.refill - 1, 0)
+        allocating = [uop for uop in uops if not (self.eliminate and uop.idiom)]
+        free = [r for r in range(self.numRegs) if not self.live[r]]
+
+        # The whole group goes, or none of it. Renaming in order against a RAT updated as it goes is the
+        # same as the RTL's in group forwarding
+        if uops and len(allocating) <= len(free):
+            for uop in uops:
+                a, b, old = self.rat[uop.a], self.rat[uop.b], self.rat[uop.out]
+                if self.eliminate and uop.idiom:
+                    register = a if uop.idiom == "move" else 0
+                    self.eliminated += 1
+                else:
+                    register = free.pop(0)
+                    allocated.add(register)
+                    self.done[register] = False
+                    self.superseded[register] = False
+                    self.renamed += [(register, _Uop(uop.opcode, register, a, b))]
+
+                self.refs[register] += 1
+                self.refs[old] -= 1
+                self.superseded[old] = True
+                self.rat[uop.out] = register
+                self.fused += uop.fused
+            self.nextGroup()
+
+        # Back in the pool once superseded and completed, from next cycle
+        for id in cleared:
+            self.done[id] = True
+        for r in range(1, self.numRegs):
+            superseded = self.refs[r] == 0 if self.eliminate else self.superseded[r]
+            self.live[r] = (self.live[r] or r in allocated) and not (superseded and self.done[r])
+
+
+def _bits(flags):
+    return sum(1 << i for i, flag in enumerate(flags) if flag)
+
+def inject(core, model):
+    # Commands for a pysim process that put the timing model's state into the Core, which then carries on from
+    # there. The front end is emptied and refetches from the model's next group, which takes the RTL 3 cycles
+    # (fetch, decode, skid buffer) before rename sees it again
+    renamer = core.renamer
+    scheduler = core.scheduler
+    model.refill = 3
+
+    # Straight after a Tick this cycle's register updates haven't landed yet, and would overwrite everything
+    yield Settle()
+
+    yield core.fetch.pc.eq(model.pc)
+    for valid in core.fetch.valid:
+        yield valid.eq(0)
+    for decoder in renamer.decoders:
+        yield decoder.valid.eq(0)
+    yield renamer.skid.o_valid.eq(0)
+    yield renamer.skid.skid_valid.eq(0)
+
+    # RAT and register pool
+    for reg, register in enumerate(model.rat):
+        yield from renamer.gprRAT.simWrite(reg, register)
+    yield renamer.live.eq(_bits(model.live))
+    yield renamer.done.eq(_bits(model.done))
+    if renamer.eliminate:
+        for refs, count in zip(renamer.refs, model.refs):
+            yield refs.eq(count)
+    else:
+        yield renamer.superseded.eq(_bits(model.superseded))
+
+    # Last cycle's group, on its way into the scheduler
+    for i in range(len(renamer.outValid)):
+        id, uop = model.renamed[i] if i < len(model.renamed) else (0, _Uop(0, 0, 0, 0))
+        yield renamer.outValid[i].eq(i < len(model.renamed))
+        yield renamer.outOut[i].eq(id)
+        yield renamer.outA[i].eq(uop.a)
+        yield renamer.outB[i].eq(uop.b)
+        yield renamer.outOpcode[i].eq(uop.opcode)
+        yield renamer.outUnits[i].eq(units.get(uop.opcode, 0))
+        yield renamer.outEliminated[i].eq(0)
+
+    # Scheduler: a matrix row for each uop waiting for select, with a bit for each producer still to complete
+    matrix = scheduler.matrix
+    rows = [_bits(r in model.waiting[id] for r in range(matrix.size)) if id in model.waiting else 0 for id in range(matrix.size)]
+    if isinstance(matrix, FlatMatrix):
+        yield matrix.values.eq(sum(row << id * matrix.size for id, row in enumerate(rows)))
+    else:
+        for row in matrix.rows:
+            yield row.values.eq(rows[row.id])
+    yield scheduler.waiting_for_select.eq(_bits(id in model.waiting for id in range(matrix.size)))
+    yield scheduler.scoreboard.completed.eq(_bits(id not in model.inFlight for id in range(matrix.size)))
+
+    # Execution: the opcodes and every pipeline stage
+    for id, opcode in model.opcodes.items():
+        yield from core.opcodes.simWrite(id, opcode)
+    stages = {(port, latency, model.cycles - 1 - issued): id for id, port, latency, issued in model.executing}
+    for p, port in enumerate(core.ports):
+        for latency, pipeline in port.stages.items():
+            for stage, delayed in enumerate(pipeline):
+                yield delayed.eq(stages.get((p, latency, stage), 0))
+
+
+# Two sided 95% points of Student's t, by degrees of freedom
+_t95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131,
+        2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+def estimate(windows):
+    # IPC of the whole program from (uops, cycles) for each window.
+    # The sample points are spread evenly over the instructions, and each window is (about) the same number of
+    # instructions, so it's the windows' CPI that gets averaged. The 95% confidence interval on that mean CPI is
+    # turned into one on IPC. (Windows of the same number of cycles would cover more instructions where IPC
+    # is high, and run over into whatever comes next more often there)
+    cpis = [cycles / uops for uops, cycles in windows]
+    n = len(cpis)
+    mean = sum(cpis) / n
+    if n < 2:
+        return {"ipc": 1 / mean, "low": 0.0, "high": math.inf, "samples": n}
+
+    deviation = math.sqrt(sum((cpi - mean) ** 2 for cpi in cpis) / (n - 1))
+    halfWidth = (_t95[n - 2] if n - 1 <= len(_t95) else 1.96) * deviation / math.sqrt(n)
+    return {
+        "ipc": 1 / mean,
+        "low": 1 / (mean + halfWidth),
+        "high": 1 / (mean - halfWidth) if mean > halfWidth else math.inf,
+        "samples": n,
+    }
+
+
+def sampleCore(core, Impl, Arch, trace, samples=10, warmInstructions=1500, warmup=60, length=150, passes=1, seed=0):
+    # Estimates the IPC of passes passes through trace (the program the Core was built with, which fetch
+    # loops around) from samples detailed windows, each warmup instructions followed by length measured ones.
+    # Returns estimate's dict plus windows ((uops, cycles) for each sample) and seconds
+    start = time.perf_counter()
+    rng = random.Random(seed)
+    model = CoreModel(Impl, Arch, trace)
+    counters = [core.completed, core.eliminated, core.fused]
+    windows = []
+
+    def uops():
+        yield Settle()
+        total = 0
+        for counter in counters:
+            total += yield counter
+        return total
+
+    def runFor(instructions):
+        # Cycles until at least this many more instructions have completed (or been eliminated), and how many did
+        first = yield from uops()
+        cycles = 0
+        while (yield from uops()) - first < instructions:
+            yield Tick()
+            cycles += 1
+        return (yield from uops()) - first, cycles
+
+    def process():
+        interval = len(trace) * passes // samples
+        for k in range(samples):
+            # One sample point somewhere in each interval. Evenly spaced points can all land in the same
+            # phase of a program that repeats itself
+            point = k * interval + rng.randrange(interval)
+            if model.timing and point - warmInstructions > model.instructions:
+                model.stopTiming()
+            if not model.timing:
+                model.fastForward(max(point - warmInstructions - model.instructions, 0))
+                model.startTiming()
+            model.run(max(point - model.instructions, 0))
+
+            # The model carries on from here, without the front end refill inject sets up for the RTL
+            refill = model.refill
+            yield from inject(core, model)
+            model.refill = refill
+
+            yield from runFor(warmup)
+            windows.append((yield from runFor(length)))
+
+    sim = Simulator(core)
+    sim.add_clock(1e-6)
+    sim.add_process(process)
+    sim.run()
+
+    result = estimate(windows)
+    result["windows"] = windows
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def runModel(Impl, Arch, trace, length):
+    # The model's timing mode on its own, from a drained machine until length instructions have been renamed.
+    # Returns cycles, ipc and seconds like runProgram
+    start = time.perf_counter()
+    model = CoreModel(Impl, Arch, trace)
+    model.startTiming()
+    model.run(length)
+    return {
+        "cycles": model.cycles,
+        "ipc": (model.completed + model.eliminated + model.fused) / model.cycles,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def runProgram(core, length):
+    # Detailed simulation from reset until length instructions have completed (or been eliminated), which
+    # is one pass through the program for its length, more for more. Returns cycles, ipc and seconds
+    start = time.perf_counter()
+    stats = {}
+
+    def process():
+        cycles = 0
+        uops = 0
+        while uops < length:
+            yield Tick()
+            cycles += 1
+            uops = (yield core.completed) + (yield core.eliminated) + (yield core.fused)
+        stats["cycles"] = cycles
+
+    sim = Simulator(core)
+    sim.add_clock(1e-6)
+    sim.add_process(process)
+    sim.run()
+
+    stats["ipc"] = length / stats["cycles"]
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def checkLockstep(Impl, Arch, trace, warmInstructions=300, cycles=200):
+    # Injects a warmed model into the RTL, then runs both side by side and counts the cycles where they
+    # issue something different. Anything but 0 means the model (or the injection) is off
+    from core import Core
+    from traceSim import program
+
+    core = Core(Impl, Arch, program(trace))
+    model = CoreModel(Impl, Arch, trace)
+    mismatches = []
+
+    def process():
+        # The RTL runs on its own for a while first, so injection has to replace whatever state it got to
+        for _ in range(50):
+            yield Tick()
+
+        model.fastForward(len(trace) // 3)
+        model.startTiming()
+        model.run(warmInstructions)
+        yield from inject(core, model)
+        for cycle in range(cycles):
+            yield Settle()
+            issued = []
+            for ready, readyValid in zip(core.scheduler.ready, core.scheduler.readyValid):
+                if (yield readyValid):
+                    issued += [(yield ready)]
+            expected = sorted(id for id, producers in model.waiting.items() if not producers)[:model.NumIssues]
+            if issued != expected:
+                mismatches.append((cycle, issued, expected))
+            model.step()
+            yield Tick()
+
+    sim = Simulator(core)
+    sim.add_clock(1e-6)
+    sim.add_process(process)
+    sim.run()
+    return mismatches
+
+
+if __name__ == "__main__":
+    import sys
+    from core import Core, Impl, Arch
+    from traceSim import mixedTrace, program
+
+    # python sampledSim.py test: the model against the RTL, cycle for cycle after injection
+    if sys.argv[1:] == ["test"]:
+        class Small(Impl):
+            numRenamingRegisters = 40 # Rename stalls on registers a lot
+
+        class Large(Impl):
+            numRenamingRegisters = 128 # Rename hardly ever stalls
+            FlatMatrix = True
+
+        for name, impl in [("default", Impl()), ("40 registers", Small()), ("128 registers", Large())]:
+            for seed in range(2):
+                mismatches = checkLockstep(impl, Arch(), mixedTrace(1000, seed=seed))
+                print(f"{name}, seed {seed}: {'ok' if not mismatches else f'{len(mismatches)} cycles differ, first {mismatches[0]}'}")
+        sys.exit()
+
+    trace = mixedTrace(2000)
+    result = sampleCore(Core(Impl(), Arch(), program(trace)), Impl(), Arch(), trace)
+    print(f"sampled IPC {result['ipc']:.2f} ({result['low']:.2f} - {result['high']:.2f}) in {result['seconds']:.1f}s")
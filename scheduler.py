@@ -1,7 +1,10 @@
 from nmigen import *
 from nmigen.cli import main
 from multiMem import MultiMem
+from bankedMem import BankedMem
+from buildCache import cached
 from renamer import Renamer
+from util import *
 
 class Scheduler(Elaboratable):
     # Takes the output from renamer, stores it in a queue until all dependencies are met
@@ -24,21 +27,48 @@ class Scheduler(Elaboratable):
         self.inOut = [Signal(width, name=f"inOut_{i}") for i in range(Impl.NumDecodes)]
         self.inValid = [Signal(name=f"inValid_{i}") for i in range(Impl.NumDecodes)]
 
+        # Squashes every uop in the set in one cycle, like MatrixScheduler.flush_hot
+        self.flush_hot = Signal(Impl.numRenamingRegisters)
+
+        # The mapping table can't be rewritten in bulk, so squashed entries are masked instead:
+        # they read as completed (so nothing waits on them) and never wake up, until they're created again
+        self.squashed = Signal(Impl.numRenamingRegisters)
+
         # Mapping table as described in "Direct Instruction Wakeup for Out-of-Order Processors" (iwia04.pdf)
 
         # Status, tracks how many depentants each uop has
-        # This needs way more reads/writes than other parts of the table
-        self.MappingTableStatus = MultiMem(
+        # This needs way more reads/writes than other parts of the table.
+        #
+        # So much so that it can instead be split into banks by the low bits of the renaming ID, each with
+        # only a few ports (Impl.StatusBanks). Then:
+        #  * new entries aren't written, they're marked in fresh and read as 0 until their first write
+        #  * as much of the group is taken as is sure to get ports, after the wakeup writes from last cycle.
+        #    The rest isn't taken (stall), the renamer offers it again next cycle
+        #  * wakeups get whatever read ports the group left, and try again next cycle if there weren't any
+        self.banked = getattr(Impl, "StatusBanks", 0) > 0
+        statusPorts = dict(
             width=2, # 0 = No dependents, 1 = One dependent, 2 = Multiple dependents, 3 = completed
             depth=Impl.numRenamingRegisters,
             readPorts=Impl.NumDecodes * 2 + self.NumWakeupChecks, # Each new uop needs to update the status of both it's arguments.
                                                             # Each wakeup check needs to check the status it's other arg
-            writePorts=Impl.NumDecodes * 3 + Impl.NumIssues,  # Each new uop needs to set the new status of itself and both it's arguments
-                                                              # Each issue needs to update the status to completed
+            writePorts=Impl.NumDecodes * (2 if self.banked else 3) + Impl.NumIssues,  # Each new uop needs to set the new status of itself and both it's arguments
+                                                                                      # Each issue needs to update the status to completed
             init=[3] * Impl.numRenamingRegisters)
 
+        if self.banked:
+            self.MappingTableStatus = cached(Impl, BankedMem, **statusPorts,
+                banks=Impl.StatusBanks,
+                bankReadPorts=getattr(Impl, "StatusBankReadPorts", 2),
+                bankWritePorts=getattr(Impl, "StatusBankWritePorts", 2))
+            assert self.MappingTableStatus.bankReadPorts >= 2 and self.MappingTableStatus.bankWritePorts >= 2, \
+                "a single uop must always fit"
+
+            self.fresh = Signal(Impl.numRenamingRegisters)
+        else:
+            self.MappingTableStatus = cached(Impl, MultiMem, **statusPorts)
+
         # C-Pointer, Tracks the first dependency of each uop
-        self.MappingTableCptr = MultiMem(
+        self.MappingTableCptr = cached(Impl, MultiMem,
             width=(Impl.numRenamingRegisters-1).bit_length(),
             depth=Impl.numRenamingRegisters,
             readPorts=Impl.NumIssues, # Only need to read this back at issue
@@ -52,7 +82,7 @@ class Scheduler(Elaboratable):
         #     writePorts=Impl.NumDecodes * 2) # One per dependency
 
         # uop args
-        self.UopArgs = MultiMem(
+        self.UopArgs = cached(Impl, MultiMem,
             width=width * 2,
             depth=Impl.numRenamingRegisters,
             readPorts=self.NumWakeupChecks, # each wakeup check requires one read
@@ -81,7 +111,8 @@ class Scheduler(Elaboratable):
         self.ready = [Signal(width, name=f"ready{i}") for i in range(self.NumWakeupChecks)]
         self.readyValid = [Signal(name=f"ready{i}_valid") for i in range(self.NumWakeupChecks)]
 
-        self.stall = Signal()
+        self.stall = Signal() # Some of the group wasn't taken, and must be offered again
+        self.inTaken = [Signal(name=f"inTaken_{i}") for i in range(Impl.NumDecodes)]
         self.outStatus = Signal(2)
         self.outCptr = Signal(width)
 
@@ -93,83 +124,53 @@ class Scheduler(Elaboratable):
         m.submodules.MappingTableCptr = self.MappingTableCptr
         # m.submodules.MappingTableMptr = self.MappingTableMptr
         m.submodules.MappingTableStatus = self.MappingTableStatus
+        m.submodules.UopArgs = self.UopArgs
         # m.submodules.renamer = self.renamer
 
-        # First, we need to find conflicts between writes to MT
+        gone = Signal(len(self.squashed))
+        m.d.comb += gone.eq(self.squashed | self.flush_hot)
 
-        def accumulateConflcits(Result: Signal, ThisId: Signal, chain: Value, start: int, name):
-            # Look at every arg after this one in the wave and check if any depend on the same ID
-            final = chain
-            for j in range(start + 1, self.NumIssues):
-                conflictA = Signal(name=f"{name}_conflicted_by_{j}A")
-                conflictB = Signal(name=f"{name}_conflicted_by_{j}B")
+        def isGone(id):
+            return gone.bit_select(id, 1)
 
-                accumulated = Signal()
+        def readStatus(rPORT, id):
+            data = self.MappingTableStatus.read_data[rPORT]
+            return Mux(self.fresh.bit_select(id, 1), Const(0), data) if self.banked else data
 
-                m.d.comb += [
-                    # check if the IDs are equal
-                    conflictA.eq(ThisId == self.inA[j]),
-                    conflictB.eq(ThisId == self.inB[j]),
-
-                    # and acclumuate the result in a chain
-                    accumulated.eq(final | conflictA | conflictB)
-                ]
-
-                final = accumulated
-            m.d.comb += Result.eq(~final) # invert
-
-        def accumulateConflcitsReverse(Result: Signal, ThisId: Signal, chain: Value, end: int, name):
-            # Look at every uop before this one in the wave and check if this arg conflicts with it
-            final = chain
-            for j in range(0, end):
-                conflictA = Signal(name=f"{name}_conflicts_{j}")
+        # The part of the group being taken this cycle
+        inValid = self.inTaken if self.banked else self.inValid
+        if not self.banked:
+            m.d.comb += [taken.eq(valid) for taken, valid in zip(self.inTaken, self.inValid)]
 
-                accumulated = Signal()
+        created = treeOR(Mux(valid, Const(1, len(gone)) << out, 0) for valid, out in zip(inValid, self.inOut))
+        m.d.sync += self.squashed.eq((self.squashed & ~created) | self.flush_hot)
 
-                m.d.comb += [
-                    # check if the IDs are equal
-                    conflictA.eq(ThisId == self.inOut[j]),
-
-                    # and acclumuate the result in a chain
-                    accumulated.eq(final | conflictA)
-                ]
-
-                final = accumulated
-            m.d.comb += Result.eq(final)
+        # First, we need to find conflicts between writes to MT
 
+        def accumulateConflcits(Result: Signal, ThisId: Signal, start: int):
+            # Look at every arg after this one in the wave and check if any depend on the same ID
+            later = [(j, arg) for j in range(start + 1, self.NumIssues) for arg in (self.inA[j], self.inB[j])]
+            if self.banked:
+                # Only the part of the group being taken
+                m.d.comb += Result.eq(~treeOR(inValid[j] & (ThisId == arg) for j, arg in later))
+            else:
+                m.d.comb += Result.eq(~anyEqual(ThisId, [arg for _, arg in later])) # invert
 
+        def accumulateConflcitsReverse(Result: Signal, ThisId: Signal, end: int):
+            # Look at every uop before this one in the wave and check if this arg conflicts with it
+            m.d.comb += Result.eq(anyEqual(ThisId, self.inOut[:end]))
 
-        def sumPrecedingConflicts(Result: Signal, ThisId: Signal, end: int, name):
+        def sumPrecedingConflicts(Result: Signal, ThisId: Signal, end: int):
             # look at all args before this one and count how many conflcit
             # Clamp at two
-
-            # I'm hoping this can be packed into one or two LUTs
-            finalSum = Const(0)
-            for j in range(0, end):
-                conflictA = Signal(name=f"{name}_conflicted_by_{j}A")
-                conflictB = Signal(name=f"{name}_conflicted_by_{j}B")
-                conflict = Signal(name=f"{name}_conflicted_by_{j}")
-
-                m.d.comb += [
-                    conflictA.eq(ThisId == self.inA[j]),
-                    conflictB.eq(ThisId == self.inB[j]),
-                    conflict.eq(conflictA | conflictB)
-                ]
-
-                sum = Signal(4) # just assume NumIssues will never exceed 15
-                m.d.comb += sum.eq(finalSum + conflict)
-                finalSum = sum
-
-            with m.If(finalSum > Const(2)):
-                m.d.comb += Result.eq(Const(2))
-            with m.Else():
-                m.d.comb += Result.eq(finalSum)
+            conflicts = [(ThisId == self.inA[j]) | (ThisId == self.inB[j]) for j in range(0, end)]
+            m.d.comb += Result.eq(popcountClamp(conflicts, 2))
 
         # These signals allow the status of a new MT entry to be set to 0 on create.
         # If another uop in this same wave depends on it, the status will need to be set to something else
         AllowStatusCreate = [Signal(name = f"allow_status_create_{i}") for i in range(self.NumIssues)]
         for i in range(self.NumIssues):
-            accumulateConflcits(AllowStatusCreate[i], self.inOut[i], Const(0), i, f"uop{i}_create")
+            accumulateConflcits(AllowStatusCreate[i], self.inOut[i], i)
 
         # For each arg, track if this is the first, second or Nth use of that dependenciy this wave
         # Later uses might need to skip straght to another stage of depending
@@ -182,36 +183,45 @@ class Scheduler(Elaboratable):
         IgnoreStatus = [Signal(name = f"ignore_old_status_{i}") for i in range(self.NumIssues * 2)]
 
         for i in range(self.NumIssues):
-            accumulateConflcits(AllowStatusUpdate[i*2    ], self.inA[i], Const(0), i, f"uop{i}_argA_update")
-            accumulateConflcits(AllowStatusUpdate[i*2 + 1], self.inB[i], Const(0), i, f"uop{i}_argB_update")
+            accumulateConflcits(AllowStatusUpdate[i*2    ], self.inA[i], i)
+            accumulateConflcits(AllowStatusUpdate[i*2 + 1], self.inB[i], i)
 
-            sumPrecedingConflicts(DependConflictOffset[i*2    ], self.inA[i], i, f"uop{i}_argA_update")
-            sumPrecedingConflicts(DependConflictOffset[i*2 + 1], self.inB[i], i, f"uop{i}_argB_update")
+            sumPrecedingConflicts(DependConflictOffset[i*2    ], self.inA[i], i)
+            sumPrecedingConflicts(DependConflictOffset[i*2 + 1], self.inB[i], i)
 
-            accumulateConflcitsReverse(IgnoreStatus[i*2], self.inA[i], Const(0), i, f"uop{i}_argA")
-            accumulateConflcitsReverse(IgnoreStatus[i*2 + 1], self.inB[i], Const(0), i, f"uop{i}_argB")
+            accumulateConflcitsReverse(IgnoreStatus[i*2], self.inA[i], i)
+            accumulateConflcitsReverse(IgnoreStatus[i*2 + 1], self.inB[i], i)
 
         wPORT = 0
         c_wPORT = 0
         rPORT = 0
+        if self.banked:
+            # The lowest numbered bank ports lose, so put the wakeup reads there
+            rPORT = self.NumWakeupChecks
+
+        # Status entries written this cycle, they're no longer fresh
+        Written = []
 
         # for each uop, create a entry in MT
         for i in range(self.NumDecodes):
             m.d.comb += [
-                self.MappingTableStatus.write_addr[wPORT].eq(self.inOut[i]),
-                self.MappingTableStatus.write_data[wPORT].eq(Const(0)), # clear to no dependices
-
-                 # but only if there isn't a conflict (another uop is reading this result this cycle)
-                self.MappingTableStatus.write_enable[wPORT].eq(AllowStatusCreate[i] & self.inValid[i]),
-
                 # Also store the arguments of this uop
                 self.UopArgs.write_addr[i].eq(self.inOut[i]),
                 self.UopArgs.write_data[i].eq(Cat(self.inA[i], self.inB[i])),
-                self.UopArgs.write_enable[i].eq(self.inValid[i])
+                self.UopArgs.write_enable[i].eq(inValid[i])
             ]
 
-            # Update used memory ports
-            wPORT += 1
+            if not self.banked:
+                m.d.comb += [
+                    self.MappingTableStatus.write_addr[wPORT].eq(self.inOut[i]),
+                    self.MappingTableStatus.write_data[wPORT].eq(Const(0)), # clear to no dependices
+
+                     # but only if there isn't a conflict (another uop is reading this result this cycle)
+                    self.MappingTableStatus.write_enable[wPORT].eq(AllowStatusCreate[i] & inValid[i]),
+                ]
+
+                # Update used memory ports
+                wPORT += 1
 
             ArgsNotEqual = Signal(name=f"uop{i}_ArgsNotEqual")
 
@@ -232,22 +242,22 @@ class Scheduler(Elaboratable):
                 # Suppress all writes if this is the first arg and both args are equal
                 if j == 0:
                     m.d.comb += [
-                        WriteCptr.eq(self.inValid[i] & (OffsetStatus == Const(0)) & ArgsNotEqual),
-                        WriteMptr.eq(self.inValid[i] & (OffsetStatus == Const(1)) & ArgsNotEqual),
-                        WriteStatus.eq(self.inValid[i] & AllowStatusUpdate[i*2] & ArgsNotEqual & ~AlreadyReady)
+                        WriteCptr.eq(inValid[i] & (OffsetStatus == Const(0)) & ArgsNotEqual),
+                        WriteMptr.eq(inValid[i] & (OffsetStatus == Const(1)) & ArgsNotEqual),
+                        WriteStatus.eq(inValid[i] & AllowStatusUpdate[i*2] & ArgsNotEqual & ~AlreadyReady)
                     ]
                 else:
                     m.d.comb += [
-                        WriteCptr.eq(self.inValid[i] & OffsetStatus == Const(0)),
-                        WriteMptr.eq(self.inValid[i] & OffsetStatus == Const(1)),
-                        WriteStatus.eq(self.inValid[i] & AllowStatusUpdate[i*2 + 1] & ~AlreadyReady)
+                        WriteCptr.eq(inValid[i] & OffsetStatus == Const(0)),
+                        WriteMptr.eq(inValid[i] & OffsetStatus == Const(1)),
+                        WriteStatus.eq(inValid[i] & AllowStatusUpdate[i*2 + 1] & ~AlreadyReady)
                     ]
 
                 m.d.comb += [
                     # Read the pervious status
                     self.MappingTableStatus.read_addr[rPORT].eq(arg),
                     # If the arg was created within this same wave, we need to ignore the old stale status
-                    PrevStatus.eq(Mux(IgnoreStatus[i*2 + j], Const(0), self.MappingTableStatus.read_data[rPORT])),
+                    PrevStatus.eq(Mux(IgnoreStatus[i*2 + j], Const(0), Mux(isGone(arg), Const(3), readStatus(rPORT, arg)))),
                     AlreadyReady.eq(PrevStatus == Const(3)),
 
                     # Also Take into account prevous conflicting args
@@ -266,12 +276,22 @@ class Scheduler(Elaboratable):
                     # 0 -> 1, 1 -> 2, 2 -> 2, 3 -> 2, 4 -> 2
                     self.MappingTableStatus.write_data[wPORT].eq(Const(0b1010101001).word_select(OffsetStatus, 2))
                 ]
+                if self.banked:
+                    # The A read only matters if it's a different source to B
+                    m.d.comb += self.MappingTableStatus.read_enable[rPORT].eq(inValid[i] & (ArgsNotEqual if j == 0 else 1))
+                    Written += [(WriteStatus, arg)]
 
                 # Update used memory ports
                 rPORT += 1
                 c_wPORT += 1
                 wPORT += 1
 
+        # Wakeups which will write the status next cycle. They can't be refused then, so a wakeup
+        # only goes ahead if there will be a bank write port for it
+        WakeupWrites = []
+        if self.banked:
+            rPORT = 0
+
         # Trigger Wakeups checks for instructions that were issued last cycle
         for i, wakeupId in enumerate(self.wakeUpNext):
             argA = Signal(self.width)
@@ -287,7 +307,7 @@ class Scheduler(Elaboratable):
 
             # Identify the other argument which wasn't the source of the wakeup
             # Saves us a read port
-            with m.If(argA == self.wakeUpNextSrc):
+            with m.If(argA == self.wakeUpNextSrc[i]):
                 m.d.comb += otherArg.eq(argB)
             with m.Else():
                 m.d.comb += otherArg.eq(argA)
@@ -302,34 +322,61 @@ class Scheduler(Elaboratable):
             m.d.comb += [
                 # Read status
                 self.MappingTableStatus.read_addr[rPORT].eq(otherArg),
-                otherArgStatus.eq(self.MappingTableStatus.read_data[rPORT]),
+                otherArgStatus.eq(readStatus(rPORT, otherArg)),
 
                 # if status is 3, then it's ready
-                otherArgReady.eq(otherArgStatus == Const(3)),
+                otherArgReady.eq((otherArgStatus == Const(3)) | isGone(otherArg)),
 
                 # check next c-pointer
                 self.MappingTableCptr.read_addr[i].eq(wakeupId),
                 nextCptr.eq(self.MappingTableCptr.read_data[i])
             ]
 
+            # Squashed uops don't wake up, and the chain of wakeups through them stops
+            wakeupGone = isGone(wakeupId)
+
+            proceed = Const(1)
+            if self.banked:
+                # Otherwise it tries again next cycle
+                status = self.MappingTableStatus
+                readGranted = status.read_grant[rPORT] | (wakeupId == 0)
+                writes = popcount(write & (status.bankOf(id) == status.bankOf(wakeupId)) for write, id in WakeupWrites)
+
+                proceed = Signal(name=f"wakeup{i}_proceed")
+                m.d.comb += [
+                    status.read_enable[rPORT].eq(wakeupId != 0),
+                    proceed.eq(readGranted & (writes < status.bankWritePorts)),
+                ]
+                WakeupWrites += [(readGranted & otherArgReady & ~wakeupGone, wakeupId)]
+
+                # Its write last cycle lands now
+                Written += [(status.write_enable[wPORT], status.write_addr[wPORT])]
+
             m.d.sync += [
                 # if it's ready, then we can queue it
-                self.readyValid[i].eq((otherArgReady | otherArg == Const(0)) & wakeupId != Const(0)),
+                self.readyValid[i].eq(((otherArgReady | otherArg == Const(0)) & wakeupId != Const(0)) & ~wakeupGone & proceed),
                 self.ready[i].eq(wakeupId),
 
                 # Update the mapping table status
-                self.MappingTableStatus.write_enable[wPORT].eq(otherArgReady),
+                self.MappingTableStatus.write_enable[wPORT].eq(otherArgReady & ~wakeupGone & proceed),
                 self.MappingTableStatus.write_addr[wPORT].eq(wakeupId),
                 self.MappingTableStatus.write_data[wPORT].eq(Const(3)),
-
-                # queue any dependcies for update
-                self.wakeUpNext[i].eq(nextCptr),
-                self.wakeUpNextSrc[i].eq(wakeupId)
             ]
 
+            with m.If(proceed):
+                m.d.sync += [
+                    # queue any dependcies for update
+                    self.wakeUpNext[i].eq(Mux(wakeupGone, 0, nextCptr)),
+                    self.wakeUpNextSrc[i].eq(wakeupId)
+                ]
+
             rPORT += 1
             wPORT += 1
 
+        if self.banked:
+            self.admit(m, [(status.write_enable[p], status.write_addr[p]) for p in range(wPORT - len(self.wakeUpNext), wPORT)])
+            written = Cat(*[treeOR(write & (id == e) for write, id in Written) for e in range(len(self.fresh))])
+            m.d.sync += self.fresh.eq((self.fresh | created) & ~written)
 
         # m.d.comb += [
         #     self.MappingTableStatus.read_addr[rPORT].eq(self.readStatus),
@@ -340,6 +387,30 @@ class Scheduler(Elaboratable):
 
         return m
 
+    def admit(self, m, wakeupWrites):
+        # Takes as much of the group as is sure to get status ports, counting every access it might make.
+        # Wakeup writes from last cycle are landing now, and always get their ports
+        status = self.MappingTableStatus
+        reads = [[] for _ in self.inTaken]
+        writes = [[] for _ in self.inTaken]
+        for i, (a, b, valid) in enumerate(zip(self.inA, self.inB, self.inValid)):
+            for arg, used in [(a, valid & (a != b)), (b, valid)]:
+                reads[i] += [(used, arg)]
+                writes[i] += [(used, arg)]
+
+        def fits(accesses, ports, bank):
+            return popcount(used & (status.bankOf(id) == bank) for used, id in accesses) <= ports
+
+        for i, taken in enumerate(self.inTaken):
+            # A slot is only taken if all the slots before it are
+            earlierReads = [access for slot in reads[:i + 1] for access in slot]
+            earlierWrites = [access for slot in writes[:i + 1] for access in slot]
+            m.d.comb += taken.eq(self.inValid[i] & treeAND(
+                fits(earlierReads, status.bankReadPorts, bank) &
+                fits(wakeupWrites + earlierWrites, status.bankWritePorts, bank) for bank in range(len(status.banks))))
+
+        m.d.comb += self.stall.eq(treeOR(valid & ~taken for valid, taken in zip(self.inValid, self.inTaken)))
+
 from nmigen.back.pysim import *
 
 
@@ -0,0 +1,62 @@
+from nmigen import *
+from nmigen.cli import main
+
+# Stream protocol between pipeline stages
+#
+# A stage offers data with valid and the next stage accepts it with ready. Data moves in any
+# cycle where both are high. A stage offering data has to keep offering the same data until
+# it's accepted, so a stall freezes the stages behind it without dropping anything.
+
+class SkidBuffer(Elaboratable):
+    # Registered stage with a one entry skid, so that i_ready comes straight out of a register
+    # instead of combinationally following o_ready back up the pipeline.
+    #
+    # When o_ready drops, the upstream stage only finds out next cycle, so whatever it sent
+    # this cycle lands in the skid. It still runs at full throughput while o_ready stays high.
+
+    def __init__(self, width, name="skid"):
+        # inputs
+        self.i_data = Signal(width, name=f"{name}_i_data")
+        self.i_valid = Signal(name=f"{name}_i_valid")
+        self.o_ready = Signal(name=f"{name}_o_ready")
+
+        # State
+        self.skid = Signal(width, name=f"{name}_skid")
+        self.skid_valid = Signal(name=f"{name}_skid_valid")
+
+        # outputs
+        self.i_ready = Signal(name=f"{name}_i_ready")
+        self.o_data = Signal(width, name=f"{name}_o_data")
+        self.o_valid = Signal(name=f"{name}_o_valid")
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.d.comb += self.i_ready.eq(~self.skid_valid)
+
+        with m.If(self.o_ready | ~self.o_valid):
+            # Output is free, refill it from the skid first
+            with m.If(self.skid_valid):
+                m.d.sync += [
+                    self.o_data.eq(self.skid),
+                    self.o_valid.eq(1),
+                    self.skid_valid.eq(0),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    self.o_data.eq(self.i_data),
+                    self.o_valid.eq(self.i_valid),
+                ]
+        with m.Elif(self.i_valid & self.i_ready):
+            # Output is stalled, catch what was already on its way
+            m.d.sync += [
+                self.skid.eq(self.i_data),
+                self.skid_valid.eq(1),
+            ]
+
+        return m
+
+
+if __name__ == "__main__":
+    skid = SkidBuffer(8)
+    main(skid, ports=[skid.i_data, skid.i_valid, skid.i_ready, skid.o_data, skid.o_valid, skid.o_ready])
@@ -0,0 +1,321 @@
+import random
+from collections import namedtuple, deque
+
+from nmigen.back.pysim import Simulator, Settle, Tick
+from decoder import opcodes, encode, simpleOpcodes
+
+# Trace driven simulation of the scheduling backends
+#
+# Traces are lists of Uops using arch registers. runScheduler does renaming and execution
+# in python and only simulates the scheduler itself, so different schedulers can be compared
+# cycle for cycle on the same trace.
+
+Uop = namedtuple("Uop", ["op", "out", "a", "b"])
+
+# Roughly integer code: mostly ALU, lots of loads, some multiplies and branches
+mixedOps = {"add": 40, "sub": 10, "and": 5, "or": 5, "mul": 10, "load": 25, "branch": 5}
+
+def mixedTrace(length, seed=0, mix=mixedOps, regs=16, locality=0.5):
+    # Sources read one of the last few results with probability locality, otherwise a random register
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    trace = []
+    recent = deque(maxlen=4)
+    for _ in range(length):
+        def source():
+            if recent and rng.random() < locality:
+                return rng.choice(recent)
+            return rng.randrange(1, regs)
+
+        uop = Uop(rng.choices(names, weights)[0], rng.randrange(1, regs), source(), source())
+        trace.append(uop)
+        recent.append(uop.out)
+    return trace
+
+
+def withIdioms(trace, rate, seed=0):
+    # Turns about rate of the uops into moves (and/or of a register with itself) or zeroing (sub from itself)
+    rng = random.Random(seed)
+    result = []
+    for uop in trace:
+        roll = rng.random()
+        if roll < rate / 2:
+            uop = Uop(rng.choice(["and", "or"]), uop.out, uop.a, uop.a)
+        elif roll < rate:
+            uop = Uop("sub", uop.out, uop.a, uop.a)
+        result.append(uop)
+    return result
+
+
+def withFusablePairs(trace, rate, seed=0):
+    # Replaces about rate of the uops with the first half of a pair Fusion can fuse, the next uop
+    # becoming the second half: compare and branch on the result, or an address add and a load from it
+    rng = random.Random(seed)
+    result = list(trace)
+    i = 0
+    while i < len(result) - 1:
+        if rng.random() < rate:
+            first = result[i]
+            if rng.random() < 0.5:
+                result[i:i + 2] = [Uop("sub", first.out, first.a, first.b), Uop("branch", first.out, first.out, first.a)]
+            else:
+                result[i:i + 2] = [Uop("add", first.out, first.a, first.b), Uop("load", first.out, first.out, first.out)]
+            i += 2
+        else:
+            i += 1
+    return result
+
+
+def steerTrace(trace, decodes, complexDecoders, simple=simpleOpcodes):
+    # Decode groups Steering splits the trace into, with complexDecoders of the decodes slots decoding
+    # anything and the rest only simple. Each group starts where the last one stopped
+    groups = 0
+    k = 0
+    while k < len(trace):
+        taken = 1
+        while taken < decodes and k + taken < len(trace) and (taken < complexDecoders or trace[k + taken].op in simple):
+            taken += 1
+        groups += 1
+        k += taken
+    return groups
+
+
+def program(trace):
+    # Encodes a trace as instructions for Fetch
+    return [encode(opcodes[uop.op][0], uop.out, uop.a, uop.b) for uop in trace]
+
+
+class _InFlight:
+    def __init__(self, uop, id, sources, misses=False):
+        self.uop = uop
+        self.id = id
+        self.sources = sources
+        self.misses = misses # A load that misses the next time it executes
+        self.woken = False   # Consumers have been woken, maybe speculatively
+        self.dataAt = None   # First cycle a consumer can issue and get the real result
+        self.done = False
+        self.issued = None
+
+def runScheduler(scheduler, impl, trace, maxCycles=None, filterCompleted=True, missRate=0.0, missLatency=20, cancelDelay=1, seed=0, counters=()):
+    # Drives any scheduler with the MatrixScheduler interface:
+    #   inA, inB, inOut, inValid (and inUnits if it has them) for insert, optionally inReady to refuse a group
+    #   ready/readyValid for the first NumIssues ports, clear_addr for completions
+    #
+    # Renaming IDs are handed out from a free list and come back once the uop completes.
+    # Sources whose producer has already completed are passed as zero (NULL).
+    # With filterCompleted=False they are passed as the producer's ID, like the renamer does,
+    # and the scheduler has to work out they're ready itself. IDs are then only freed once they
+    # are completed and no arch register maps to them any more.
+    # A uop with latency N issued in cycle t clears in cycle t + N - 1, so a dependent uop can
+    # issue in cycle t + N.
+    #
+    # With missRate, that fraction of loads miss and take missLatency cycles longer.
+    # Schedulers with replay wake consumers as if the load hit, get a cancel_addr cancelDelay
+    # cycles later and a second clear when the data arrives. Uops on replay_hot are dropped from
+    # execution and issue again later. A uop only completes (confirm_addr) once its sources have,
+    # and before that it's checked to have issued after the real data arrived.
+    # Other schedulers are told about the miss up front, so their clear just comes later.
+    #
+    # Returns a dict with cycles, uops, ipc and replays, plus the final value of each of the
+    # scheduler's performance counters named in counters. Raises if a uop issues before its sources
+    # have been woken, completes having read bad data, or if the trace doesn't drain within maxCycles.
+
+    NumIssues = scheduler.NumIssues
+    maxCycles = maxCycles or 20 * len(trace) + 100
+    replay = getattr(scheduler, "replay", False)
+
+    rng = random.Random(seed)
+    misses = [uop.op == "load" and rng.random() < missRate for uop in trace]
+
+    stats = {"cycles": 0, "uops": len(trace), "replays": 0, "misses": sum(misses)}
+
+    def process():
+        free = deque(range(1, impl.numRenamingRegisters))
+        producers = {}  # arch reg -> _InFlight
+        inFlight = {}   # renaming id -> _InFlight
+        completing = [] # (cycle, _InFlight)
+        cancelling = [] # (cycle, _InFlight, sent by us rather than the scheduler)
+        position = 0
+        cycle = 0
+
+        def release(entry):
+            entry.done = True
+            del inFlight[entry.id]
+            if filterCompleted or producers[entry.uop.out] is not entry:
+                free.append(entry.id)
+
+        while position < len(trace) or inFlight:
+            if cycle >= maxCycles:
+                raise RuntimeError(f"scheduler didn't drain after {cycle} cycles ({len(inFlight)} uops stuck)")
+
+            # Insert
+            group = []
+            for i in range(scheduler.NumDecodes):
+                if position + len(group) < len(trace) and len(group) < len(free):
+                    uop = trace[position + len(group)]
+
+                    # Find each source's producer, earlier uops in this group take priority
+                    sources = []
+                    ids = []
+                    for reg in (uop.a, uop.b):
+                        producer = producers.get(reg)
+                        for earlier in group:
+                            if earlier.uop.out == reg:
+                                producer = earlier
+                        if producer and not producer.done:
+                            sources += [producer]
+                        if producer and (not producer.done or not filterCompleted):
+                            ids += [producer.id]
+                        else:
+                            ids += [0]
+
+                    entry = _InFlight(uop, free[len(group)], sources, misses[position + len(group)])
+
+                    yield scheduler.inA[i].eq(ids[0])
+                    yield scheduler.inB[i].eq(ids[1])
+                    yield scheduler.inOut[i].eq(entry.id)
+                    yield scheduler.inValid[i].eq(1)
+                    if hasattr(scheduler, "inUnits"):
+                        yield scheduler.inUnits[i].eq(opcodes[uop.op][1])
+                    group += [entry]
+                else:
+                    yield scheduler.inValid[i].eq(0)
+
+            # Cancel wakeups of loads found to have missed
+            if replay:
+                due = [c for c in cancelling if c[0] <= cycle and c[2]][:len(scheduler.cancel_addr)]
+                for p, cancel_addr in enumerate(scheduler.cancel_addr):
+                    yield cancel_addr.eq(due[p][1].id if p < len(due) else 0)
+                cancelled = due + [c for c in cancelling if c[0] <= cycle and not c[2]]
+
+            yield Settle()
+
+            accepted = (yield scheduler.inReady) if hasattr(scheduler, "inReady") else 1
+            if accepted:
+                for entry in group:
+                    free.popleft()
+                    overwritten = producers.get(entry.uop.out)
+                    producers[entry.uop.out] = entry
+                    inFlight[entry.id] = entry
+                    if overwritten and overwritten.done and not filterCompleted:
+                        free.append(overwritten.id)
+                position += len(group)
+
+            # Issue
+            for p in range(NumIssues):
+                if (yield scheduler.readyValid[p]):
+                    entry = inFlight[(yield scheduler.ready[p])]
+                    if entry.issued is not None or any(not source.woken for source in entry.sources):
+                        raise RuntimeError(f"{entry.uop} issued early or twice in cycle {cycle}")
+                    entry.issued = cycle
+                    latency = opcodes[entry.uop.op][2]
+                    if entry.misses and not replay:
+                        latency += missLatency
+                        entry.misses = False
+                    completing += [(cycle + latency - 1, entry)]
+
+            # Drop whatever the scheduler pulled back. The scheduler cancels their own wakeups next cycle
+            if replay:
+                replayed = yield scheduler.replay_hot
+                for entry in inFlight.values():
+                    if replayed >> entry.id & 1:
+                        completing = [c for c in completing if c[1] is not entry]
+                        cancelling = [c for c in cancelling if c[1] is not entry]
+                        cancelling += [(cycle + 1, entry, False)]
+                        entry.issued = None
+                        entry.dataAt = None
+                        stats["replays"] += 1
+
+            # Complete, but only one per clear port a cycle. Anything else waits for a free clear port
+            completing.sort(key=lambda c: c[0])
+            clears = [c for c in completing if c[0] <= cycle][:len(scheduler.clear_addr)]
+            for p, clear_addr in enumerate(scheduler.clear_addr):
+                yield clear_addr.eq(clears[p][1].id if p < len(clears) else 0)
+
+            # Confirm uops whose result is good, which needs all their sources to be good first
+            if replay:
+                confirms = [entry for entry in inFlight.values() if entry.dataAt is not None and all(source.done for source in entry.sources)]
+                confirms = confirms[:len(scheduler.confirm_addr)]
+                for entry in confirms:
+                    if any(entry.issued < source.dataAt for source in entry.sources):
+                        raise RuntimeError(f"{entry.uop} read bad data and wasn't replayed")
+                for p, confirm_addr in enumerate(scheduler.confirm_addr):
+                    yield confirm_addr.eq(confirms[p].id if p < len(confirms) else 0)
+
+            yield Tick()
+            cycle += 1
+
+            if replay:
+                for c in cancelled:
+                    if c in cancelling:
+                        cancelling.remove(c)
+                        c[1].woken = False
+                for entry in confirms:
+                    release(entry)
+
+            for c in clears:
+                completing.remove(c)
+                entry = c[1]
+                entry.woken = True
+                if entry.misses:
+                    # That was speculative, the data turns up later
+                    entry.misses = False
+                    cancelling += [(cycle - 1 + cancelDelay, entry, True)]
+                    completing += [(cycle - 1 + missLatency, entry)]
+                    continue
+                entry.dataAt = cycle
+                if not replay:
+                    release(entry)
+
+        for i in range(scheduler.NumDecodes):
+            yield scheduler.inValid[i].eq(0)
+        stats["cycles"] = cycle
+        for name in counters:
+            stats[name] = yield getattr(scheduler, name)
+
+    sim = Simulator(scheduler)
+    sim.add_clock(1e-6)
+    sim.add_process(process)
+    sim.run()
+
+    stats["ipc"] = stats["uops"] / stats["cycles"]
+    return stats
+
+
+def runCore(core, cycles, warmup=100):
+    # Runs a closed loop Core headless and reads its performance counters, one stat for each.
+    # The first warmup cycles are left out so the pipeline has filled.
+    # uops counts trace uops: eliminated ones too, they're done as soon as they're renamed,
+    # and both halves of a fused pair. With SMT, threadUops has the same count for each thread.
+    # window is the mean number of uops in flight
+    counters = ["cycles", "completed", "eliminated", "fused", "renamed", "uopCacheHits", "uopCacheMisses", "ratSplits", "decodeSplits", "decoded", "window"]
+    signals = {name: getattr(core, name) for name in counters}
+    threadUops = getattr(core, "threadUops", [])
+    for t, signal in enumerate(threadUops):
+        signals[f"threadUops{t}"] = signal
+    stats = {}
+
+    def process():
+        for _ in range(warmup):
+            yield Tick()
+        for name, signal in signals.items():
+            stats[name] = -(yield signal)
+
+        for _ in range(cycles):
+            yield Tick()
+        for name, signal in signals.items():
+            stats[name] += yield signal
+        stats["uops"] = stats["completed"] + stats["eliminated"] + stats["fused"]
+        if threadUops:
+            stats["threadUops"] = [stats.pop(f"threadUops{t}") for t in range(len(threadUops))]
+
+    sim = Simulator(core)
+    sim.add_clock(1e-6)
+    sim.add_process(process)
+    sim.run()
+
+    stats["ipc"] = stats["uops"] / stats["cycles"]
+    stats["window"] /= stats["cycles"]
+    return stats
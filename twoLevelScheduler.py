@@ -0,0 +1,276 @@
+from nmigen import *
+from nmigen.lib.coding import *
+from nmigen.cli import main
+from multiMem import MultiMem
+from buildCache import cached
+from matrixScheduler import Matrix, FlatMatrix, PiorityEncoder, Scoreboard
+from util import *
+
+class TwoLevelScheduler(Elaboratable):
+    # Deep window scheduler with the MatrixScheduler interface, in two levels:
+    #   a waiting buffer: a FIFO of Impl.WaitingEntries uops in a MultiMem, which every uop goes into first
+    #   a window: a small wakeup matrix of Impl.WindowEntries slots, which is all select looks at
+    #
+    # Each cycle, up to NumDecodes uops out of the first Impl.PromoteLookahead in the buffer move into
+    # free window slots, oldest first. Only uops predicted to be ready soon move: every source has
+    # completed, has issued or is in the window itself. Anything two or more steps down a dependence
+    # chain (behind a load miss, say) sits in the buffer, where it's cheap, instead of holding a slot.
+    # The head of the buffer moves past a uop once it and everything older has gone.
+    # (Only promoting uops whose window sources can be selected right now leaves the window mostly
+    # empty, and issues a lot less.)
+    #
+    # Window slots aren't renaming registers, so slotOf records where each promoted uop went for its
+    # consumers to find it. A slot is held until its uop completes, as its consumers' matrix bits point
+    # at it until then. Uops spend at least one cycle more between insert and select than in the
+    # MatrixScheduler. A group is refused (inReady low) unless the buffer has room for a whole one.
+
+    def __init__(self, Impl, Arch):
+        self.width = width = Impl.numRenamingRegisters.bit_length()
+        self.NumIssues = Impl.NumIssues
+        self.NumDecodes = Impl.NumDecodes
+        self.numRegs = Impl.numRenamingRegisters
+
+        self.windowSize = getattr(Impl, "WindowEntries", 16) + 1 # Slot zero is NULL
+        self.bufferSize = getattr(Impl, "WaitingEntries", 64)
+        self.lookahead = getattr(Impl, "PromoteLookahead", 2 * Impl.NumDecodes)
+        assert self.bufferSize & (self.bufferSize - 1) == 0, "WaitingEntries must be a power of two"
+        assert Impl.NumDecodes <= self.lookahead <= self.bufferSize
+        self.addrBits = (self.bufferSize - 1).bit_length()
+
+        # Inputs from renamer
+        self.inA = [Signal(width, name=f"inA_{i}") for i in range(Impl.NumDecodes)]
+        self.inB = [Signal(width, name=f"inB_{i}") for i in range(Impl.NumDecodes)]
+        self.inOut = [Signal(width, name=f"inOut_{i}") for i in range(Impl.NumDecodes)]
+        self.inValid = [Signal(name=f"inValid_{i}") for i in range(Impl.NumDecodes)]
+
+        # Completions, one per clear port. Defaults to one per issue
+        self.clear_addr = [Signal(width, name=f"clear_addr_{p}") for p in range(getattr(Impl, "NumClears", Impl.NumIssues))]
+
+        # Waiting buffer, from head (oldest) to tail. The pointers have an extra bit so full and empty differ
+        self.buffer = cached(Impl, MultiMem,
+            width=3 * width, # out, A, B
+            depth=self.bufferSize,
+            readPorts=self.lookahead,
+            writePorts=Impl.NumDecodes)
+        self.head = Signal(self.addrBits + 1)
+        self.tail = Signal(self.addrBits + 1)
+        self.promotedEntries = Signal(self.bufferSize) # Moved to the window ahead of something older
+
+        # Where each renaming register's uop is, outside the window itself
+        self.scoreboard = Scoreboard(self.numRegs)
+        self.issued = Signal(self.numRegs)   # Selected, result on its way
+        self.inWindow = Signal(self.numRegs) # Promoted, slotOf says where
+        self.slotOf = cached(Impl, MultiMem,
+            width=(self.windowSize - 1).bit_length(),
+            depth=self.numRegs,
+            readPorts=2 * self.lookahead,
+            writePorts=Impl.NumDecodes)
+
+        # Where in the buffer each renaming register's producer went. A uop can wait in the buffer long after
+        # its producer completed, and by then the ID might belong to a younger uop. A source whose ID was
+        # inserted again behind the consumer has completed
+        self.positionOf = cached(Impl, MultiMem,
+            width=self.addrBits + 1,
+            depth=self.numRegs,
+            readPorts=2 * self.lookahead,
+            writePorts=Impl.NumDecodes)
+
+        # Window
+        matrix = FlatMatrix if getattr(Impl, "FlatMatrix", False) else Matrix
+        self.matrix = matrix(self.windowSize, Impl.NumDecodes)
+        self.slots = [Signal(width, name=f"slot_{s}_id") for s in range(self.windowSize)]
+        self.occupied = Signal(self.windowSize, reset=1)
+        self.waiting_for_select = Signal(self.windowSize)
+
+        self.allocator = PiorityEncoder(self.windowSize, Impl.NumDecodes)
+        self.selecter = PiorityEncoder(self.windowSize, self.NumIssues)
+
+        # Outputs
+        self.ready = [Signal(width, name=f"ready{i}") for i in range(self.NumIssues)]
+        self.readyValid = [Signal(name=f"ready{i}_valid") for i in range(self.NumIssues)]
+        self.inReady = Signal()
+
+        # Performance counters
+        self.cycles = Signal(32)
+        self.promotions = Signal(32)
+        self.windowOccupancy = Signal(32) # Summed over cycles, slots held
+        self.bufferOccupancy = Signal(32) # Summed over cycles, uops in the buffer (including ones already promoted)
+        self.windowFull = Signal(32)      # Cycles a uop predicted ready couldn't get a slot
+
+    def decode(self, m, name, value, size, enable):
+        m.submodules[name] = decoder = Decoder(size)
+        m.d.comb += decoder.i.eq(value)
+        return Mux(enable, decoder.o, 0)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.buffer = self.buffer
+        m.submodules.slotOf = self.slotOf
+        m.submodules.positionOf = self.positionOf
+        m.submodules.scoreboard = self.scoreboard
+        m.submodules.matrix = self.matrix
+        m.submodules.allocator = self.allocator
+        m.submodules.selecter = self.selecter
+
+        count = Signal(range(self.bufferSize + 1))
+        m.d.comb += count.eq((self.tail - self.head)[:self.addrBits + 1])
+
+        # Insert at the tail of the buffer
+        m.d.comb += self.inReady.eq(count <= self.bufferSize - self.NumDecodes)
+        accepted = [valid & self.inReady for valid in self.inValid]
+
+        Inserts = []
+        Written = []
+        for i, accept in enumerate(accepted):
+            position = (self.tail + popcount(accepted[:i]))[:self.addrBits + 1]
+            addr = position[:self.addrBits]
+            m.d.comb += [
+                self.positionOf.write_addr[i].eq(self.inOut[i]),
+                self.positionOf.write_data[i].eq(position),
+                self.positionOf.write_enable[i].eq(accept),
+                self.buffer.write_addr[i].eq(addr),
+                self.buffer.write_data[i].eq(Cat(self.inOut[i], self.inA[i], self.inB[i])),
+                self.buffer.write_enable[i].eq(accept),
+            ]
+            Inserts += [self.decode(m, f"insert_decoder_{i}", self.inOut[i], self.numRegs, accept)]
+            Written += [self.decode(m, f"written_decoder_{i}", addr, self.bufferSize, accept)]
+        m.d.sync += self.tail.eq(self.tail + popcount(accepted))
+        Inserted = treeOR(Inserts)
+
+        # Completions free their slot and clear its column
+        Clears = [self.decode(m, f"clear_decoder_{p}", clear_addr, self.numRegs, 1) for p, clear_addr in enumerate(self.clear_addr)]
+        ClearedSlots = Cat(Const(0), *[self.occupied[s] & anyEqual(self.slots[s], self.clear_addr) for s in range(1, self.windowSize)])
+        m.d.comb += [
+            self.scoreboard.clear_hot.eq(treeOR(Clears)),
+            self.scoreboard.insert_hot.eq(Inserted),
+            self.matrix.clear_hot.eq(ClearedSlots),
+        ]
+        completed = self.scoreboard.ready
+
+        selectable = Signal(self.windowSize)
+        m.d.comb += selectable.eq(self.matrix.is_clear & self.waiting_for_select)
+
+        # Look through the oldest uops in the buffer for ones ready soon
+        candidates = []
+        uops = []
+        for k in range(self.lookahead):
+            addr = (self.head + k)[:self.addrBits]
+            out, a, b = Signal(self.width), Signal(self.width), Signal(self.width)
+            present = Signal(name=f"lookahead_{k}_present")
+            m.d.comb += [
+                self.buffer.read_addr[k].eq(addr),
+                Cat(out, a, b).eq(self.buffer.read_data[k]),
+                present.eq((k < count) & ~self.promotedEntries.bit_select(addr, 1)),
+            ]
+
+            soon = []
+            waitsOn = []
+            for j, src in enumerate([a, b]):
+                port = 2 * k + j
+                slot = self.slotOf.read_data[port]
+                distance = (self.positionOf.read_data[port] - self.head)[:self.addrBits + 1]
+                reused = (distance > k) & (distance < count)
+                inWindow = self.inWindow.bit_select(src, 1) & (src != 0) & ~reused
+                done = completed.bit_select(src, 1) | reused
+                m.d.comb += [
+                    self.slotOf.read_addr[port].eq(src),
+                    self.positionOf.read_addr[port].eq(src),
+                ]
+
+                soon += [(src == 0) | done | self.issued.bit_select(src, 1) | inWindow]
+                waitsOn += [self.decode(m, f"lookahead_{k}_{'AB'[j]}_slot_decoder", slot, self.windowSize, inWindow & ~done)]
+
+            candidate = Signal(name=f"lookahead_{k}_candidate")
+            m.d.comb += candidate.eq(present & soon[0] & soon[1])
+            candidates += [candidate]
+            uops += [(addr, out, treeOR(waitsOn))]
+
+        # The Nth candidate takes the Nth free slot, through the Nth set port of the matrix
+        m.d.comb += self.allocator.input.eq(~self.occupied)
+
+        Promoted = []
+        PromotedEntries = []
+        PromotedIds = []
+        for r, slotHot in enumerate(self.allocator.outHot):
+            takes = [candidate & (popcount(candidates[:k]) == r) & (slotHot != 0) for k, candidate in enumerate(candidates) if k >= r]
+            promote = treeOR(takes)
+            out = treeOR(Mux(take, uop[1], 0) for take, uop in zip(takes, uops[r:]))
+
+            m.submodules[f"slot_encoder_{r}"] = slotEncoder = Encoder(self.windowSize)
+            m.d.comb += [
+                self.matrix.row_selects[r].eq(Mux(promote, slotHot, 0)),
+                self.matrix.row_data[r].eq(treeOR(Mux(take, uop[2], 0) for take, uop in zip(takes, uops[r:]))),
+
+                slotEncoder.i.eq(slotHot),
+                self.slotOf.write_addr[r].eq(out),
+                self.slotOf.write_data[r].eq(slotEncoder.o),
+                self.slotOf.write_enable[r].eq(promote),
+            ]
+
+            for s in range(1, self.windowSize):
+                with m.If(promote & slotHot[s]):
+                    m.d.sync += self.slots[s].eq(out)
+
+            Promoted += [self.matrix.row_selects[r]]
+            PromotedEntries += [self.decode(m, f"promoted_entry_decoder_{r}", treeOR(Mux(take, uop[0], 0) for take, uop in zip(takes, uops[r:])), self.bufferSize, promote)]
+            PromotedIds += [self.decode(m, f"promoted_decoder_{r}", out, self.numRegs, promote)]
+
+        PromotedSlots = treeOR(Promoted)
+        PromotedNow = treeOR(PromotedEntries)
+
+        # The head moves past everything at the front that has gone to the window
+        gone = [(k < count) & (self.promotedEntries | PromotedNow).bit_select(uop[0], 1) for k, uop in enumerate(uops)]
+        m.d.sync += self.head.eq(self.head + popcount(treeAND(gone[:k + 1]) for k in range(len(gone))))
+
+        # Select
+        m.d.comb += self.selecter.input.eq(selectable)
+        Selected = []
+        for i, (outHot, ready, readyValid) in enumerate(zip(self.selecter.outHot, self.ready, self.readyValid)):
+            m.d.comb += [
+                ready.eq(treeOR(Mux(outHot[s], self.slots[s], 0) for s in range(1, self.windowSize))),
+                readyValid.eq(outHot != 0),
+            ]
+            Selected += [self.decode(m, f"selected_decoder_{i}", ready, self.numRegs, readyValid)]
+        SelectedSlots = treeOR(self.selecter.outHot)
+
+        m.d.sync += [
+            self.occupied.eq(((self.occupied | PromotedSlots) & ~ClearedSlots) | 1),
+            self.waiting_for_select.eq((self.waiting_for_select & ~SelectedSlots) | PromotedSlots),
+            self.promotedEntries.eq((self.promotedEntries | PromotedNow) & ~treeOR(Written)),
+            self.inWindow.eq((self.inWindow | treeOR(PromotedIds)) & ~Inserted),
+            self.issued.eq((self.issued | treeOR(Selected)) & ~Inserted),
+        ]
+
+        m.d.sync += [
+            self.cycles.eq(self.cycles + 1),
+            self.promotions.eq(self.promotions + popcount(row_select != 0 for row_select in Promoted)),
+            self.windowOccupancy.eq(self.windowOccupancy + popcount(self.occupied[1:])),
+            self.bufferOccupancy.eq(self.bufferOccupancy + count),
+            self.windowFull.eq(self.windowFull + (treeOR(candidates) & (self.occupied == (1 << self.windowSize) - 1))),
+        ]
+
+        return m
+
+
+if __name__ == "__main__":
+    import sys
+    from bench import makeImpl, Arch
+    from traceSim import mixedTrace, runScheduler
+
+    impl = makeImpl(registers=128, WindowEntries=16, WaitingEntries=64)
+
+    # python twoLevelScheduler.py test: runs a trace through it, which fails if anything issues early
+    if sys.argv[1:] == ["test"]:
+        for name, trace in [("mixed", mixedTrace(300)), ("high ILP", mixedTrace(300, seed=1, regs=32, locality=0.1))]:
+            for missRate in [0.0, 0.2]:
+                stats = runScheduler(TwoLevelScheduler(impl, Arch()), impl, trace, missRate=missRate)
+                print(f"{name}, {missRate:.0%} load misses: {stats['uops']} uops in {stats['cycles']} cycles, IPC {stats['ipc']:.2f}")
+        sys.exit()
+
+    scheduler = TwoLevelScheduler(impl, Arch())
+    ports = scheduler.ready + scheduler.readyValid + scheduler.clear_addr + [scheduler.inReady]
+    for inOut, inA, inB, inValid in zip(scheduler.inOut, scheduler.inA, scheduler.inB, scheduler.inValid):
+        ports += [inOut, inA, inB, inValid]
+
+    main(scheduler, ports=ports)
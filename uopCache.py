@@ -0,0 +1,124 @@
+from nmigen import *
+from nmigen.cli import main
+from util import *
+
+class UopCache(Elaboratable):
+    # Direct mapped cache of whole decoded groups, indexed by fetch address, sitting between
+    # decode and the renamer's input.
+    #
+    # Groups coming out of decode are written in as they pass. Each entry also records the
+    # address of the group after it, so once the next group is in the cache the following ones
+    # can be found without fetch. That's loop-stream mode: a hot loop that fits is replayed
+    # straight out of the cache while fetch and decode sit idle.
+    #
+    # On the first miss, fetch is redirected to the missing address. Whatever fetch and decode
+    # were still holding is from before the loop started streaming, so it's dropped until a
+    # group with the expected address comes out of decode.
+    #   Impl.UopCacheEntries: number of groups, a power of two
+
+    def __init__(self, Impl, width, addrWidth):
+        self.entries = Impl.UopCacheEntries
+        assert self.entries & (self.entries - 1) == 0, "UopCacheEntries must be a power of two"
+        self.indexShift = (Impl.NumDecodes - 1).bit_length()
+
+        self.data = Memory(width=width, depth=self.entries)
+        self.tags = Memory(width=addrWidth * 2, depth=self.entries) # address and next address
+
+        # inputs from decode
+        self.d_data = Signal(width)
+        self.d_valid = Signal()
+        self.d_addr = Signal(addrWidth)
+        self.d_next = Signal(addrWidth)
+
+        # inputs from rename
+        self.o_ready = Signal()
+
+        # State
+        self.expected = Signal(addrWidth) # Address of the next group rename should get
+        self.streaming = Signal()         # The last group came from the cache
+        self.tagValid = Signal(self.entries)
+
+        # outputs to rename
+        self.o_data = Signal(width)
+        self.o_valid = Signal()
+
+        # outputs to decode and fetch
+        self.d_ready = Signal()
+        self.redirect = Signal()
+        self.redirectAddr = Signal(addrWidth)
+
+        # Performance, a group was delivered from the cache/from decode
+        self.hit = Signal()
+        self.miss = Signal()
+
+    def index(self, addr):
+        return (addr >> self.indexShift)[:max(1, (self.entries - 1).bit_length())]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.data_read = dataRead = self.data.read_port(domain="comb")
+        m.submodules.tags_read = tagsRead = self.tags.read_port(domain="comb")
+        m.submodules.data_write = dataWrite = self.data.write_port()
+        m.submodules.tags_write = tagsWrite = self.tags.write_port()
+
+        addrWidth = len(self.expected)
+        cachedAddr = tagsRead.data[:addrWidth]
+        cachedNext = tagsRead.data[addrWidth:]
+
+        lookup = self.index(self.expected)
+        cached = self.tagValid.bit_select(lookup, 1) & (cachedAddr == self.expected)
+        decoded = self.d_valid & (self.d_addr == self.expected)
+
+        m.d.comb += [
+            dataRead.addr.eq(lookup),
+            tagsRead.addr.eq(lookup),
+
+            self.o_data.eq(Mux(cached, dataRead.data, self.d_data)),
+            self.o_valid.eq(cached | decoded),
+
+            # Decode is frozen while streaming, anything it has that isn't expected is dropped
+            self.d_ready.eq(~cached & (self.o_ready | ~decoded)),
+
+            self.hit.eq(cached & self.o_ready),
+            self.miss.eq(~cached & decoded & self.o_ready),
+
+            # Fetch has been idle, start it again from where the cache left off
+            self.redirect.eq(self.streaming & ~cached),
+            self.redirectAddr.eq(self.expected),
+        ]
+
+        with m.If(self.hit):
+            m.d.sync += [
+                self.expected.eq(cachedNext),
+                self.streaming.eq(1),
+            ]
+        with m.Elif(self.redirect):
+            m.d.sync += self.streaming.eq(0)
+
+        # Fill with every group delivered from decode
+        with m.If(self.miss):
+            m.d.sync += [
+                self.expected.eq(self.d_next),
+                self.tagValid.eq(self.tagValid | Const(1, self.entries) << self.index(self.d_addr)),
+            ]
+        m.d.comb += [
+            dataWrite.addr.eq(self.index(self.d_addr)),
+            dataWrite.data.eq(self.d_data),
+            dataWrite.en.eq(self.miss),
+            tagsWrite.addr.eq(self.index(self.d_addr)),
+            tagsWrite.data.eq(Cat(self.d_addr, self.d_next)),
+            tagsWrite.en.eq(self.miss),
+        ]
+
+        return m
+
+
+if __name__ == "__main__":
+    class Impl:
+        NumDecodes = 4
+        UopCacheEntries = 16
+
+    cache = UopCache(Impl(), 64, 8)
+    main(cache, ports=[cache.d_data, cache.d_valid, cache.d_addr, cache.d_next, cache.d_ready, cache.o_data,
+                       cache.o_valid, cache.o_ready, cache.redirect, cache.redirectAddr])
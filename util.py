@@ -1,12 +1,52 @@
-from nmigen import Signal
+from nmigen import *
 
-def acclumnateOR(comb, items):
-    result = items[0]
-    for item in items[1:]:
-        new_result = Signal(item.width)
-        comb += new_result.eq(result | item)
-        result = new_result
-    return result
+# Reduction helpers
+#
+# These all build balanced trees out of plain expressions rather than chains of fresh
+# Signals, so the depth grows with log2(len(items)) and elaboration doesn't have to create
+# (and the simulator doesn't have to track) a signal per step.
+
+def treeReduce(op, items):
+    items = list(items)
+    while len(items) > 1:
+        items = [op(items[i], items[i + 1]) if i + 1 < len(items) else items[i] for i in range(0, len(items), 2)]
+    return items[0]
+
+def treeOR(items, empty=Const(0)):
+    items = list(items)
+    return treeReduce(lambda a, b: a | b, items) if items else empty
+
+def treeAND(items, empty=Const(1)):
+    items = list(items)
+    return treeReduce(lambda a, b: a & b, items) if items else empty
+
+def prefixOR(bits):
+    # Kogge-Stone style scan, result[j] is the OR of bits[:j+1]
+    scan = list(bits)
+    distance = 1
+    while distance < len(scan):
+        scan = [scan[j] | scan[j - distance] if j >= distance else scan[j] for j in range(len(scan))]
+        distance *= 2
+    return scan
+
+def anyEqual(value, items):
+    # High if value equals any of items
+    return treeOR(value == item for item in items)
+
+def popcount(bits):
+    # Adder tree, so it's log2(len(bits)) adders deep instead of a chain of increments
+    bits = [Value.cast(bit) for bit in bits]
+    if not bits:
+        return Const(0)
+    return treeReduce(lambda a, b: a + b, bits)
+
+def popcountClamp(bits, clamp):
+    # Counts the high bits, but saturates at clamp
+    bits = list(bits)
+    if len(bits) <= clamp:
+        return popcount(bits)
+    count = popcount(bits)
+    return Mux(count > clamp, clamp, count)
 
 def constEncode(value):
-    return (value& (-value)).bit_length()-1
\ No newline at end of file
+    return (value& (-value)).bit_length()-1